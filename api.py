@@ -1,17 +1,101 @@
 from __future__ import annotations
 
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
 from functools import lru_cache
+from typing import Literal, TypeVar
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 
+import metrics
+from backends import InferenceBackend, create_backend, create_token_counter
+from batcher import PRIORITIES, GenerationBatcher, QueueFullError, RequestCancelledError
+from conversion_cache import ConversionCache, Reservation
+from fastpath import FastPathResult, try_transpile
+from generation import GenerationConfig
+from long_sql import PartConversion, convert_parts, plan_parts
+from parse_sql import SQLPart
+from postprocess import clean_response_text, count_statements, parse_verdict
 from prompt import (
     prompt_trans_system,
     prompt_trans_user,
+    prompt_varify_followup,
     prompt_varify_system,
     prompt_varify_user,
 )
-from qwencoder import GenerationConfig, QwenSqlEncoder
+from replica_pool import ReplicaPool
+
+# 생성 백엔드: hf(GPU transformers), tiny(작은 모델 CPU), fake(모델 없이 입력을 돌려주는 벤치마크용)
+BACKEND = os.getenv("BACKEND", "hf")
+MODEL_NAME = os.getenv("MODEL_NAME", "hf_models/XGenerationLab__XiYanSQL-QwenCoder-32B-2504")
+# speculative decoding용 작은 Qwen 계열 draft 모델 경로(미설정 시 로드하지 않음)
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME") or None
+
+# fake 백엔드 설정: echo(입력 그대로) 또는 transform(간단한 Oracle -> PostgreSQL 치환), 호출당 지연, 디코드 속도
+FAKE_MODE = os.getenv("FAKE_MODE", "echo")
+FAKE_LATENCY_MS = float(os.getenv("FAKE_LATENCY_MS", "0"))
+FAKE_TOKENS_PER_SECOND = float(os.getenv("FAKE_TOKENS_PER_SECOND", "0"))
+
+# 1 이상이면 백엔드를 워커 프로세스 REPLICAS개에 띄우고 대기 토큰이 가장 적은 워커로 요청을 보낸다(0이면 이 프로세스에서 실행).
+REPLICAS = int(os.getenv("REPLICAS", "0"))
+# 워커별 CUDA_VISIBLE_DEVICES. ';'로 구분(예: "0,1;2,3"). 비우면 지정하지 않는다.
+REPLICA_DEVICES = [devices.strip() for devices in os.getenv("REPLICA_DEVICES", "").split(";") if devices.strip()]
+# 워커별 CPU 스레드 수(0이면 지정하지 않음)
+REPLICA_THREADS = int(os.getenv("REPLICA_THREADS", "0"))
+REPLICA_HEALTH_INTERVAL_S = float(os.getenv("REPLICA_HEALTH_INTERVAL_S", "5"))
+REPLICA_HEALTH_TIMEOUT_S = float(os.getenv("REPLICA_HEALTH_TIMEOUT_S", "60"))
+
+# 출력에 프롬프트 마커가 다시 나오면(다음 예제/질문을 지어내기 시작하면) 거기서 멈춘다.
+CONVERSION_STOP_STRINGS = ("Oracle SQL:", "#### example")
+VERIFY_STOP_STRINGS = ("Oracle SQL:",)
+# 변환 출력 토큰 한도 = min(max_new_tokens, 입력 SQL 토큰 수 * ratio + margin)
+OUTPUT_BUDGET_RATIO = float(os.getenv("OUTPUT_BUDGET_RATIO", "2.0"))
+OUTPUT_BUDGET_MARGIN = int(os.getenv("OUTPUT_BUDGET_MARGIN", "64"))
+
+# 서버 시작 시 모델 로딩 후 이 프롬프트 길이(토큰)들로 한 번씩 생성해 커널/캐시를 데운다. 비우면 생략.
+WARMUP_LENGTHS = [int(value) for value in os.getenv("WARMUP_LENGTHS", "64,512,2048").split(",") if value.strip()]
+WARMUP_MAX_NEW_TOKENS = int(os.getenv("WARMUP_MAX_NEW_TOKENS", "8"))
+# 로딩 중 요청에 503과 함께 보내는 Retry-After(초)
+LOADING_RETRY_AFTER_S = int(os.getenv("LOADING_RETRY_AFTER_S", "30"))
+
+# 기본 변환 프롬프트 요청은 먼저 sqlglot 규칙 변환을 시도하고, 지원 구문만으로 된 문장이면 모델 없이 응답한다.
+FAST_PATH = os.getenv("FAST_PATH", "true").lower() in ("1", "true", "yes")
+
+# /convert_long: 조각 하나의 프롬프트(시스템 프롬프트, 예제, 조각 SQL 포함)가 이 토큰 수 안에 들도록
+# 이 깊이 이상의 FROM/JOIN 파생 테이블을 CTE 조각으로 떼어 따로 변환한다.
+LONG_SQL_PART_TOKENS = int(os.getenv("LONG_SQL_PART_TOKENS", "2048"))
+LONG_SQL_MIN_DEPTH = int(os.getenv("LONG_SQL_MIN_DEPTH", "2"))
+# 모델 컨텍스트 길이. 프롬프트 + 출력 한도가 이를 넘는 조각이 있으면 잘리게 두지 않고 413으로 거절한다.
+MODEL_CONTEXT_TOKENS = int(os.getenv("MODEL_CONTEXT_TOKENS", "32768"))
+
+# 요청 deadline(초). 요청 필드 timeout_s와 헤더 X-Request-Timeout 중 작은 값을 쓰고, 0보다 크면 이 값이 상한이 된다.
+REQUEST_TIMEOUT_S = float(os.getenv("REQUEST_TIMEOUT_S", "0"))
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+# 응답을 기다리는 동안 클라이언트 연결이 끊겼는지 확인하는 주기(초)
+DISCONNECT_POLL_S = float(os.getenv("DISCONNECT_POLL_S", "0.5"))
+
+# 동시 요청을 하나의 model.generate로 묶는 마이크로배칭 설정
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "10"))
+# 우선순위 레인별 최대 대기 요청 수. 가득 차면 429 + Retry-After로 응답한다.
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", "256"))
+QUEUE_RETRY_AFTER_S = int(os.getenv("QUEUE_RETRY_AFTER_S", "5"))
+# /generate_batch 한 요청이 동시에 대기열에 올리는 길이 버킷 수
+BATCH_INFLIGHT_BUCKETS = int(os.getenv("BATCH_INFLIGHT_BUCKETS", "2"))
+# 변환 결과 캐시(메모리 LRU + SQLite). 경로를 비우면 메모리 계층만 사용한다.
+CONVERSION_CACHE_PATH = os.getenv("CONVERSION_CACHE_PATH", "conversion_cache.sqlite3")
+CONVERSION_CACHE_SIZE = int(os.getenv("CONVERSION_CACHE_SIZE", "4096"))
+
+Priority = Literal["interactive", "bulk"]
 
 
 class GenerateRequest(BaseModel):
@@ -22,10 +106,24 @@ class GenerateRequest(BaseModel):
     temperature: float = Field(0.1, ge=0.0, le=2.0)
     top_p: float = Field(0.8, ge=0.0, le=1.0)
     do_sample: bool = True
+    priority: Priority = Field("interactive", description="interactive(UI 단건) 또는 bulk(대량 배치 실행)")
+    cache: bool | None = Field(None, description="결과 캐시 사용 여부(미입력 시 do_sample=False일 때만 사용)")
+    prompt_lookup_num_tokens: int | None = Field(
+        None, ge=1, le=64, description="입력 SQL n-gram 복사 후보 길이(prompt lookup decoding, 미입력 시 사용 안 함)"
+    )
+    use_draft_model: bool = Field(False, description="draft 모델 제안 + 본 모델 검증(speculative decoding) 사용 여부")
+    stop_strings: list[str] | None = Field(None, description="출력 중단 문자열(미입력 시 기본 프롬프트 마커 사용)")
+    stop_on_statement_end: bool = Field(True, description="입력과 같은 수의 SQL 문장이 끝나면 생성 중단")
+    auto_max_new_tokens: bool = Field(True, description="입력 SQL 토큰 수에 비례해 출력 토큰 한도를 줄임")
+    timeout_s: float | None = Field(None, gt=0, description="이 시간(초) 안에 끝나지 않으면 생성을 멈추고 504로 응답")
+    fast_path: bool | None = Field(
+        None, description="지원 구문만으로 된 문장은 모델 대신 sqlglot 규칙 변환으로 응답(미입력 시 서버 설정 FAST_PATH)"
+    )
 
 
 class GenerateResponse(BaseModel):
     response: str
+    stats: dict | None = None
 
 
 class VerifyRequest(BaseModel):
@@ -35,46 +133,914 @@ class VerifyRequest(BaseModel):
     temperature: float = Field(0.1, ge=0.0, le=2.0)
     top_p: float = Field(0.8, ge=0.0, le=1.0)
     do_sample: bool = True
+    priority: Priority = Field("interactive", description="interactive(UI 단건) 또는 bulk(대량 배치 실행)")
+    cache: bool | None = Field(None, description="결과 캐시 사용 여부(미입력 시 do_sample=False일 때만 사용)")
+    timeout_s: float | None = Field(None, gt=0, description="이 시간(초) 안에 끝나지 않으면 생성을 멈추고 504로 응답")
+
+
+class ConvertVerifyRequest(BaseModel):
+    question: str = Field(..., description="변환할 Oracle SQL")
+    max_new_tokens: int = Field(1024, ge=1, le=2048)
+    verify_max_new_tokens: int = Field(256, ge=1, le=2048, description="검증 출력 토큰 한도")
+    temperature: float = Field(0.1, ge=0.0, le=2.0)
+    top_p: float = Field(0.8, ge=0.0, le=1.0)
+    do_sample: bool = True
+    priority: Priority = Field("interactive", description="interactive(UI 단건) 또는 bulk(대량 배치 실행)")
+    stop_on_statement_end: bool = Field(True, description="입력과 같은 수의 SQL 문장이 끝나면 생성 중단")
+    auto_max_new_tokens: bool = Field(True, description="입력 SQL 토큰 수에 비례해 출력 토큰 한도를 줄임")
+    timeout_s: float | None = Field(None, gt=0, description="이 시간(초) 안에 끝나지 않으면 생성을 멈추고 504로 응답")
+
+
+class ConvertVerifyResponse(BaseModel):
+    response: str = Field(..., description="변환된 PostgreSQL")
+    verify_response: str = Field(..., description="검증 출력 원문")
+    verdict: dict | None = Field(None, description='{"result": "0"|"1", "reason": ...}, 해석하지 못하면 null')
+    stats: dict | None = None
+
+
+class ConvertLongRequest(BaseModel):
+    question: str = Field(..., description="변환할 긴 Oracle SQL")
+    max_new_tokens: int = Field(1024, ge=1, le=2048, description="조각별 출력 토큰 한도")
+    temperature: float = Field(0.1, ge=0.0, le=2.0)
+    top_p: float = Field(0.8, ge=0.0, le=1.0)
+    do_sample: bool = True
+    priority: Priority = Field("interactive", description="interactive(UI 단건) 또는 bulk(대량 배치 실행)")
+    cache: bool | None = Field(None, description="결과 캐시 사용 여부(미입력 시 do_sample=False일 때만 사용)")
+    stop_on_statement_end: bool = Field(True, description="조각 문장이 끝나면 생성 중단")
+    auto_max_new_tokens: bool = Field(True, description="조각 SQL 토큰 수에 비례해 출력 토큰 한도를 줄임")
+    fast_path: bool | None = Field(
+        None, description="지원 구문만으로 된 조각은 모델 대신 sqlglot 규칙 변환으로 응답(미입력 시 서버 설정 FAST_PATH)"
+    )
+    max_part_tokens: int | None = Field(
+        None, ge=1, description="조각 하나의 프롬프트 토큰 목표, 시스템 프롬프트 포함(미입력 시 LONG_SQL_PART_TOKENS)"
+    )
+    min_depth: int | None = Field(None, ge=0, description="떼어 낼 파생 테이블의 최소 깊이(미입력 시 LONG_SQL_MIN_DEPTH)")
+    timeout_s: float | None = Field(None, gt=0, description="이 시간(초) 안에 끝나지 않으면 생성을 멈추고 504로 응답")
+
+
+class LongSqlPart(BaseModel):
+    statement_index: int
+    name: str = Field(..., description="main 또는 CTE 이름")
+    source_sql: str
+    converted_sql: str
+
+
+class ConvertLongResponse(BaseModel):
+    response: str = Field(..., description="조각 변환 결과를 합친 PostgreSQL")
+    parts: list[LongSqlPart]
+    stats: dict | None = None
+
+
+class BatchItem(BaseModel):
+    question: str | None = Field(None, description="변환할 SQL(변환 항목)")
+    oracle_sql: str | None = Field(None, description="원본 Oracle SQL(검증 항목)")
+    pg_sql: str | None = Field(None, description="변환된 PostgreSQL SQL(검증 항목)")
+
+
+class GenerateBatchRequest(BaseModel):
+    items: list[BatchItem] = Field(..., min_length=1, max_length=10000)
+    max_new_tokens: int = Field(1024, ge=1, le=2048)
+    temperature: float = Field(0.1, ge=0.0, le=2.0)
+    top_p: float = Field(0.8, ge=0.0, le=1.0)
+    do_sample: bool = True
+    priority: Priority = Field("bulk", description="interactive(UI 단건) 또는 bulk(대량 배치 실행)")
+    cache: bool | None = Field(None, description="결과 캐시 사용 여부(미입력 시 do_sample=False일 때만 사용)")
+    prompt_lookup_num_tokens: int | None = Field(
+        None, ge=1, le=64, description="입력 SQL n-gram 복사 후보 길이(prompt lookup decoding, 미입력 시 사용 안 함)"
+    )
+    use_draft_model: bool = Field(False, description="draft 모델 제안 + 본 모델 검증(speculative decoding) 사용 여부")
+    stop_strings: list[str] | None = Field(None, description="출력 중단 문자열(미입력 시 기본 프롬프트 마커 사용)")
+    stop_on_statement_end: bool = Field(True, description="입력과 같은 수의 SQL 문장이 끝나면 생성 중단")
+    auto_max_new_tokens: bool = Field(True, description="입력 SQL 토큰 수에 비례해 출력 토큰 한도를 줄임")
+    timeout_s: float | None = Field(None, gt=0, description="이 시간(초) 안에 끝나지 않으면 생성을 멈추고 504로 응답")
+    fast_path: bool | None = Field(
+        None, description="지원 구문만으로 된 문장은 모델 대신 sqlglot 규칙 변환으로 응답(미입력 시 서버 설정 FAST_PATH)"
+    )
+
+
+class BatchResult(BaseModel):
+    index: int
+    response: str | None = None
+    error: str | None = None
 
 
-app = FastAPI(title="Qwen SQL Encoder API")
+class GenerateBatchResponse(BaseModel):
+    results: list[BatchResult]
+
+
+logger = logging.getLogger(__name__)
+
+
+class LoadState:
+    """모델 로딩/워밍업 진행 상태. /readyz와 요청 수락 여부 판단에 쓴다."""
+
+    def __init__(self) -> None:
+        self.status = "starting"  # starting | loading | warming_up | ready | failed
+        self.error: str | None = None
+        self.timings: dict[str, float] = {}
+        self.ready = threading.Event()
+
+
+load_state = LoadState()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 로딩은 별도 스레드에서 진행해서 그동안에도 /healthz, /readyz가 응답하게 한다.
+    threading.Thread(target=load_and_warm_up, name="model-loader", daemon=True).start()
+    yield
+
+
+app = FastAPI(title="Qwen SQL Encoder API", lifespan=lifespan)
 
 
 @lru_cache(maxsize=1)
-def get_encoder() -> QwenSqlEncoder:
-    model_name = "hf_models/XGenerationLab__XiYanSQL-QwenCoder-32B-2504"
-    return QwenSqlEncoder(model_name)
+def get_encoder() -> InferenceBackend:
+    options = {}
+    if BACKEND == "fake":
+        options = {"mode": FAKE_MODE, "latency_ms": FAKE_LATENCY_MS, "tokens_per_second": FAKE_TOKENS_PER_SECOND}
+    options.update(model_name=MODEL_NAME, draft_model_name=DRAFT_MODEL_NAME)
+    if REPLICAS > 0:
+        return ReplicaPool(
+            BACKEND,
+            REPLICAS,
+            backend_options=options,
+            devices=REPLICA_DEVICES or None,
+            threads_per_replica=REPLICA_THREADS,
+            health_interval_s=REPLICA_HEALTH_INTERVAL_S,
+            health_timeout_s=REPLICA_HEALTH_TIMEOUT_S,
+            token_counter=create_token_counter(BACKEND, **options),
+        )
+    return create_backend(BACKEND, **options)
 
 
-@app.post("/generate", response_model=GenerateResponse)
-def generate_sql(payload: GenerateRequest) -> GenerateResponse:
-    encoder = get_encoder()
+@lru_cache(maxsize=1)
+def get_batcher() -> GenerationBatcher:
+    return GenerationBatcher(
+        get_encoder(),
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_WINDOW_MS,
+        max_queue_size=QUEUE_MAX_SIZE,
+        # 워커마다 배치 하나씩 동시에 실행한다.
+        workers=max(REPLICAS, 1),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_cache() -> ConversionCache:
+    return ConversionCache(
+        path=CONVERSION_CACHE_PATH or None,
+        memory_size=CONVERSION_CACHE_SIZE,
+        # 백엔드마다 결과가 다르므로 모델 이름으로 키 공간을 나눈다(fake 결과가 실제 변환 결과로 쓰이지 않게).
+        namespace=get_encoder().model_name,
+    )
+
+
+def make_warmup_sql(encoder: InferenceBackend, target_tokens: int) -> str:
+    """대략 target_tokens 토큰 길이의 SELECT 문을 만든다."""
+    sample = "SELECT " + ", ".join(f"T.COL_{index}" for index in range(10)) + " FROM DUAL T"
+    tokens_per_column = max(encoder.count_text_tokens(sample) / 10, 1.0)
+    columns = max(1, int(target_tokens / tokens_per_column))
+    return "SELECT " + ", ".join(f"T.COL_{index}" for index in range(columns)) + " FROM DUAL T"
+
+
+def warm_up(encoder: InferenceBackend, lengths: list[int]) -> dict[str, float]:
+    """
+    변환/검증 기본 프롬프트로 길이별 1회씩 생성한다.
+    CUDA 커널 준비와 시스템 프롬프트 KV-cache 생성을 첫 사용자 요청 전에 끝낸다.
+    ReplicaPool이면 워커마다 따로 데운다.
+    """
+    timings: dict[str, float] = {}
+    targets = encoder.replicas if isinstance(encoder, ReplicaPool) else [encoder]
+    for index, target in enumerate(targets):
+        label = f"replica_{index}_" if isinstance(encoder, ReplicaPool) else ""
+        for length in lengths:
+            question = make_warmup_sql(target, length)
+            settings = {"max_new_tokens": WARMUP_MAX_NEW_TOKENS, "do_sample": False}
+            generate_config = build_generate_config(
+                GenerateRequest(question=question, auto_max_new_tokens=False, **settings)
+            )
+            verify_config = build_verify_config(VerifyRequest(oracle_sql=question, pg_sql=question, **settings))
+            started = time.perf_counter()
+            target.generate_batch([question], [generate_config])
+            target.generate_batch([question], [verify_config])
+            timings[f"{label}warmup_{length}_tokens_s"] = time.perf_counter() - started
+    return timings
+
+
+def load_and_warm_up() -> None:
+    started = time.perf_counter()
+    try:
+        load_state.status = "loading"
+        encoder = get_encoder()
+        load_state.timings.update(encoder.load_timings)
+        get_batcher()
+        get_cache()
+        load_state.status = "warming_up"
+        load_state.timings.update(warm_up(encoder, WARMUP_LENGTHS))
+    except Exception as exc:  # noqa: BLE001
+        load_state.status = "failed"
+        load_state.error = str(exc)
+        logger.exception("model loading failed")
+        return
+    load_state.timings["total_startup_s"] = time.perf_counter() - started
+    load_state.status = "ready"
+    load_state.ready.set()
+    logger.info("model ready: %s", load_state.timings)
+
+
+def require_ready() -> None:
+    """로딩이 끝나기 전 요청은 기다리게 하지 않고 503으로 돌려보낸다."""
+    if not load_state.ready.is_set():
+        raise HTTPException(
+            status_code=503,
+            detail=f"model is {load_state.status}",
+            headers={"Retry-After": str(LOADING_RETRY_AFTER_S)},
+        )
+
+
+def should_cache(cache: bool | None, do_sample: bool) -> bool:
+    """샘플링 요청은 명시적으로 cache=true일 때만 캐시를 쓴다."""
+    return cache if cache is not None else not do_sample
+
+
+def wants_fast_path(fast_path: bool | None, payload: GenerateRequest | None = None) -> bool:
+    """요청 값이 없으면 FAST_PATH를 따른다. 프롬프트를 직접 지정한 요청은 항상 모델로 보낸다."""
+    if payload is not None and (payload.system_prompt or payload.user_prompt):
+        return False
+    return FAST_PATH if fast_path is None else fast_path
+
+
+def run_fast_path(question: str) -> FastPathResult:
+    result = try_transpile(question)
+    metrics.FAST_PATH_REQUESTS.inc(result="transpiled" if result.sql is not None else "model")
+    if result.sql is None:
+        logger.debug("fast path fallback (%s)", result.reason)
+    return result
+
+
+def fast_path_stats(result: FastPathResult) -> dict:
+    return {
+        "decode_mode": "fastpath",
+        "backend": "sqlglot",
+        "statements": result.statements,
+        "fast_path_s": result.elapsed_s,
+    }
+
+
+def submit_generation(
+    question: str,
+    config: GenerationConfig,
+    priority: Priority,
+    use_cache: bool,
+    cancel: threading.Event,
+) -> Future:
+    """
+    캐시 적중/동일 요청 진행 중이면 그 결과를, 아니면 배처에 새로 제출한 결과를 기다리는 Future.
+    캐시를 쓰면 공유 생성의 취소는 캐시가 맡는다(기다리는 요청이 모두 떠났을 때만 멈춘다).
+    """
+    batcher = get_batcher()
+    if not use_cache:
+        return batcher.submit(question, config, priority=priority, cancel=cancel)
+    cache = get_cache()
+    return cache.coalesce(
+        cache.key(question, config),
+        lambda shared_cancel: batcher.submit(question, config, priority=priority, cancel=shared_cancel),
+    )
+
+
+def resolve_timeout(request: Request, timeout_s: float | None) -> float | None:
+    """요청 필드, X-Request-Timeout 헤더, 서버 상한(REQUEST_TIMEOUT_S) 중 가장 작은 값."""
+    values = [timeout_s] if timeout_s else []
+    header = request.headers.get(REQUEST_TIMEOUT_HEADER)
+    if header is not None:
+        try:
+            value = float(header)
+        except ValueError:
+            value = 0.0
+        if value <= 0:
+            raise HTTPException(status_code=400, detail=f"{REQUEST_TIMEOUT_HEADER} must be a positive number of seconds")
+        values.append(value)
+    if REQUEST_TIMEOUT_S > 0:
+        values.append(REQUEST_TIMEOUT_S)
+    return min(values) if values else None
+
+
+def abandon_generation(futures: list[Future], cancel: threading.Event) -> None:
+    """대기 중인 요청은 대기열에서 빼고, 실행 중인 요청은 다음 디코드 스텝에서 멈추게 한다."""
+    cancel.set()
+    for future in futures:
+        future.cancel()
+
+
+T = TypeVar("T")
+
+
+def discard_task(task: asyncio.Future) -> None:
+    """더 기다리지 않을 작업을 취소하고, 이미 실패로 끝났다면 그 예외를 읽어 경고 로그를 막는다."""
+    task.cancel()
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+
+async def guard_request(
+    request: Request,
+    waiter: Awaitable[T],
+    timeout: float | None,
+    abandon: Callable[[], None],
+) -> T:
+    """
+    waiter를 기다리다 deadline이 지나면 504, 클라이언트 연결이 끊기면 499로 끝낸다.
+    두 경우 모두 abandon()으로 생성을 멈춘다.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout is not None else None
+    task = asyncio.ensure_future(waiter)
+    try:
+        while True:
+            wait_s = DISCONNECT_POLL_S
+            if deadline is not None:
+                wait_s = min(wait_s, max(deadline - loop.time(), 0.0))
+            done, _ = await asyncio.wait({task}, timeout=wait_s)
+            if done:
+                return task.result()
+            if deadline is not None and loop.time() >= deadline:
+                reason = "deadline"
+                break
+            if await request.is_disconnected():
+                reason = "disconnect"
+                break
+    except asyncio.CancelledError:
+        abandon()
+        discard_task(task)
+        raise
+    abandon()
+    discard_task(task)
+    metrics.ABANDONED_REQUESTS.inc(reason=reason)
+    if reason == "deadline":
+        raise HTTPException(status_code=504, detail=f"deadline of {timeout:g}s exceeded")
+    raise HTTPException(status_code=499, detail="client closed request")
+
+
+# 지연 시간 히스토그램과 처리 중 요청 수를 기록하는 엔드포인트
+METRIC_ENDPOINTS = (
+    "/generate",
+    "/generate/stream",
+    "/verify",
+    "/verify/stream",
+    "/convert_verify",
+    "/convert_long",
+    "/generate_batch",
+)
+
+
+class RequestMetricsMiddleware:
+    """
+    METRIC_ENDPOINTS의 처리 중 요청 수와 지연 시간(스트리밍은 마지막 바이트까지)을 기록한다.
+    BaseHTTPMiddleware는 receive를 감싸서 엔드포인트가 연결 끊김을 감지하지 못하게 하므로 순수 ASGI로 둔다.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or scope["path"] not in METRIC_ENDPOINTS:
+            await self.app(scope, receive, send)
+            return
+        endpoint = scope["path"]
+        status = "500"
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        started = time.perf_counter()
+        metrics.INFLIGHT_REQUESTS.inc(endpoint=endpoint)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.INFLIGHT_REQUESTS.dec(endpoint=endpoint)
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, status=status)
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(QUEUE_RETRY_AFTER_S)},
+    )
+
+
+def build_generate_config(payload: GenerateRequest) -> GenerationConfig:
+    """디코딩 모드 조합이 잘못됐거나 draft 모델이 없으면 ValueError."""
+    if payload.use_draft_model and DRAFT_MODEL_NAME is None:
+        raise ValueError("draft model is not configured (set DRAFT_MODEL_NAME)")
     system_prompt = payload.system_prompt or prompt_trans_system()
     user_prompt = payload.user_prompt or prompt_trans_user(question=payload.question)
-    config = GenerationConfig(
+    expected_statements = count_statements(payload.question) if payload.stop_on_statement_end else 0
+    return GenerationConfig(
         system_prompt=system_prompt,
         user_prompt=user_prompt,
         max_new_tokens=payload.max_new_tokens,
         temperature=payload.temperature,
         top_p=payload.top_p,
         do_sample=payload.do_sample,
+        prompt_lookup_num_tokens=payload.prompt_lookup_num_tokens,
+        use_draft_model=payload.use_draft_model,
+        stop_strings=tuple(CONVERSION_STOP_STRINGS if payload.stop_strings is None else payload.stop_strings),
+        expected_statements=expected_statements or None,
+        output_budget_ratio=OUTPUT_BUDGET_RATIO if payload.auto_max_new_tokens else None,
+        output_budget_margin=OUTPUT_BUDGET_MARGIN,
     )
-    output = encoder.generate(payload.question, config=config)
-    return GenerateResponse(response=output)
 
 
-@app.post("/verify", response_model=GenerateResponse)
-def verify_sql(payload: VerifyRequest) -> GenerateResponse:
-    encoder = get_encoder()
+def build_verify_config(payload: VerifyRequest) -> GenerationConfig:
     system_prompt = prompt_varify_system()
     user_prompt = prompt_varify_user(oracle_sql=payload.oracle_sql, pg_sql=payload.pg_sql)
-    config = GenerationConfig(
+    return GenerationConfig(
         system_prompt=system_prompt,
         user_prompt=user_prompt,
         max_new_tokens=payload.max_new_tokens,
         temperature=payload.temperature,
         top_p=payload.top_p,
         do_sample=payload.do_sample,
+        stop_strings=VERIFY_STOP_STRINGS,
     )
-    output = encoder.generate(payload.oracle_sql, config=config)
-    return GenerateResponse(response=output)
+
+
+def build_convert_verify_configs(payload: ConvertVerifyRequest) -> tuple[GenerationConfig, GenerationConfig]:
+    """변환 설정과, 같은 대화에 이어 붙일 검증 후속 질문 설정."""
+    settings = {"temperature": payload.temperature, "top_p": payload.top_p, "do_sample": payload.do_sample}
+    convert_config = build_generate_config(
+        GenerateRequest(
+            question=payload.question,
+            max_new_tokens=payload.max_new_tokens,
+            stop_on_statement_end=payload.stop_on_statement_end,
+            auto_max_new_tokens=payload.auto_max_new_tokens,
+            **settings,
+        )
+    )
+    verify_config = GenerationConfig(
+        user_prompt=prompt_varify_followup(),
+        max_new_tokens=payload.verify_max_new_tokens,
+        stop_strings=VERIFY_STOP_STRINGS,
+        **settings,
+    )
+    return convert_config, verify_config
+
+
+def build_batch_item_config(item: BatchItem, payload: GenerateBatchRequest) -> tuple[str, GenerationConfig]:
+    """question이 있으면 변환 항목, oracle_sql과 pg_sql이 있으면 검증 항목으로 본다."""
+    settings = {
+        "max_new_tokens": payload.max_new_tokens,
+        "temperature": payload.temperature,
+        "top_p": payload.top_p,
+        "do_sample": payload.do_sample,
+    }
+    if item.question:
+        request = GenerateRequest(
+            question=item.question,
+            prompt_lookup_num_tokens=payload.prompt_lookup_num_tokens,
+            use_draft_model=payload.use_draft_model,
+            stop_strings=payload.stop_strings,
+            stop_on_statement_end=payload.stop_on_statement_end,
+            auto_max_new_tokens=payload.auto_max_new_tokens,
+            **settings,
+        )
+        return item.question, build_generate_config(request)
+    if item.oracle_sql and item.pg_sql:
+        verify = VerifyRequest(oracle_sql=item.oracle_sql, pg_sql=item.pg_sql, **settings)
+        return item.oracle_sql, build_verify_config(verify)
+    raise ValueError("item needs either question or both oracle_sql and pg_sql")
+
+
+def bucket_by_length(
+    entries: list[tuple[int, str, GenerationConfig, int]],
+    bucket_size: int,
+) -> list[list[tuple[int, str, GenerationConfig, int]]]:
+    """
+    (index, question, config, token 수) 목록을 batch_key별로 나누고 토큰 길이순으로 정렬해
+    bucket_size개씩 자른다. 비슷한 길이끼리 묶여 왼쪽 패딩 낭비가 줄어든다.
+    """
+    by_key: dict[tuple, list[tuple[int, str, GenerationConfig, int]]] = {}
+    for entry in entries:
+        by_key.setdefault(entry[2].batch_key(), []).append(entry)
+    buckets = []
+    for group in by_key.values():
+        group.sort(key=lambda entry: entry[3])
+        size = bucket_size if group[0][2].batchable else 1
+        buckets.extend(group[i:i + size] for i in range(0, len(group), size))
+    return buckets
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def start_stream(
+    question: str,
+    config: GenerationConfig,
+    priority: Priority,
+    timeout: float | None = None,
+) -> AsyncIterator[str]:
+    """
+    응답을 시작하기 전에 대기열에 넣어서, 대기열이 가득 차면 스트림 대신 429가 나가도록 한다.
+    """
+    loop = asyncio.get_running_loop()
+    chunks: asyncio.Queue[str | None] = asyncio.Queue()
+    cancel = threading.Event()
+
+    def on_text(text: str) -> None:
+        loop.call_soon_threadsafe(chunks.put_nowait, text)
+
+    future = get_batcher().submit(question, config, priority=priority, on_text=on_text, cancel=cancel)
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(chunks.put_nowait, None))
+    deadline = loop.time() + timeout if timeout is not None else None
+    return stream_events(future, chunks, cancel, deadline)
+
+
+async def stream_events(
+    future: Future,
+    chunks: asyncio.Queue[str | None],
+    cancel: threading.Event,
+    deadline: float | None = None,
+) -> AsyncIterator[str]:
+    """
+    토큰이 디코딩되는 대로 `token` 이벤트를 보내고, 마지막에 정리된 전체 텍스트를 `done` 이벤트로 보낸다.
+    deadline(loop.time() 기준)이 지나면 `error` 이벤트를 보내고 끝낸다.
+    클라이언트가 연결을 끊거나 deadline이 지나면 cancel이 set되어 다음 디코드 스텝에서 생성이 중단되고,
+    아직 대기 중이면 대기열에서 빠진다.
+    """
+    loop = asyncio.get_running_loop()
+    finished = False
+    try:
+        while True:
+            remaining = deadline - loop.time() if deadline is not None else None
+            try:
+                chunk = await asyncio.wait_for(chunks.get(), remaining)
+            except asyncio.TimeoutError:
+                finished = True
+                metrics.ABANDONED_REQUESTS.inc(reason="deadline")
+                yield format_sse("error", {"detail": "deadline exceeded"})
+                return
+            if chunk is None:
+                break
+            yield format_sse("token", {"text": chunk})
+        finished = True
+        try:
+            output = future.result()
+        except Exception as exc:  # noqa: BLE001
+            yield format_sse("error", {"detail": str(exc)})
+            return
+        yield format_sse("done", {"response": clean_response_text(output.text)})
+    finally:
+        if not finished:
+            metrics.ABANDONED_REQUESTS.inc(reason="disconnect")
+        abandon_generation([future], cancel)
+
+
+async def fast_path_events(sql: str) -> AsyncIterator[str]:
+    """규칙 변환 결과는 한 번에 나오므로 token 이벤트 하나와 done 이벤트로 보낸다."""
+    yield format_sse("token", {"text": sql})
+    yield format_sse("done", {"response": sql})
+
+
+@app.get("/healthz")
+async def healthz() -> dict:
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz() -> JSONResponse:
+    body = {"status": load_state.status, "timings": load_state.timings, "error": load_state.error}
+    if load_state.ready.is_set() and REPLICAS > 0:
+        body["replicas"] = get_encoder().status()
+    return JSONResponse(status_code=200 if load_state.ready.is_set() else 503, content=body)
+
+
+@app.get("/metrics")
+async def prometheus_metrics() -> Response:
+    if load_state.ready.is_set():
+        batcher = get_batcher()
+        for priority in PRIORITIES:
+            metrics.QUEUE_DEPTH.set(batcher.queue_depth(priority), priority=priority)
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.post("/generate", response_model=GenerateResponse, dependencies=[Depends(require_ready)])
+async def generate_sql(payload: GenerateRequest, request: Request) -> GenerateResponse:
+    try:
+        config = build_generate_config(payload)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    if wants_fast_path(payload.fast_path, payload):
+        result = await asyncio.to_thread(run_fast_path, payload.question)
+        if result.sql is not None:
+            return GenerateResponse(response=result.sql, stats=fast_path_stats(result))
+    return await run_generation(request, payload.question, config, payload)
+
+
+async def run_generation(
+    request: Request,
+    question: str,
+    config: GenerationConfig,
+    payload: GenerateRequest | VerifyRequest,
+) -> GenerateResponse:
+    timeout = resolve_timeout(request, payload.timeout_s)
+    use_cache = should_cache(payload.cache, payload.do_sample)
+    cancel = threading.Event()
+    # 캐시 조회가 SQLite를 읽을 수 있으므로 제출은 이벤트 루프 밖에서 한다.
+    future = await asyncio.to_thread(submit_generation, question, config, payload.priority, use_cache, cancel)
+    output = await guard_request(
+        request,
+        asyncio.wrap_future(future),
+        timeout,
+        lambda: abandon_generation([future], cancel),
+    )
+    return GenerateResponse(response=output.text, stats=output.stats)
+
+
+@app.post("/generate/stream", dependencies=[Depends(require_ready)])
+async def generate_sql_stream(payload: GenerateRequest, request: Request) -> StreamingResponse:
+    try:
+        config = build_generate_config(payload)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    if wants_fast_path(payload.fast_path, payload):
+        result = await asyncio.to_thread(run_fast_path, payload.question)
+        if result.sql is not None:
+            return StreamingResponse(fast_path_events(result.sql), media_type="text/event-stream")
+    timeout = resolve_timeout(request, payload.timeout_s)
+    events = start_stream(payload.question, config, payload.priority, timeout)
+    return StreamingResponse(events, media_type="text/event-stream")
+
+
+@app.post("/verify", response_model=GenerateResponse, dependencies=[Depends(require_ready)])
+async def verify_sql(payload: VerifyRequest, request: Request) -> GenerateResponse:
+    config = build_verify_config(payload)
+    return await run_generation(request, payload.oracle_sql, config, payload)
+
+
+@app.post("/verify/stream", dependencies=[Depends(require_ready)])
+async def verify_sql_stream(payload: VerifyRequest, request: Request) -> StreamingResponse:
+    config = build_verify_config(payload)
+    timeout = resolve_timeout(request, payload.timeout_s)
+    events = start_stream(payload.oracle_sql, config, payload.priority, timeout)
+    return StreamingResponse(events, media_type="text/event-stream")
+
+
+@app.post("/convert_verify", response_model=ConvertVerifyResponse, dependencies=[Depends(require_ready)])
+async def convert_and_verify_sql(payload: ConvertVerifyRequest, request: Request) -> ConvertVerifyResponse:
+    """
+    변환과 검증을 한 번에 실행한다. 검증은 변환 대화에 후속 질문으로 이어 붙여
+    Oracle SQL과 변환 결과의 KV-cache를 다시 prefill하지 않는다.
+    """
+    convert_config, verify_config = build_convert_verify_configs(payload)
+    timeout = resolve_timeout(request, payload.timeout_s)
+    cancel = threading.Event()
+    future = get_batcher().submit_convert_verify(
+        payload.question, convert_config, verify_config, priority=payload.priority, cancel=cancel
+    )
+    conversion, verdict = await guard_request(
+        request,
+        asyncio.wrap_future(future),
+        timeout,
+        lambda: abandon_generation([future], cancel),
+    )
+    return ConvertVerifyResponse(
+        response=conversion.text,
+        verify_response=verdict.text,
+        verdict=parse_verdict(verdict.text),
+        stats={"convert": conversion.stats, "verify": verdict.stats},
+    )
+
+
+def build_part_config(sql: str, payload: ConvertLongRequest) -> GenerationConfig:
+    return build_generate_config(
+        GenerateRequest(
+            question=sql,
+            max_new_tokens=payload.max_new_tokens,
+            temperature=payload.temperature,
+            top_p=payload.top_p,
+            do_sample=payload.do_sample,
+            stop_on_statement_end=payload.stop_on_statement_end,
+            auto_max_new_tokens=payload.auto_max_new_tokens,
+        )
+    )
+
+
+def plan_long_sql(payload: ConvertLongRequest) -> tuple[list[SQLPart], list[PartConversion], dict]:
+    """
+    조각 SQL 토큰 한도 = 조각 프롬프트 목표 - (빈 질문으로 렌더링한 변환 프롬프트 토큰 수)로 나누고,
+    프롬프트 + 출력 한도가 MODEL_CONTEXT_TOKENS를 넘는 조각이 있으면 413.
+    """
+    encoder = get_encoder()
+    part_tokens = payload.max_part_tokens or LONG_SQL_PART_TOKENS
+    prompt_tokens = encoder.count_tokens(build_part_config("", payload))
+    sql_tokens = part_tokens - prompt_tokens
+    if sql_tokens <= 0:
+        raise HTTPException(
+            status_code=400,
+            detail=f"max_part_tokens {part_tokens} leaves no room after the {prompt_tokens}-token prompt",
+        )
+    statements, parts = plan_parts(
+        payload.question,
+        min_depth_to_extract=LONG_SQL_MIN_DEPTH if payload.min_depth is None else payload.min_depth,
+        count_tokens=encoder.count_text_tokens,
+        max_tokens=sql_tokens,
+    )
+    too_long = []
+    for part in parts:
+        total = prompt_tokens + encoder.count_text_tokens(part.source_sql)
+        total += encoder.token_budget(part.source_sql, build_part_config(part.source_sql, payload))
+        if total > MODEL_CONTEXT_TOKENS:
+            too_long.append(f"{part.name} ({total} tokens)")
+    if too_long:
+        raise HTTPException(
+            status_code=413,
+            detail=f"parts exceed the {MODEL_CONTEXT_TOKENS}-token context window: {', '.join(too_long)}",
+        )
+    return statements, parts, {"prompt_tokens": prompt_tokens, "max_sql_tokens": sql_tokens}
+
+
+@app.post("/convert_long", response_model=ConvertLongResponse, dependencies=[Depends(require_ready)])
+async def convert_long_sql_endpoint(payload: ConvertLongRequest, request: Request) -> ConvertLongResponse:
+    """
+    긴 문장을 메모리에서 main + 파생 테이블 CTE 조각으로 토큰 한도에 맞게 나누고,
+    조각을 모두 동시에 대기열에 올려 변환한 뒤 합친다.
+    조각 하나가 실패하면 나머지 조각 생성을 멈추고 오류로 응답한다.
+    """
+    timeout = resolve_timeout(request, payload.timeout_s)
+    use_cache = should_cache(payload.cache, payload.do_sample)
+    use_fast_path = wants_fast_path(payload.fast_path)
+    cancel = threading.Event()
+    pending: list[Future] = []
+    counts = {"fastpath": 0, "model": 0}
+
+    async def convert_part(sql: str) -> str:
+        if use_fast_path:
+            result = await asyncio.to_thread(run_fast_path, sql)
+            if result.sql is not None:
+                counts["fastpath"] += 1
+                return result.sql
+        config = build_part_config(sql, payload)
+        if cancel.is_set():
+            raise RequestCancelledError()
+        future = await asyncio.to_thread(submit_generation, sql, config, payload.priority, use_cache, cancel)
+        pending.append(future)
+        if cancel.is_set():
+            # 제출하는 동안 요청이 끝났으면 abandon_generation이 이 Future를 보지 못했다.
+            future.cancel()
+        counts["model"] += 1
+        return (await asyncio.wrap_future(future)).text
+
+    started = time.perf_counter()
+    statements, parts, budget = await asyncio.to_thread(plan_long_sql, payload)
+    try:
+        conversion = await guard_request(
+            request,
+            convert_parts(statements, parts, convert_part),
+            timeout,
+            lambda: abandon_generation(pending, cancel),
+        )
+    except Exception:
+        abandon_generation(pending, cancel)
+        raise
+    return ConvertLongResponse(
+        response=conversion.sql,
+        parts=[LongSqlPart(**vars(part)) for part in conversion.parts],
+        stats={
+            "statements": len(conversion.split),
+            "parts": len(conversion.parts),
+            "fastpath_parts": counts["fastpath"],
+            "model_parts": counts["model"],
+            **budget,
+            "split": conversion.split,
+            "elapsed_s": time.perf_counter() - started,
+        },
+    )
+
+
+@app.post("/generate_batch", response_model=GenerateBatchResponse, dependencies=[Depends(require_ready)])
+async def generate_sql_batch(payload: GenerateBatchRequest, request: Request) -> GenerateBatchResponse:
+    """
+    여러 변환/검증 항목을 받아 토큰 길이 버킷 단위로 인코더에 넘기고, 입력 순서대로 결과를 돌려준다.
+    항목별 오류는 해당 항목의 error에 담고 나머지 항목은 계속 처리한다.
+    deadline이 지나거나 연결이 끊기면 아직 끝나지 않은 항목을 모두 멈추고 504/499로 응답한다.
+    """
+    timeout = resolve_timeout(request, payload.timeout_s)
+    cancel = threading.Event()
+    pending: list[Future] = []
+    results = [BatchResult(index=index) for index in range(len(payload.items))]
+    use_cache = should_cache(payload.cache, payload.do_sample)
+    cache = get_cache()
+
+    # 규칙 변환으로 끝나는 변환 항목은 모델 대기열에 올리지 않는다.
+    fast_results: dict[int, FastPathResult] = {}
+    if wants_fast_path(payload.fast_path):
+        fast_results = await asyncio.to_thread(
+            lambda: {index: run_fast_path(item.question) for index, item in enumerate(payload.items) if item.question}
+        )
+
+    # 캐시 적중이나 이미 진행 중인 동일 요청(같은 요청 안의 중복 포함)은 그 결과를 기다린다.
+    # 미스는 제출하기 전에 실행 중으로 먼저 등록(reserve)하므로 동시에 들어온 같은 요청도 한 번만 생성한다.
+    # 캐시 조회는 SQLite를 읽을 수 있으므로 이벤트 루프 밖에서 한다.
+    reservations: dict[int, Reservation] = {}
+
+    def plan_items() -> tuple[list[tuple[int, str, GenerationConfig]], list[tuple[int, Future]]]:
+        entries: list[tuple[int, str, GenerationConfig]] = []
+        waiting: list[tuple[int, Future]] = []
+        for index, item in enumerate(payload.items):
+            fast = fast_results.get(index)
+            if fast is not None and fast.sql is not None:
+                results[index].response = fast.sql
+                continue
+            try:
+                question, config = build_batch_item_config(item, payload)
+            except ValueError as exc:
+                results[index].error = str(exc)
+                continue
+            if use_cache:
+                reservation = cache.reserve(cache.key(question, config))
+                pending.append(reservation.future)
+                if reservation.source is None:
+                    waiting.append((index, reservation.future))
+                    continue
+                reservations[index] = reservation
+            entries.append((index, question, config))
+        return entries, waiting
+
+    entries, waiting = await asyncio.to_thread(plan_items)
+
+    def release(indexes: list[int], exc: BaseException) -> None:
+        # 제출하지 못한 자리는 오류로 끝내 같은 키를 기다리는 다른 요청이 멈춰 있지 않게 한다.
+        for index in indexes:
+            reservation = reservations.pop(index, None)
+            if reservation is not None:
+                cache.fail(reservation, exc)
+
+    try:
+        encoder = get_encoder()
+        lengths = await asyncio.to_thread(lambda: [encoder.count_tokens(config) for _, _, config in entries])
+        buckets = bucket_by_length(
+            [(index, question, config, length) for (index, question, config), length in zip(entries, lengths)],
+            bucket_size=BATCH_MAX_SIZE,
+        )
+
+        batcher = get_batcher()
+        inflight = asyncio.Semaphore(BATCH_INFLIGHT_BUCKETS)
+
+        async def collect(index: int, future: Future) -> None:
+            try:
+                results[index].response = (await asyncio.wrap_future(future)).text
+            except Exception as exc:  # noqa: BLE001
+                results[index].error = str(exc)
+
+        async def run_bucket(bucket: list[tuple[int, str, GenerationConfig, int]]) -> None:
+            async with inflight:
+                if cancel.is_set():
+                    return
+                indexes = [index for index, _, _, _ in bucket]
+                # 캐시를 쓰면 다른 요청이 같은 생성을 기다릴 수 있으므로 항목별 Event는 캐시가 맡는다.
+                if use_cache:
+                    cancels = [reservations[index].cancel for index in indexes]
+                else:
+                    cancels = [cancel] * len(bucket)
+                try:
+                    futures = batcher.submit_group(
+                        [question for _, question, _, _ in bucket],
+                        [config for _, _, config, _ in bucket],
+                        priority=payload.priority,
+                        cancels=cancels,
+                    )
+                except QueueFullError as exc:
+                    release(indexes, exc)
+                    for index in indexes:
+                        results[index].error = str(exc)
+                    return
+                if use_cache:
+                    for index, future in zip(indexes, futures):
+                        cache.attach(reservations[index], future)
+                    futures = [reservations.pop(index).future for index in indexes]
+                else:
+                    pending.extend(futures)
+                for index, future in zip(indexes, futures):
+                    await collect(index, future)
+
+        await guard_request(
+            request,
+            asyncio.gather(
+                *(run_bucket(bucket) for bucket in buckets),
+                *(collect(index, future) for index, future in waiting),
+            ),
+            timeout,
+            lambda: abandon_generation(pending, cancel),
+        )
+    finally:
+        release(list(reservations), RuntimeError("generation was not submitted"))
+    return GenerateBatchResponse(results=results)
@@ -2,7 +2,6 @@ import io
 import json
 import os
 import re
-import tempfile
 from pathlib import Path
 from typing import Any
 
@@ -13,8 +12,10 @@ import sqlglot
 import streamlit as st
 from dotenv import load_dotenv
 
-from parse_sql import split_sql_file
-from xml_to_sql import export_from_xml_file
+from postprocess import clean_response_text
+from run_ledger import STAGE_CONVERT, RunLedger, content_hash
+from split_batch import SplitJob, SplitOptions, run_split_jobs
+from xml_to_sql import export_xml_files
 
 
 REQUIRED_COLUMNS = ["sql_src", "sql_length", "sql_modified"]
@@ -39,26 +40,32 @@ NON_QUERY_KEYWORDS = {
 ORACLE_XML_DIR = Path("./data/oracle/")
 EXPORTED_SQL_DIR = Path("./data/oracle/_exported_sql/")
 PARTS_OUT_DIR = Path("./out_parts/")
+# 여러 SQL에서 반복되는 파생 테이블 조각은 여기에 한 번만 저장하고 manifest가 상대 경로로 참조한다.
+PARTS_FRAGMENTS_DIR = PARTS_OUT_DIR / "_fragments"
 SQL_SPLIT_THRESHOLD = 2500
+# SQL 분할에 쓰는 프로세스 수(0이면 CPU 수)
+SPLIT_WORKERS = int(os.getenv("SPLIT_WORKERS", "0")) or None
+# 분할 결과 캐시(SQLite). 빈 값이면 끈다. 같은 SQL을 다시 분할할 때 sqlglot 파싱을 건너뛴다.
+PARSE_CACHE_PATH = os.getenv("PARSE_CACHE_PATH", "parse_cache.sqlite3")
+# 단계별 입력/출력 해시 원장(SQLite). 빈 값이면 끈다. 다시 실행하면 입력이 바뀐 XML/SQL/행만 처리한다.
+PIPELINE_LEDGER_PATH = os.getenv("PIPELINE_LEDGER_PATH", "run_ledger.sqlite3")
+# /generate_batch 사용 시 한 번의 HTTP 요청에 담는 행 수
+CONVERSION_BATCH_SIZE = 32
+# API 응답 대기 시간(초). 같은 값을 X-Request-Timeout으로 보내 서버도 그 뒤에는 생성을 멈추게 한다.
+API_TIMEOUT_S = float(os.getenv("API_TIMEOUT_S", "600"))
+BATCH_API_TIMEOUT_S = float(os.getenv("BATCH_API_TIMEOUT_S", "3600"))
 
 
 def build_payload(user_input: str) -> dict:
-    return {"question": user_input}
+    return {"question": user_input, "priority": "bulk"}
 
 
-def build_verify_payload(oracle_sql: str, pg_sql: str) -> dict:
-    return {"oracle_sql": oracle_sql, "pg_sql": pg_sql}
+def build_batch_payload(questions: list[str]) -> dict:
+    return {"items": [{"question": question} for question in questions], "priority": "bulk"}
 
 
-def clean_response_text(text: str) -> str:
-    if not text:
-        return text
-    cleaned = text.lstrip("\ufeff").lstrip()
-    cleaned = re.sub(r"^(?:\\n)+", "", cleaned)
-    cleaned = cleaned.lstrip("\n")
-    cleaned = re.sub(r"(?i)^\s*assistant[:\s]*", "", cleaned)
-    cleaned = re.sub(r"^[^A-Za-z0-9_]+", "", cleaned)
-    return cleaned
+def build_verify_payload(oracle_sql: str, pg_sql: str) -> dict:
+    return {"oracle_sql": oracle_sql, "pg_sql": pg_sql, "priority": "bulk"}
 
 
 def get_response_text(response: requests.Response) -> str:
@@ -79,7 +86,12 @@ def fetch_response_text(api_url: str, payload: dict, max_retries: int = 2) -> st
     attempts = 0
     last_response_text = ""
     while attempts <= max_retries:
-        response = requests.post(api_url, json=payload)
+        response = requests.post(
+            api_url,
+            json=payload,
+            headers={"X-Request-Timeout": str(API_TIMEOUT_S)},
+            timeout=API_TIMEOUT_S,
+        )
         response.raise_for_status()
         last_response_text = get_response_text(response)
         if last_response_text.strip():
@@ -88,6 +100,28 @@ def fetch_response_text(api_url: str, payload: dict, max_retries: int = 2) -> st
     return last_response_text
 
 
+def fetch_batch_response_texts(api_url: str, payload: dict, max_retries: int = 2) -> list[tuple[str, str | None]]:
+    items = payload["items"]
+    responses: list[tuple[str, str | None]] = [("", None)] * len(items)
+    # fetch_response_text와 같이, 오류 없이 빈 응답을 받은 항목만 모아 max_retries번까지 다시 보낸다.
+    pending = list(range(len(items)))
+    attempts = 0
+    while pending and attempts <= max_retries:
+        response = requests.post(
+            api_url,
+            json={**payload, "items": [items[index] for index in pending]},
+            headers={"X-Request-Timeout": str(BATCH_API_TIMEOUT_S)},
+            timeout=BATCH_API_TIMEOUT_S,
+        )
+        response.raise_for_status()
+        results = response.json()["results"]
+        for index, result in zip(pending, results):
+            responses[index] = (clean_response_text(result.get("response") or ""), result.get("error"))
+        pending = [index for index in pending if not responses[index][1] and not responses[index][0].strip()]
+        attempts += 1
+    return responses
+
+
 def get_db_settings() -> tuple[str | None, int | None]:
     host = os.getenv("POSTGRES_HOST")
     port_value = os.getenv("POSTGRES_PORT")
@@ -147,6 +181,20 @@ def fetch_verify_rows(connection: psycopg2.extensions.connection) -> pd.DataFram
     )
 
 
+def fetch_result_texts(cursor: Any, src_obj_ids: list[str]) -> dict[str, str]:
+    if not src_obj_ids:
+        return {}
+    cursor.execute(
+        """
+        SELECT "src_obj_id", "new_sql_src"
+        FROM scai_iv.ais_chg_rslt
+        WHERE "src_obj_id" = ANY(%s) AND "new_sql_src" IS NOT NULL
+        """,
+        (src_obj_ids,),
+    )
+    return {str(src_obj_id): new_sql_src for src_obj_id, new_sql_src in cursor.fetchall()}
+
+
 def upsert_result_row(cursor: Any, row: dict[str, Any]) -> None:
     cursor.execute(
         """
@@ -203,15 +251,22 @@ def list_sql_files(directory: Path) -> list[Path]:
     return sorted(path for path in directory.glob("*.sql") if path.is_file())
 
 
-def export_xml_directory_to_sql(src_dir: Path, out_dir: Path) -> tuple[int, int]:
+def get_ledger() -> RunLedger | None:
+    return RunLedger(PIPELINE_LEDGER_PATH) if PIPELINE_LEDGER_PATH else None
+
+
+def conversion_input_hash(api_url: str, question: str) -> str:
+    """변환 단계의 입력 해시: 호출한 API와 원본 SQL."""
+    return content_hash(api_url.rstrip("/"), question)
+
+
+def export_xml_directory_to_sql(src_dir: Path, out_dir: Path) -> tuple[int, int, int]:
     out_dir.mkdir(parents=True, exist_ok=True)
     xml_files = sorted(src_dir.glob("*.xml"))
 
-    exported_count = 0
-    for xml_path in xml_files:
-        exported_count += export_from_xml_file(xml_path, out_dir)
+    exported_count, skipped_count = export_xml_files(xml_files, out_dir, ledger=get_ledger())
 
-    return len(xml_files), exported_count
+    return len(xml_files), exported_count, skipped_count
 
 
 def run_preprocessing(db_name: str, db_user: str, db_password: str, db_host: str | None, db_port: int | None) -> None:
@@ -220,7 +275,9 @@ def run_preprocessing(db_name: str, db_user: str, db_password: str, db_host: str
 
     if st.button("변환 실행"):
         try:
-            exported_files, exported_count = export_xml_directory_to_sql(ORACLE_XML_DIR, EXPORTED_SQL_DIR)
+            exported_files, exported_count, skipped_files = export_xml_directory_to_sql(
+                ORACLE_XML_DIR, EXPORTED_SQL_DIR
+            )
         except Exception as exc:  # noqa: BLE001
             st.error(f"xml_to_sql.py 실행이 실패했습니다: {exc}")
         else:
@@ -228,7 +285,8 @@ def run_preprocessing(db_name: str, db_user: str, db_password: str, db_host: str
                 st.warning(f"{ORACLE_XML_DIR} 경로에 XML 파일이 없습니다.")
             else:
                 st.success(
-                    f"실행 완료: XML {exported_files}개, SQL {exported_count}건을 `{EXPORTED_SQL_DIR}`에 저장했습니다."
+                    f"실행 완료: XML {exported_files}개 중 {exported_files - skipped_files}개에서 "
+                    f"SQL {exported_count}건을 `{EXPORTED_SQL_DIR}`에 저장했습니다. (변경 없는 XML {skipped_files}개 건너뜀)"
                 )
 
     st.subheader("2. SQL 로드")
@@ -302,6 +360,10 @@ def run_preprocessing(db_name: str, db_user: str, db_password: str, db_host: str
     st.subheader("3. SQL 분할")
     st.caption(f"SQL 길이 {SQL_SPLIT_THRESHOLD}자 이상은 분할하고, 미만은 단일 파일로 ./out_parts/{{sql파일명}}/ 폴더에 저장합니다.")
 
+    split_changed_only = st.checkbox(
+        "변경된 SQL만 분할", value=True, key="split_changed_only", disabled=not PIPELINE_LEDGER_PATH
+    )
+
     if st.button("SQL 분할 실행"):
         sql_items = st.session_state.get("preprocess_sql_only", [])
         if not sql_items:
@@ -312,45 +374,23 @@ def run_preprocessing(db_name: str, db_user: str, db_password: str, db_host: str
         success_count = 0
         split_count = 0
         single_file_count = 0
-        split_file_rows: list[dict[str, int | str]] = []
+        split_file_rows: list[dict[str, int | float | str]] = []
         fail_rows: list[dict[str, str]] = []
 
+        split_jobs: list[SplitJob] = []
         for item in sql_items:
             base_name = Path(item["name"]).stem
             target_dir = PARTS_OUT_DIR / base_name
             target_dir.mkdir(parents=True, exist_ok=True)
             sql_text = item["sql_text"]
 
+            if len(sql_text) >= SQL_SPLIT_THRESHOLD:
+                split_jobs.append(SplitJob(name=item["name"], out_dir=str(target_dir), sql_text=sql_text))
+                continue
             try:
-                if len(sql_text) >= SQL_SPLIT_THRESHOLD:
-                    with tempfile.NamedTemporaryFile(mode="w", suffix=".sql", encoding="utf-8", delete=False) as temp_file:
-                        temp_file.write(sql_text)
-                        temp_input_path = temp_file.name
-
-                    try:
-                        split_sql_file(
-                            temp_input_path,
-                            str(target_dir),
-                            dialect="oracle",
-                            max_chars=1000,
-                            min_depth_to_extract=2,
-                        )
-                    finally:
-                        Path(temp_input_path).unlink(missing_ok=True)
-
-                    split_output_count = len(list(target_dir.glob("*.sql")))
-                    split_file_rows.append(
-                        {
-                            "파일명": item["name"],
-                            "글자수": len(sql_text),
-                            "분할파일수": split_output_count,
-                        }
-                    )
-                    split_count += 1
-                else:
-                    single_output_path = target_dir / f"{base_name}.sql"
-                    single_output_path.write_text(sql_text, encoding="utf-8")
-                    single_file_count += 1
+                single_output_path = target_dir / f"{base_name}.sql"
+                single_output_path.write_text(sql_text, encoding="utf-8")
+                single_file_count += 1
                 success_count += 1
             except Exception as exc:  # noqa: BLE001
                 fail_rows.append(
@@ -360,6 +400,50 @@ def run_preprocessing(db_name: str, db_user: str, db_password: str, db_host: str
                     }
                 )
 
+        if split_jobs:
+            # sqlglot 파싱은 CPU를 쓰므로 긴 SQL은 프로세스 풀에서 나눈다.
+            split_options = SplitOptions(
+                dialect="oracle",
+                max_chars=1000,
+                min_depth_to_extract=2,
+                fragments_dir=str(PARTS_FRAGMENTS_DIR),
+                cache_path=PARSE_CACHE_PATH or None,
+            )
+            split_lengths = {job.name: len(job.sql_text) for job in split_jobs}
+            progress_bar = st.progress(0, text="SQL 분할을 준비 중입니다.")
+            for done_count, result in enumerate(
+                run_split_jobs(
+                    split_jobs,
+                    split_options,
+                    workers=SPLIT_WORKERS,
+                    ledger=get_ledger(),
+                    force=not split_changed_only,
+                ),
+                start=1,
+            ):
+                progress_bar.progress(done_count / len(split_jobs), text=f"SQL 분할 중 ({done_count}/{len(split_jobs)})")
+                if not result.ok:
+                    fail_rows.append(
+                        {
+                            "파일명": result.name,
+                            "에러메시지": result.error or "",
+                        }
+                    )
+                    continue
+                split_file_rows.append(
+                    {
+                        "파일명": result.name,
+                        "글자수": split_lengths[result.name],
+                        "분할파일수": result.parts,
+                        "소요시간(초)": round(result.elapsed_s, 3),
+                        "캐시": "Y" if result.cached else "",
+                        "변경없음": "Y" if result.skipped else "",
+                    }
+                )
+                split_count += 1
+                success_count += 1
+            progress_bar.progress(1.0, text="SQL 분할이 완료되었습니다.")
+
         st.success(
             f"SQL 분할 완료: {success_count}건 (분할 저장 {split_count}건 / 단일 파일 저장 {single_file_count}건)"
         )
@@ -482,6 +566,11 @@ def run_conversion(db_name: str, db_user: str, db_password: str, db_host: str |
 
     st.subheader("SQL 변환")
     api_url = st.text_input("API URL", placeholder="http://localhost:8000/generate")
+    st.caption(f"`/generate_batch` URL을 입력하면 {CONVERSION_BATCH_SIZE}건씩 묶어서 호출합니다.")
+    st.caption("`/convert_long` URL을 입력하면 긴 SQL을 파생 테이블 단위로 나눠 동시에 변환한 뒤 합친 결과를 받습니다.")
+    convert_changed_only = st.checkbox(
+        "변경된 SQL만 변환", value=True, key="convert_changed_only", disabled=not PIPELINE_LEDGER_PATH
+    )
     if st.button("SQL 변환 API 호출하기", type="primary"):
         if not api_url:
             st.error("API URL을 입력하세요.")
@@ -498,6 +587,9 @@ def run_conversion(db_name: str, db_user: str, db_password: str, db_host: str |
 
         result_rows: list[dict[str, Any]] = []
         errors: list[str] = []
+        ledger = get_ledger()
+        rows = list(loaded_df.itertuples(index=False))
+        skipped_count = 0
 
         with st.spinner("API 호출 중..."):
             try:
@@ -515,33 +607,74 @@ def run_conversion(db_name: str, db_user: str, db_password: str, db_host: str |
 
             try:
                 with connection.cursor() as cursor:
-                    total_rows = len(loaded_df.index)
+                    if ledger is not None and convert_changed_only:
+                        # 지난번 같은 API로 성공한 뒤 SQL이 바뀌지 않았고, 그때 저장한 결과가
+                        # ais_chg_rslt에 그대로 남아 있는 행(id가 있는 행)은 다시 호출하지 않는다.
+                        stored_texts = fetch_result_texts(
+                            cursor, [str(row.id) for row in rows if getattr(row, "id", None) is not None]
+                        )
+                        changed_rows = []
+                        for row in rows:
+                            row_id = getattr(row, "id", None)
+                            entry = None
+                            if row_id is not None and str(row_id) in stored_texts:
+                                input_hash = conversion_input_hash(api_url, str(row.sql_modified))
+                                entry = ledger.current(STAGE_CONVERT, str(row_id), input_hash, verify_outputs=False)
+                            if entry is not None and entry.output_hash == content_hash(stored_texts[str(row_id)]):
+                                skipped_count += 1
+                            else:
+                                changed_rows.append(row)
+                        rows = changed_rows
+
+                    total_rows = len(rows)
                     progress_bar = st.progress(0, text="API 호출을 준비 중입니다.")
                     status_text = st.empty()
 
-                    for index, row in enumerate(loaded_df.itertuples(index=False), start=1):
-                        status_text.info(f"API 호출 중... ({index}/{total_rows})")
-                        question = str(row.sql_modified)
-                        payload = build_payload(question)
+                    use_batch_api = api_url.rstrip("/").endswith("/generate_batch")
+                    chunk_size = CONVERSION_BATCH_SIZE if use_batch_api else 1
+
+                    for start in range(0, total_rows, chunk_size):
+                        chunk = rows[start:start + chunk_size]
+                        status_text.info(f"API 호출 중... ({start + len(chunk)}/{total_rows})")
+                        questions = [str(row.sql_modified) for row in chunk]
                         try:
-                            response_text = fetch_response_text(api_url, payload)
+                            if use_batch_api:
+                                responses = fetch_batch_response_texts(api_url, build_batch_payload(questions))
+                            else:
+                                responses = [(fetch_response_text(api_url, build_payload(questions[0])), None)]
                         except requests.RequestException as exc:
-                            errors.append(f"API 호출 실패 (row {index}): {exc}")
+                            errors.append(f"API 호출 실패 (row {start + 1}-{start + len(chunk)}): {exc}")
                             continue
-                        result_row = {
-                            "src_obj_id": getattr(row, "id", None),
-                            "question": question,
-                            "response": response_text,
-                        }
-                        upsert_result_row(cursor, result_row)
-                        result_rows.append(result_row)
-                        progress_bar.progress(index / total_rows)
+                        for offset, (row, question, (response_text, error)) in enumerate(
+                            zip(chunk, questions, responses), start=start + 1
+                        ):
+                            if error:
+                                errors.append(f"API 호출 실패 (row {offset}): {error}")
+                                continue
+                            result_row = {
+                                "src_obj_id": getattr(row, "id", None),
+                                "question": question,
+                                "response": response_text,
+                            }
+                            upsert_result_row(cursor, result_row)
+                            result_rows.append(result_row)
+                            # 재시도 끝에 빈 응답이면 실패로 보고 기록하지 않는다(다음 실행에서 다시 변환).
+                            if ledger is not None and result_row["src_obj_id"] is not None and response_text.strip():
+                                ledger.record(
+                                    STAGE_CONVERT,
+                                    str(result_row["src_obj_id"]),
+                                    conversion_input_hash(api_url, question),
+                                    output_hash=content_hash(response_text),
+                                )
+                        progress_bar.progress((start + len(chunk)) / total_rows)
 
                     progress_bar.progress(1.0, text="API 호출이 완료되었습니다.")
                     status_text.empty()
             finally:
                 connection.close()
 
+        if skipped_count:
+            st.info(f"변경 없는 SQL {skipped_count}건은 다시 변환하지 않았습니다.")
         if errors:
             st.warning("일부 요청이 실패했습니다.")
             for error in errors:
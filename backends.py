@@ -0,0 +1,313 @@
+from __future__ import annotations
+
+import re
+import threading
+import time
+from typing import Callable, Protocol
+
+from generation import GenerationConfig, GenerationOutput
+from postprocess import StatementScanner, truncate_at_stop_strings
+
+# 가짜 토큰: 앞 공백을 포함한 단어 하나 또는 기호 하나. 이어 붙이면 원문이 그대로 복원된다.
+RE_FAKE_TOKEN = re.compile(r"\s*(?:\w+|\S)|\s+")
+
+# FakeBackend.convert_and_verify가 돌려주는 검증 결과
+FAKE_VERDICT_OK = '{"result": "0", "reason": ""}'
+FAKE_VERDICT_EMPTY = '{"result": "1", "reason": "변환 결과가 비어 있습니다."}'
+
+# FakeBackend(mode="transform")가 적용하는 간단한 Oracle -> PostgreSQL 치환
+FAKE_TRANSFORM_RULES = (
+    (re.compile(r"\bNVL\s*\(", re.IGNORECASE), "COALESCE("),
+    (re.compile(r"\bSYSDATE\b", re.IGNORECASE), "CURRENT_TIMESTAMP"),
+    (re.compile(r"\s+FROM\s+DUAL\b", re.IGNORECASE), ""),
+    (re.compile(r"\bVARCHAR2\b", re.IGNORECASE), "VARCHAR"),
+    (re.compile(r"\bNUMBER\b", re.IGNORECASE), "NUMERIC"),
+)
+
+
+class InferenceBackend(Protocol):
+    """api.py와 GenerationBatcher가 사용하는 생성 백엔드 인터페이스."""
+
+    model_name: str
+    load_timings: dict[str, float]
+
+    def count_tokens(self, config: GenerationConfig) -> int: ...
+
+    def count_text_tokens(self, text: str) -> int: ...
+
+    def token_budget(self, question: str, config: GenerationConfig) -> int: ...
+
+    def generate(self, question: str, config: GenerationConfig | None = None) -> str: ...
+
+    def generate_batch(
+        self,
+        questions: list[str],
+        configs: list[GenerationConfig],
+        on_text: Callable[[str], None] | None = None,
+        stop_events: list[threading.Event | None] | None = None,
+    ) -> list[GenerationOutput]: ...
+
+    def convert_and_verify(
+        self,
+        question: str,
+        convert_config: GenerationConfig,
+        verify_config: GenerationConfig,
+        stop_event: threading.Event | None = None,
+    ) -> tuple[GenerationOutput, GenerationOutput]: ...
+
+
+class TokenCounter(Protocol):
+    """모델 없이 토크나이저만으로 하는 토큰 계산(ReplicaPool이 부모 프로세스에서 쓴다)."""
+
+    def count_tokens(self, config: GenerationConfig) -> int: ...
+
+    def count_text_tokens(self, text: str) -> int: ...
+
+    def token_budget(self, question: str, config: GenerationConfig) -> int: ...
+
+
+BackendFactory = Callable[..., InferenceBackend]
+_BACKENDS: dict[str, BackendFactory] = {}
+TokenCounterFactory = Callable[..., TokenCounter]
+_TOKEN_COUNTERS: dict[str, TokenCounterFactory] = {}
+
+
+def register_backend(name: str) -> Callable[[BackendFactory], BackendFactory]:
+    def decorator(factory: BackendFactory) -> BackendFactory:
+        _BACKENDS[name] = factory
+        return factory
+
+    return decorator
+
+
+def available_backends() -> list[str]:
+    return sorted(_BACKENDS)
+
+
+def create_backend(name: str, **options) -> InferenceBackend:
+    factory = _BACKENDS.get(name)
+    if factory is None:
+        raise ValueError(f"unknown backend: {name} (available: {', '.join(available_backends())})")
+    return factory(**options)
+
+
+def register_token_counter(name: str) -> Callable[[TokenCounterFactory], TokenCounterFactory]:
+    def decorator(factory: TokenCounterFactory) -> TokenCounterFactory:
+        _TOKEN_COUNTERS[name] = factory
+        return factory
+
+    return decorator
+
+
+def create_token_counter(name: str, **options) -> TokenCounter | None:
+    """백엔드와 같은 토큰 수를 내는 토크나이저만 불러온다. 등록된 것이 없는 백엔드면 None."""
+    factory = _TOKEN_COUNTERS.get(name)
+    return factory(**options) if factory is not None else None
+
+
+@register_backend("hf")
+def _create_hf_backend(model_name: str, draft_model_name: str | None = None, **options) -> InferenceBackend:
+    """GPU용 transformers 백엔드. torch는 이 백엔드를 고를 때만 import한다."""
+    from qwencoder import QwenSqlEncoder
+
+    return QwenSqlEncoder(model_name, draft_model_name=draft_model_name, **options)
+
+
+@register_backend("tiny")
+def _create_tiny_backend(model_name: str, draft_model_name: str | None = None, **options) -> InferenceBackend:
+    """작은 모델을 CPU float32로 올린다. GPU 없이 실제 토크나이저/generate 경로를 확인할 때 쓴다."""
+    import torch
+
+    from qwencoder import QwenSqlEncoder
+
+    return QwenSqlEncoder(
+        model_name,
+        draft_model_name=draft_model_name,
+        dtype=torch.float32,
+        device_map="cpu",
+        **options,
+    )
+
+
+@register_backend("fake")
+def _create_fake_backend(model_name: str = "fake", draft_model_name: str | None = None, **options) -> InferenceBackend:
+    return FakeBackend(**options)
+
+
+@register_token_counter("hf")
+@register_token_counter("tiny")
+def _create_chat_token_counter(model_name: str, draft_model_name: str | None = None, **options) -> TokenCounter:
+    return ChatTokenCounter(model_name)
+
+
+@register_token_counter("fake")
+def _create_fake_token_counter(model_name: str = "fake", draft_model_name: str | None = None, **options) -> TokenCounter:
+    return FakeBackend(**options)
+
+
+class ChatTokenCounter:
+    """
+    모델 디렉터리의 토크나이저만 불러와 QwenSqlEncoder와 같은 방식(채팅 템플릿 적용, 특수 토큰 없이)으로 센다.
+    transformers는 이때만 불러오고 torch나 모델 가중치는 올리지 않는다.
+    """
+
+    def __init__(self, model_name: str) -> None:
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # fast tokenizer는 여러 스레드에서 동시에 인코딩하지 않는다.
+        self._lock = threading.Lock()
+
+    def count_tokens(self, config: GenerationConfig) -> int:
+        message = [
+            {"role": "system", "content": config.system_prompt},
+            {"role": "user", "content": config.user_prompt},
+        ]
+        text = self.tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
+        return self.count_text_tokens(text)
+
+    def count_text_tokens(self, text: str) -> int:
+        with self._lock:
+            return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def token_budget(self, question: str, config: GenerationConfig) -> int:
+        if config.output_budget_ratio is None:
+            return config.max_new_tokens
+        return config.token_budget(self.count_text_tokens(question))
+
+
+def fake_tokenize(text: str) -> list[str]:
+    return RE_FAKE_TOKEN.findall(text)
+
+
+def fake_transform(text: str) -> str:
+    for pattern, replacement in FAKE_TRANSFORM_RULES:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class FakeBackend:
+    """
+    모델 없이 입력 SQL을 그대로(echo) 또는 간단히 치환해(transform) 돌려주는 결정적 백엔드.
+    호출마다 latency_ms를 기다린 뒤 tokens_per_second 속도로 토큰을 내보내므로,
+    GPU 없이 배칭/캐시/스트리밍 등 모델 바깥 경로의 처리량을 잴 수 있다.
+    배치 한 번의 디코드 시간은 가장 긴 행 기준이다(실제 배치 generate와 같은 모양).
+    """
+
+    def __init__(self, mode: str = "echo", latency_ms: float = 0.0, tokens_per_second: float = 0.0) -> None:
+        if mode not in ("echo", "transform"):
+            raise ValueError(f"unknown fake backend mode: {mode}")
+        self.mode = mode
+        self.latency = latency_ms / 1000.0
+        self.tokens_per_second = tokens_per_second
+        self.model_name = f"fake:{mode}"
+        self.load_timings: dict[str, float] = {}
+
+    def count_text_tokens(self, text: str) -> int:
+        return len(fake_tokenize(text))
+
+    def count_tokens(self, config: GenerationConfig) -> int:
+        return self.count_text_tokens(config.system_prompt or "") + self.count_text_tokens(config.user_prompt or "")
+
+    def token_budget(self, question: str, config: GenerationConfig) -> int:
+        if config.output_budget_ratio is None:
+            return config.max_new_tokens
+        return config.token_budget(self.count_text_tokens(question))
+
+    def generate(self, question: str, config: GenerationConfig | None = None) -> str:
+        if config is None:
+            config = GenerationConfig()
+        return self.generate_batch([question], [config])[0].text
+
+    def _respond(self, question: str, config: GenerationConfig) -> list[str]:
+        """행 하나의 출력 토큰. 예산, 문장 수, stop_strings를 실제 백엔드와 같은 순서로 적용한다."""
+        text = fake_transform(question) if self.mode == "transform" else question
+        tokens = fake_tokenize(text)[: self.token_budget(question, config)]
+        if config.expected_statements:
+            scanner = StatementScanner()
+            for index, token in enumerate(tokens):
+                scanner.feed(token)
+                if scanner.terminators >= config.expected_statements:
+                    tokens = tokens[: index + 1]
+                    break
+        if config.stop_strings:
+            tokens = fake_tokenize(truncate_at_stop_strings("".join(tokens), config.stop_strings))
+        return tokens
+
+    def generate_batch(
+        self,
+        questions: list[str],
+        configs: list[GenerationConfig],
+        on_text: Callable[[str], None] | None = None,
+        stop_events: list[threading.Event | None] | None = None,
+    ) -> list[GenerationOutput]:
+        if len(questions) != len(configs):
+            raise ValueError("questions and configs must have the same length")
+        if not configs:
+            return []
+        head = configs[0]
+        if any(config.batch_key() != head.batch_key() for config in configs):
+            raise ValueError("configs in one batch must share the same batch_key()")
+        if on_text is not None and len(configs) != 1:
+            raise ValueError("streaming is only supported for a single request")
+        if not head.batchable and len(configs) != 1:
+            raise ValueError(f"{head.decode_mode} decoding is only supported for a single request")
+        if stop_events is None:
+            stop_events = [None] * len(configs)
+
+        tokenize_started = time.perf_counter()
+        rows = [self._respond(question, config) for question, config in zip(questions, configs)]
+        lengths = [len(tokens) for tokens in rows]
+        prefill_started = time.perf_counter()
+        if self.latency > 0:
+            time.sleep(self.latency)
+        decode_started = time.perf_counter()
+        step_time = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        for step in range(max(lengths)):
+            for row, event in enumerate(stop_events):
+                if event is not None and event.is_set() and lengths[row] > step:
+                    lengths[row] = step
+            if all(length <= step for length in lengths):
+                break
+            if step_time:
+                time.sleep(step_time)
+            if on_text is not None and lengths[0] > step:
+                on_text(rows[0][step])
+
+        timings = {
+            "tokenize_s": prefill_started - tokenize_started,
+            "prefill_s": decode_started - prefill_started,
+            "decode_s": time.perf_counter() - decode_started,
+        }
+        outputs = []
+        for question, config, tokens, length in zip(questions, configs, rows, lengths):
+            stats = {
+                "decode_mode": head.decode_mode,
+                "batch_size": len(configs),
+                "token_budget": self.token_budget(question, config),
+                "backend": self.model_name,
+                **timings,
+            }
+            outputs.append(
+                GenerationOutput(
+                    text="".join(tokens[:length]),
+                    input_tokens=self.count_tokens(config),
+                    output_tokens=length,
+                    stats=stats,
+                )
+            )
+        return outputs
+
+    def convert_and_verify(
+        self,
+        question: str,
+        convert_config: GenerationConfig,
+        verify_config: GenerationConfig,
+        stop_event: threading.Event | None = None,
+    ) -> tuple[GenerationOutput, GenerationOutput]:
+        """변환 결과가 비어 있지 않으면 통과 판정을 돌려준다. 검증 턴도 같은 지연/속도로 흉내 낸다."""
+        (conversion,) = self.generate_batch([question], [convert_config], stop_events=[stop_event])
+        verdict_text = FAKE_VERDICT_OK if conversion.text.strip() else FAKE_VERDICT_EMPTY
+        (verdict,) = self.generate_batch([verdict_text], [verify_config], stop_events=[stop_event])
+        verdict.stats["reused_prefix_tokens"] = conversion.input_tokens + conversion.output_tokens
+        return conversion, verdict
@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable
+
+import metrics
+from backends import InferenceBackend
+from generation import GenerationConfig, GenerationOutput
+
+# 우선순위 레인(앞쪽이 먼저 처리됨). UI의 단건 호출이 대량 배치 실행 뒤에 밀리지 않게 한다.
+PRIORITIES = ("interactive", "bulk")
+
+
+class QueueFullError(RuntimeError):
+    """해당 우선순위 레인의 대기열이 가득 차서 요청을 받을 수 없음."""
+
+    def __init__(self, priority: str, depth: int) -> None:
+        super().__init__(f"{priority} queue is full ({depth} pending)")
+        self.priority = priority
+        self.depth = depth
+
+
+class RequestCancelledError(RuntimeError):
+    """실행 중인 요청이 취소(deadline 초과, 클라이언트 연결 끊김)되어 중간에 멈춤."""
+
+    def __init__(self) -> None:
+        super().__init__("request was cancelled during generation")
+
+
+@dataclass
+class _Job:
+    question: str
+    config: GenerationConfig
+    priority: str = PRIORITIES[0]
+    on_text: Callable[[str], None] | None = None
+    cancel: threading.Event | None = None
+    group: int | None = None
+    # 설정하면 변환 후 같은 대화로 검증까지 실행한다(convert_and_verify). 결과는 (변환, 검증) 튜플.
+    verify_config: GenerationConfig | None = None
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def solo(self) -> bool:
+        """스트리밍 요청, 배치를 지원하지 않는 디코딩 모드, 변환+검증 요청은 단독 배치로 실행한다."""
+        return self.on_text is not None or not self.config.batchable or self.verify_config is not None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel is not None and self.cancel.is_set()
+
+
+class GenerationBatcher:
+    """
+    동시에 들어온 생성 요청을 짧은 시간(max_wait_ms) 동안 모으거나 max_batch_size에 도달하면
+    InferenceBackend.generate_batch 한 번으로 처리하고, 요청별 결과를 각 Future에 돌려준다.
+    GenerationConfig.batch_key()가 다른 요청은 서로 다른 배치로 나뉜다.
+    스트리밍 요청(on_text)과 batchable이 아닌 설정(prompt lookup 등)은 항상 단독 배치로 실행된다.
+
+    요청은 PRIORITIES 순서의 레인에 쌓이며 배치는 항상 가장 높은 우선순위 레인의 맨 앞 요청부터 만든다.
+    남는 자리는 batch_key가 같은 낮은 우선순위 요청으로 채운다.
+    레인별 대기 요청 수가 max_queue_size에 도달하면 submit이 QueueFullError를 던진다.
+
+    workers가 2 이상이면 그 수만큼의 스레드가 동시에 배치를 꺼내 실행한다.
+    동시 호출을 처리할 수 있는 백엔드(ReplicaPool)에서만 사용한다.
+    """
+
+    def __init__(
+        self,
+        encoder: InferenceBackend,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        max_queue_size: int = 256,
+        workers: int = 1,
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be >= 1")
+        if max_queue_size < 1:
+            raise ValueError("max_queue_size must be >= 1")
+        if workers < 1:
+            raise ValueError("workers must be >= 1")
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        self._lanes: dict[str, deque[_Job]] = {priority: deque() for priority in PRIORITIES}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._group_ids = itertools.count()
+        self._workers = [
+            threading.Thread(target=self._run, name=f"generation-batcher-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(
+        self,
+        question: str,
+        config: GenerationConfig,
+        priority: str = PRIORITIES[0],
+        on_text: Callable[[str], None] | None = None,
+        cancel: threading.Event | None = None,
+    ) -> Future:
+        """
+        on_text를 주면 디코딩된 텍스트 조각을 차례로 전달한다.
+        cancel이 set되면 대기 중인 요청은 실행하지 않고, 실행 중이면 다음 디코드 스텝에서 멈춘 뒤
+        Future에 RequestCancelledError를 넣는다. 대기 중에 Future.cancel()을 부르면 대기열에서 바로 빠진다.
+        """
+        job = _Job(question=question, config=config, priority=priority, on_text=on_text, cancel=cancel)
+        return self._enqueue(job)
+
+    def submit_convert_verify(
+        self,
+        question: str,
+        convert_config: GenerationConfig,
+        verify_config: GenerationConfig,
+        priority: str = PRIORITIES[0],
+        cancel: threading.Event | None = None,
+    ) -> Future:
+        """변환과 이어지는 검증을 한 잡으로 넣는다. Future의 결과는 (변환, 검증) GenerationOutput 튜플."""
+        job = _Job(
+            question=question,
+            config=convert_config,
+            priority=priority,
+            cancel=cancel,
+            verify_config=verify_config,
+        )
+        return self._enqueue(job)
+
+    def _enqueue(self, job: _Job) -> Future:
+        priority = job.priority
+        if priority not in self._lanes:
+            raise ValueError(f"unknown priority: {priority}")
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("batcher is closed")
+            lane = self._lanes[priority]
+            if len(lane) >= self.max_queue_size:
+                raise QueueFullError(priority, len(lane))
+            lane.append(job)
+            self._cond.notify()
+        job.future.add_done_callback(self._discard)
+        return job.future
+
+    def submit_group(
+        self,
+        questions: list[str],
+        configs: list[GenerationConfig],
+        priority: str = PRIORITIES[0],
+        cancels: list[threading.Event | None] | None = None,
+    ) -> list[Future]:
+        """
+        호출자가 미리 구성한 배치(예: 토큰 길이 버킷)를 한 번에 넣는다.
+        그룹은 다른 요청과 섞이지 않고 그대로 하나의 generate_batch 호출로 실행된다.
+        cancels는 항목별 취소 Event(submit의 cancel과 같음)다.
+        """
+        if priority not in self._lanes:
+            raise ValueError(f"unknown priority: {priority}")
+        if not 1 <= len(configs) <= self.max_batch_size or len(questions) != len(configs):
+            raise ValueError("group size must be between 1 and max_batch_size")
+        if any(config.batch_key() != configs[0].batch_key() for config in configs):
+            raise ValueError("configs in one group must share the same batch_key()")
+        if len(configs) > 1 and not configs[0].batchable:
+            raise ValueError(f"{configs[0].decode_mode} decoding cannot be grouped")
+        if cancels is None:
+            cancels = [None] * len(configs)
+        elif len(cancels) != len(configs):
+            raise ValueError("cancels must have the same length as configs")
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("batcher is closed")
+            group = next(self._group_ids)
+            jobs = [
+                _Job(question=question, config=config, priority=priority, cancel=cancel, group=group)
+                for question, config, cancel in zip(questions, configs, cancels)
+            ]
+            lane = self._lanes[priority]
+            if len(lane) + len(jobs) > self.max_queue_size:
+                raise QueueFullError(priority, len(lane))
+            lane.extend(jobs)
+            self._cond.notify()
+        for job in jobs:
+            job.future.add_done_callback(self._discard)
+        return [job.future for job in jobs]
+
+    def generate(self, question: str, config: GenerationConfig, priority: str = PRIORITIES[0]) -> str:
+        return self.submit(question, config, priority=priority).result().text
+
+    def queue_depth(self, priority: str | None = None) -> int:
+        with self._cond:
+            if priority is not None:
+                return len(self._lanes[priority])
+            return sum(len(lane) for lane in self._lanes.values())
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _discard(self, future: Future) -> None:
+        """대기 중에 취소된 Future의 잡을 레인에서 뺀다."""
+        if not future.cancelled():
+            return
+        with self._cond:
+            for priority, lane in self._lanes.items():
+                if any(job.future is future for job in lane):
+                    self._lanes[priority] = deque(job for job in lane if job.future is not future)
+                    return
+
+    def _head(self) -> _Job | None:
+        for lane in self._lanes.values():
+            if lane:
+                return lane[0]
+        return None
+
+    def _take_batch(self) -> list[_Job]:
+        """
+        가장 높은 우선순위 레인의 맨 앞 요청과 batch_key가 같은 요청을
+        우선순위, 도착 순서대로 최대 max_batch_size개 꺼낸다.
+        """
+        head = self._head()
+        if head.solo:
+            return [self._lanes[head.priority].popleft()]
+        if head.group is not None:
+            # submit_group으로 들어온 잡은 레인 안에서 연속으로 놓여 있다.
+            lane = self._lanes[head.priority]
+            batch = []
+            while lane and lane[0].group == head.group:
+                batch.append(lane.popleft())
+            return batch
+        key = head.config.batch_key()
+        batch: list[_Job] = []
+        for priority, lane in self._lanes.items():
+            remaining: deque[_Job] = deque()
+            while lane:
+                job = lane.popleft()
+                if (
+                    len(batch) < self.max_batch_size
+                    and not job.solo
+                    and job.group is None
+                    and job.config.batch_key() == key
+                ):
+                    batch.append(job)
+                else:
+                    remaining.append(job)
+            self._lanes[priority] = remaining
+        return batch
+
+    def _count_ready(self) -> int:
+        head = self._head()
+        if head.solo or head.group is not None:
+            return self.max_batch_size
+        key = head.config.batch_key()
+        return sum(
+            1
+            for lane in self._lanes.values()
+            for job in lane
+            if not job.solo and job.group is None and job.config.batch_key() == key
+        )
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._head() is None and not self._closed:
+                    self._cond.wait()
+                if self._head() is None and self._closed:
+                    return
+                # 첫 요청 도착 후 max_wait 동안 같은 배치에 들어갈 요청을 더 기다린다.
+                deadline = self._head().enqueued_at + self.max_wait
+                while not self._closed and self._head() is not None and self._count_ready() < self.max_batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._head() is None:
+                    # 다른 워커 스레드가 먼저 꺼내 갔다.
+                    continue
+                batch = self._take_batch()
+
+            for job in batch:
+                if job.cancelled:
+                    job.future.cancel()
+            batch = [job for job in batch if job.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.monotonic()
+            for job in batch:
+                metrics.QUEUE_WAIT_SECONDS.observe(started - job.enqueued_at, priority=job.priority)
+            try:
+                outputs = self._execute(batch)
+            except Exception as exc:  # noqa: BLE001
+                metrics.GENERATION_ERRORS.inc()
+                for job in batch:
+                    job.future.set_exception(exc)
+                continue
+            for job, output in zip(batch, outputs):
+                if job.cancelled:
+                    # 중간에 멈춘 출력은 잘린 결과이므로 돌려주지(캐시하지) 않는다.
+                    job.future.set_exception(RequestCancelledError())
+                else:
+                    job.future.set_result(output)
+
+    def _execute(self, batch: list[_Job]) -> list:
+        head = batch[0]
+        if head.verify_config is not None:
+            conversion, verdict = self.encoder.convert_and_verify(
+                head.question, head.config, head.verify_config, stop_event=head.cancel
+            )
+            metrics.observe_batch([conversion])
+            metrics.observe_batch([verdict])
+            return [(conversion, verdict)]
+        outputs = self.encoder.generate_batch(
+            [job.question for job in batch],
+            [job.config for job in batch],
+            on_text=head.on_text,
+            stop_events=[job.cancel for job in batch],
+        )
+        metrics.observe_batch(outputs)
+        return outputs
@@ -0,0 +1,140 @@
+import argparse
+import random
+import re
+import time
+import uuid
+from typing import Dict, Tuple
+
+from parse_sql import (
+    RE_CDATA_CLOSE,
+    RE_CDATA_OPEN,
+    RE_HASH_VAR,
+    RE_MYBATIS_BIND,
+    RE_MYBATIS_DOLLAR,
+    RE_MYBATIS_XML_TAG,
+    UNICODE_OPS,
+    mask_placeholders,
+    unmask_placeholders,
+)
+
+
+def make_statement(rng: random.Random, index: int) -> str:
+    conditions = []
+    for i in range(rng.randint(4, 16)):
+        column = f"T.COL_{rng.randint(0, 300)}"
+        choice = rng.random()
+        if choice < 0.5:
+            conditions.append(f"AND {column} = #{{param{i}, jdbcType=VARCHAR}}")
+        elif choice < 0.65:
+            conditions.append(f"AND {column} ≥ #{{from{i}}}")
+        elif choice < 0.75:
+            conditions.append(f"AND {column} ≠ #CODE{i}#")
+        elif choice < 0.85:
+            conditions.append(f"<if test=\"p{i} != null\">AND {column} ≤ #{{p{i}}}</if>")
+        else:
+            conditions.append(f"AND {column} IN (${{list{i}}})")
+    body = "\n    ".join(conditions)
+    return (
+        f"-- statement {index}\n"
+        f"SELECT T.ID, T.NAME, NVL(T.AMT, 0) AS AMT\n"
+        f"  FROM TB_SAMPLE_{index % 97} T\n"
+        f" WHERE 1 = 1\n    {body}\n"
+        f"<![CDATA[ AND T.REG_DT <= SYSDATE ]]>;\n"
+    )
+
+
+def make_dump(size_mb: float, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    statements = []
+    total = 0
+    while total < size_mb * 1024 * 1024:
+        statement = make_statement(rng, len(statements))
+        statements.append(statement)
+        total += len(statement.encode("utf-8"))
+    return statements
+
+
+def legacy_mask_placeholders(sql: str) -> Tuple[str, Dict[str, str]]:
+    """비교용: 패턴 종류별로 텍스트를 다시 훑고, 유니코드 연산자는 한 개씩 replace하던 이전 방식."""
+    run_id = uuid.uuid4().hex
+    mapping: Dict[str, str] = {}
+    counter = 0
+
+    def marker(prefix: str) -> str:
+        nonlocal counter
+        value = f"/*__{prefix}__{run_id}__{counter}__*/"
+        counter += 1
+        return value
+
+    def comment_repl(prefix: str):
+        def repl(m: re.Match) -> str:
+            value = marker(prefix)
+            mapping[value] = m.group(0)
+            return value
+
+        return repl
+
+    masked = RE_MYBATIS_XML_TAG.sub(comment_repl("MBTAG"), sql)
+    masked = RE_CDATA_OPEN.sub(comment_repl("CDATA_OPEN"), masked)
+    masked = RE_CDATA_CLOSE.sub(comment_repl("CDATA_CLOSE"), masked)
+    for uop, ascii_op in UNICODE_OPS.items():
+        while uop in masked:
+            replacement = f"{ascii_op}{marker('UOP')}"
+            mapping[replacement] = uop
+            masked = masked.replace(uop, replacement, 1)
+
+    def string_repl(m: re.Match) -> str:
+        nonlocal counter
+        value = f"'__PH__{run_id}__{counter}__'"
+        counter += 1
+        mapping[value] = m.group(0)
+        return value
+
+    for pattern in (RE_MYBATIS_BIND, RE_MYBATIS_DOLLAR, RE_HASH_VAR):
+        masked = pattern.sub(string_repl, masked)
+    return masked, mapping
+
+
+def legacy_unmask_placeholders(sql: str, mapping: Dict[str, str]) -> str:
+    for replacement in sorted(mapping.keys(), key=len, reverse=True):
+        sql = sql.replace(replacement, mapping[replacement])
+    return sql
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def run(label: str, mask, unmask, text: str, per_statement_limit: int) -> None:
+    (masked, mapping), mask_s = timed(mask, text)
+    restored, unmask_s = timed(unmask, masked, mapping)
+    assert restored == text, f"{label}: round trip mismatch"
+    pieces = masked.split(";\n")[:per_statement_limit]
+    _, pieces_s = timed(lambda: [unmask(piece, mapping) for piece in pieces])
+    mb = len(text.encode("utf-8")) / 1024 / 1024
+    print(
+        f"{label:>7}: mask {mask_s * 1000:9.1f} ms ({mb / mask_s:7.1f} MB/s) | "
+        f"unmask {unmask_s * 1000:9.1f} ms | "
+        f"unmask x{len(pieces)} statements {pieces_s * 1000:9.1f} ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="MyBatis mapper 덤프를 흉내 낸 입력으로 마스킹/원복 시간을 잰다")
+    parser.add_argument("--size_mb", type=float, default=4.0)
+    parser.add_argument("--statements", type=int, default=200, help="문장별 원복을 잴 문장 수")
+    parser.add_argument("--compare", action="store_true", help="이전 방식도 함께 잰다(입력이 크면 매우 느리다)")
+    args = parser.parse_args()
+
+    text = "".join(make_dump(args.size_mb))
+    _, mapping = mask_placeholders(text)
+    print(f"input: {len(text.encode('utf-8')) / 1024 / 1024:.2f} MB, {len(mapping)} placeholders")
+    run("current", mask_placeholders, unmask_placeholders, text, args.statements)
+    if args.compare:
+        run("legacy", legacy_mask_placeholders, legacy_unmask_placeholders, text, args.statements)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import time
+
+from sqlglot import expressions as exp
+
+from parse_sql import split_sql_text
+
+
+def make_statement(depth: int, width: int) -> str:
+    sql = "SELECT A.ID, A.V FROM TB_BASE A WHERE A.ID = #{id}"
+    for d in range(depth):
+        joins = " ".join(
+            f"JOIN (SELECT B{d}_{w}.ID, SUM(B{d}_{w}.AMT) AS S FROM TB_X{w} B{d}_{w} "
+            f"WHERE B{d}_{w}.K = #{{k{d}_{w}}} GROUP BY B{d}_{w}.ID) J{d}_{w} ON J{d}_{w}.ID = T{d}.ID"
+            for w in range(width)
+        )
+        sql = f"SELECT T{d}.ID, T{d}.V FROM ({sql}) T{d} {joins}".rstrip()
+    return sql + ";"
+
+
+class SqlCallCounter:
+    """Expression.sql 호출 횟수를 센다(측정용)."""
+
+    def __init__(self):
+        self.count = 0
+        self._original = exp.Expression.sql
+
+    def __enter__(self):
+        original = self._original
+
+        def counted(node, *args, **kwargs):
+            self.count += 1
+            return original(node, *args, **kwargs)
+
+        exp.Expression.sql = counted
+        return self
+
+    def __exit__(self, *exc):
+        exp.Expression.sql = self._original
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="중첩 파생 테이블 문장을 만들어 split_sql_text 시간과 직렬화 횟수를 잰다")
+    parser.add_argument("--depths", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--width", type=int, default=3, help="단계마다 JOIN하는 서브쿼리 수(0이면 서브쿼리만 한 줄로 깊게 중첩)")
+    parser.add_argument("--max_chars", type=int, nargs="+", default=[400, 4000])
+    parser.add_argument("--min_depth", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for depth in args.depths:
+        sql = make_statement(depth, args.width)
+        for max_chars in args.max_chars:
+            best = float("inf")
+            for _ in range(args.repeat):
+                with SqlCallCounter() as counter:
+                    started = time.perf_counter()
+                    parts = split_sql_text(sql, max_chars=max_chars, min_depth_to_extract=args.min_depth)
+                    best = min(best, time.perf_counter() - started)
+            part = parts[0]
+            print(
+                f"depth {depth:4d} width {args.width} ({len(sql):8d} chars) max_chars {max_chars:6d}: "
+                f"{best * 1000:9.1f} ms | {len(part.ctes):4d} ctes | "
+                f"{counter.count:5d} serializations | oversized {len(part.meta.get('oversized', []))}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import asdict, dataclass
+from typing import Callable
+
+import metrics
+from generation import GenerationConfig, GenerationOutput
+
+# 작은따옴표 문자열 리터럴('' 이스케이프 포함)과 그 밖의 공백 덩어리
+RE_SQL_LITERAL_OR_SPACE = re.compile(r"'(?:[^']|'')*'|\s+")
+
+
+def normalize_sql_text(text: str) -> str:
+    """
+    문자열 리터럴 밖의 공백만 한 칸으로 줄이고 끝의 세미콜론을 떼어,
+    들여쓰기/줄바꿈만 다른 같은 SQL이 같은 키를 갖게 한다.
+    """
+    if not text:
+        return ""
+
+    def repl(m: re.Match) -> str:
+        token = m.group(0)
+        return token if token.startswith("'") else " "
+
+    return RE_SQL_LITERAL_OR_SPACE.sub(repl, text).strip().rstrip(";").strip()
+
+
+def make_cache_key(namespace: str, question: str, config: GenerationConfig) -> str:
+    """정규화한 SQL + 프롬프트 + 생성 설정의 sha256."""
+    payload = {
+        "namespace": namespace,
+        "question": normalize_sql_text(question),
+        "system_prompt": normalize_sql_text(config.system_prompt or ""),
+        "user_prompt": normalize_sql_text(config.user_prompt or ""),
+        "max_new_tokens": config.max_new_tokens,
+        "temperature": config.temperature,
+        "top_p": config.top_p,
+        "do_sample": config.do_sample,
+        "stop_strings": list(config.stop_strings),
+        "expected_statements": config.expected_statements,
+        "output_budget_ratio": config.output_budget_ratio,
+        "output_budget_margin": config.output_budget_margin,
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _forward(source: Future, target: Future) -> None:
+    """source가 끝나면 그 결과를 target에 넣는다(target이 이미 취소됐으면 버린다)."""
+
+    def copy_result(done: Future) -> None:
+        if not target.set_running_or_notify_cancel():
+            return
+        if done.cancelled():
+            target.set_exception(RuntimeError("generation was cancelled"))
+        elif done.exception() is not None:
+            target.set_exception(done.exception())
+        else:
+            target.set_result(done.result())
+
+    source.add_done_callback(copy_result)
+
+
+def _chain(source: Future) -> Future:
+    """source의 결과를 따라가는 새 Future. 한 호출자가 취소해도 공유 중인 생성은 취소되지 않는다."""
+    target: Future = Future()
+    _forward(source, target)
+    return target
+
+
+@dataclass
+class Reservation:
+    """reserve 결과. source가 있으면(캐시 미스) 호출자가 생성을 제출해 attach하거나 fail로 끝내야 한다."""
+
+    future: Future  # 호출자가 기다릴 Future(적중이면 이미 끝나 있다)
+    source: Future | None = None  # 실행 중으로 먼저 등록한 자리
+    cancel: threading.Event | None = None  # 제출할 생성에 넘길 취소 Event
+
+
+@dataclass
+class _Inflight:
+    """실행 중인 공유 생성. 기다리는 쪽이 모두 떠나면 cancel을 set하고 대기열에서 뺀다."""
+
+    future: Future
+    cancel: threading.Event | None = None
+    waiters: int = 0
+
+    @property
+    def abandoned(self) -> bool:
+        return self.future.cancelled() or (self.cancel is not None and self.cancel.is_set())
+
+
+class ConversionCache:
+    """
+    변환 결과 캐시. 메모리 LRU 계층 아래에 SQLite 파일 계층을 두고,
+    같은 키로 이미 실행 중인 생성이 있으면 새로 제출하지 않고 그 결과를 함께 기다린다.
+    """
+
+    def __init__(self, path: str | None = None, memory_size: int = 4096, namespace: str = "") -> None:
+        self.namespace = namespace
+        self.memory_size = memory_size
+        self._memory: OrderedDict[str, GenerationOutput] = OrderedDict()
+        self._inflight: dict[str, _Inflight] = {}
+        # 이미 끝난 Future에 콜백을 걸면 같은 스레드에서 바로 _on_done이 불리므로 재진입 가능한 락을 쓴다.
+        self._lock = threading.RLock()
+        self._db: sqlite3.Connection | None = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS conversions (
+                    key TEXT PRIMARY KEY,
+                    output TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self._db.commit()
+
+    def key(self, question: str, config: GenerationConfig) -> str:
+        return make_cache_key(self.namespace, question, config)
+
+    def lookup(self, key: str) -> GenerationOutput | None:
+        with self._lock:
+            return self._lookup_locked(key)
+
+    def _lookup_locked(self, key: str) -> GenerationOutput | None:
+        output = self._memory.get(key)
+        if output is not None:
+            self._memory.move_to_end(key)
+            return output
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT output FROM conversions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        output = GenerationOutput(**json.loads(row[0]))
+        self._remember_locked(key, output)
+        return output
+
+    def _remember_locked(self, key: str, output: GenerationOutput) -> None:
+        self._memory[key] = output
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def store(self, key: str, output: GenerationOutput) -> None:
+        with self._lock:
+            self._remember_locked(key, output)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO conversions (key, output, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(asdict(output), ensure_ascii=False), time.time()),
+                )
+                self._db.commit()
+
+    def _follow(self, key: str, entry: _Inflight) -> Future:
+        """entry를 기다리는 Future를 하나 더 만든다. 이 Future를 cancel()하면 기다림을 그만둔 것으로 센다."""
+        target = _chain(entry.future)
+        entry.waiters += 1
+        target.add_done_callback(lambda done: self._on_waiter_done(entry, done))
+        return target
+
+    def _on_waiter_done(self, entry: _Inflight, done: Future) -> None:
+        if not done.cancelled():
+            return
+        with self._lock:
+            entry.waiters -= 1
+            abandoned = entry.waiters == 0
+        if abandoned:
+            # 아무도 기다리지 않는 생성은 대기 중이면 빼고, 실행 중이면 다음 디코드 스텝에서 멈춘다.
+            if entry.cancel is not None:
+                entry.cancel.set()
+            entry.future.cancel()
+
+    def reserve(self, key: str) -> Reservation:
+        """
+        캐시 적중이면 끝난 Future를, 같은 키가 실행 중이면 그 결과를 따라가는 Future를 돌려준다.
+        아니면 빈 자리(source)를 실행 중으로 먼저 등록하므로, 호출자가 생성을 제출하기 전에 들어온
+        같은 키의 요청도 새로 제출하지 않고 이 자리를 기다린다. 확인과 등록은 한 번의 락 안에서 한다.
+        """
+        with self._lock:
+            output = self._lookup_locked(key)
+            if output is not None:
+                metrics.CACHE_REQUESTS.inc(result="hit")
+                future: Future = Future()
+                future.set_result(output)
+                return Reservation(future)
+            entry = self._inflight.get(key)
+            if entry is not None and not entry.abandoned:
+                metrics.CACHE_REQUESTS.inc(result="coalesced")
+                return Reservation(self._follow(key, entry))
+            metrics.CACHE_REQUESTS.inc(result="miss")
+            entry = _Inflight(future=Future(), cancel=threading.Event())
+            self._inflight[key] = entry
+            entry.future.add_done_callback(lambda done, entry=entry: self._on_done(key, entry, done))
+            return Reservation(self._follow(key, entry), source=entry.future, cancel=entry.cancel)
+
+    @staticmethod
+    def attach(reservation: Reservation, future: Future) -> None:
+        """reserve로 받은 자리에 제출한 생성을 잇는다. 기다리는 요청이 모두 떠나 자리가 취소되면 생성도 취소한다."""
+        _forward(future, reservation.source)
+        reservation.source.add_done_callback(lambda done: done.cancelled() and future.cancel())
+
+    @staticmethod
+    def fail(reservation: Reservation, exc: BaseException) -> None:
+        """생성을 제출하지 못한 자리를 오류로 끝낸다. 이미 모두 떠나 취소된 자리면 그대로 둔다."""
+        if reservation.source.set_running_or_notify_cancel():
+            reservation.source.set_exception(exc)
+
+    def _on_done(self, key: str, entry: _Inflight, done: Future) -> None:
+        with self._lock:
+            if self._inflight.get(key) is entry:
+                del self._inflight[key]
+        # 빈 응답은 클라이언트가 재시도하므로 저장하지 않는다.
+        if not done.cancelled() and done.exception() is None and done.result().text.strip():
+            self.store(key, done.result())
+
+    def coalesce(self, key: str, submit: Callable[[threading.Event], Future]) -> Future:
+        """
+        캐시 적중이면 완료된 Future를, 같은 키가 실행 중이면 그 결과를 따라가는 Future를,
+        아니면 submit(cancel)로 새로 제출한 생성을 따라가는 Future를 돌려준다.
+        돌려받은 Future를 cancel()하면 기다림을 그만두며, 같은 생성을 기다리는 요청이 더 없으면
+        submit에 넘긴 cancel이 set된다.
+        """
+        reservation = self.reserve(key)
+        if reservation.source is not None:
+            try:
+                future = submit(reservation.cancel)
+            except BaseException as exc:
+                # 그 사이 이 자리를 기다리기 시작한 요청에도 같은 오류를 돌려준다.
+                self.fail(reservation, exc)
+                raise
+            self.attach(reservation, future)
+        return reservation.future
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+
+import sqlglot
+from sqlglot import expressions as exp
+from sqlglot.errors import ErrorLevel, SqlglotError
+
+from parse_sql import mask_placeholders, unmask_placeholders
+
+SOURCE_DIALECT = "oracle"
+TARGET_DIALECT = "postgres"
+
+# mask_placeholders가 만드는 마커 중 바인드 변수(#{...}, ${...}, #VAR#) 마커의 접두어.
+# 나머지(동적 태그, CDATA, 유니코드 연산자)는 SQL 구조가 달라질 수 있으므로 모델로 보낸다.
+BIND_MARKER_PREFIX = "'__PH__"
+
+# 문장 최상위 노드로 허용하는 종류
+ALLOWED_STATEMENTS = (exp.Select, exp.Union, exp.Except, exp.Intersect, exp.Insert, exp.Update, exp.Delete)
+
+# sqlglot이 Oracle -> PostgreSQL로 의미를 바꾸지 않고 옮기는 것이 확인된 노드들.
+# 나누기(정수 나눗셈 차이), ||(NULL 연결 차이), 날짜 함수/포맷, 윈도 함수 등은 일부러 뺐다.
+# TRIM/LENGTH/SUBSTR는 Oracle에서 빈 문자열이 NULL이라 결과가 달라지므로 뺐고,
+# +/-는 두 피연산자가 모두 숫자로 확인될 때만 허용한다(_unsupported_reason 참고).
+ALLOWED_NODES = frozenset(
+    {
+        exp.Select, exp.Union, exp.Except, exp.Intersect, exp.Insert, exp.Update, exp.Delete,
+        exp.With, exp.CTE, exp.Subquery, exp.From, exp.Join, exp.Where, exp.Group, exp.Having,
+        exp.Order, exp.Ordered, exp.Distinct, exp.Schema, exp.Values, exp.Tuple,
+        exp.Table, exp.TableAlias, exp.Column, exp.Identifier, exp.Alias, exp.Star, exp.Literal,
+        exp.Null, exp.Boolean, exp.Paren,
+        exp.And, exp.Or, exp.Not, exp.EQ, exp.NEQ, exp.GT, exp.GTE, exp.LT, exp.LTE,
+        exp.In, exp.Between, exp.Like, exp.Is, exp.Exists,
+        exp.Add, exp.Sub, exp.Mul, exp.Neg,
+        exp.Coalesce, exp.Case, exp.If, exp.DecodeCase, exp.CurrentTimestamp,
+        exp.Count, exp.Sum, exp.Min, exp.Max, exp.Avg,
+        exp.Upper, exp.Lower, exp.Abs,
+        exp.Cast, exp.DataType, exp.DataTypeParam,
+    }
+)
+
+# CAST 대상으로 허용하는 타입. Oracle DATE는 시각까지 담으므로 PostgreSQL DATE로 옮기지 않는다.
+ALLOWED_TYPES = frozenset(
+    {
+        exp.DataType.Type.VARCHAR, exp.DataType.Type.NVARCHAR, exp.DataType.Type.CHAR, exp.DataType.Type.NCHAR,
+        exp.DataType.Type.TEXT, exp.DataType.Type.DECIMAL, exp.DataType.Type.INT, exp.DataType.Type.BIGINT,
+        exp.DataType.Type.SMALLINT, exp.DataType.Type.TIMESTAMP,
+    }
+)
+
+# 결과가 늘 숫자인 식. Oracle은 날짜 + 숫자를 일 단위로 계산하지만 PostgreSQL의 timestamp + integer는
+# 오류이고 컬럼 타입은 알 수 없으므로, +/-는 피연산자가 숫자 리터럴이거나 이런 식일 때만 옮긴다.
+NUMERIC_NODES = (exp.Count, exp.Sum, exp.Avg, exp.Abs)
+NUMERIC_TYPES = frozenset(
+    {
+        exp.DataType.Type.DECIMAL, exp.DataType.Type.INT, exp.DataType.Type.BIGINT, exp.DataType.Type.SMALLINT,
+    }
+)
+
+# 컬럼처럼 파싱되지만 Oracle 의사 컬럼/시퀀스 참조인 이름
+PSEUDO_COLUMNS = frozenset({"ROWNUM", "ROWID", "LEVEL", "NEXTVAL", "CURRVAL", "SYSTIMESTAMP", "USER"})
+
+
+@dataclass
+class FastPathResult:
+    sql: str | None  # 변환된 PostgreSQL(모델로 보내야 하면 None)
+    reason: str  # "transpiled" 또는 모델로 보내는 이유
+    elapsed_s: float = 0.0
+    statements: int = 0
+
+
+def _is_numeric(node: exp.Expression) -> bool:
+    """숫자 리터럴이거나 결과가 숫자로 정해진 식이면 True. 컬럼과 바인드 변수는 타입을 모르므로 False."""
+    if isinstance(node, exp.Literal):
+        return node.is_number
+    if isinstance(node, (exp.Paren, exp.Neg)):
+        return _is_numeric(node.this)
+    if isinstance(node, (exp.Add, exp.Sub, exp.Mul)):
+        return _is_numeric(node.left) and _is_numeric(node.right)
+    if isinstance(node, exp.Cast):
+        return node.to.this in NUMERIC_TYPES
+    return isinstance(node, NUMERIC_NODES)
+
+
+def _is_dual(select: exp.Select) -> bool:
+    """조인 없이 FROM DUAL만 있는 SELECT."""
+    source = select.args.get("from_")
+    return (
+        source is not None
+        and not select.args.get("joins")
+        and isinstance(source.this, exp.Table)
+        and source.this.name.upper() == "DUAL"
+        and not source.this.args.get("db")
+    )
+
+
+def _unsupported_reason(stmt: exp.Expression) -> str | None:
+    """화이트리스트를 벗어나는 첫 구문의 이름. 모두 허용되면 None."""
+    if not isinstance(stmt, ALLOWED_STATEMENTS):
+        return f"statement:{type(stmt).__name__}"
+    for node in stmt.walk():
+        if type(node) not in ALLOWED_NODES:
+            return f"node:{type(node).__name__}"
+        if isinstance(node, exp.Identifier) and "@" in node.name:
+            # 데이터베이스 링크(t@dblink)는 PostgreSQL에 없다.
+            return "dblink"
+        if isinstance(node, exp.Select) and _is_dual(node) and any(sel.is_star for sel in node.expressions):
+            # FROM DUAL을 지우면 SELECT *만 남아 PostgreSQL에서 오류다.
+            return "dual_star"
+        if isinstance(node, exp.Column):
+            if node.args.get("join_mark"):
+                return "outer_join_plus"
+            if any(part.name.upper() in PSEUDO_COLUMNS for part in node.parts):
+                return "pseudo_column"
+        elif isinstance(node, exp.Literal) and node.is_string and node.this == "":
+            # Oracle에서 ''는 NULL이다.
+            return "empty_string"
+        elif isinstance(node, exp.DataType) and node.this not in ALLOWED_TYPES:
+            return f"type:{node.this.name}"
+        elif isinstance(node, (exp.Add, exp.Sub)) and not (_is_numeric(node.left) and _is_numeric(node.right)):
+            return "non_numeric_arithmetic"
+    return None
+
+
+def _drop_dual(stmt: exp.Expression) -> exp.Expression:
+    """FROM DUAL(조인 없음)은 PostgreSQL에서 FROM 없이 쓴다."""
+    for select in stmt.find_all(exp.Select):
+        if _is_dual(select):
+            select.set("from_", None)
+    return stmt
+
+
+def try_transpile(sql: str) -> FastPathResult:
+    """
+    규칙 기반으로 Oracle SQL을 PostgreSQL로 바꿔 본다.
+    모든 문장이 화이트리스트 안의 구문으로만 되어 있을 때만 결과를 돌려주고,
+    (+) 외부 조인, CONNECT BY, MyBatis 동적 태그 등이 있으면 sql=None과 이유를 돌려준다.
+    바인드 변수(#{...} 등)는 문자열 리터럴로 가렸다가 그대로 되돌린다.
+    """
+    started = time.perf_counter()
+
+    def fallback(reason: str, statements: int = 0) -> FastPathResult:
+        return FastPathResult(None, reason, time.perf_counter() - started, statements)
+
+    masked, mapping = mask_placeholders(sql)
+    if any(not marker.startswith(BIND_MARKER_PREFIX) for marker in mapping):
+        return fallback("dynamic_sql")
+    try:
+        statements = [stmt for stmt in sqlglot.parse(masked, read=SOURCE_DIALECT) if stmt is not None]
+    except SqlglotError:
+        return fallback("parse_error")
+    if not statements:
+        return fallback("empty")
+
+    converted = []
+    for stmt in statements:
+        reason = _unsupported_reason(stmt)
+        if reason is not None:
+            return fallback(reason, len(statements))
+        try:
+            text = _drop_dual(stmt).sql(dialect=TARGET_DIALECT, unsupported_level=ErrorLevel.RAISE)
+        except SqlglotError:
+            return fallback("unsupported_by_transpiler", len(statements))
+        converted.append(unmask_placeholders(text, mapping) + ";")
+
+    return FastPathResult(
+        sql="\n".join(converted),
+        reason="transpiled",
+        elapsed_s=time.perf_counter() - started,
+        statements=len(statements),
+    )
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass, field
+
+
+@dataclass(frozen=True)
+class GenerationConfig:
+    max_new_tokens: int = 1024
+    temperature: float = 0.1
+    top_p: float = 0.8
+    do_sample: bool = True
+    user_prompt: str | None = None
+    system_prompt: str | None = None
+    # 설정하면 입력 SQL의 n-gram을 이어 붙인 후보를 한 번의 forward로 검증한다(prompt lookup decoding).
+    prompt_lookup_num_tokens: int | None = None
+    # 작은 draft 모델이 제안한 토큰을 본 모델이 검증한다(speculative / assisted decoding).
+    use_draft_model: bool = False
+    # 출력에 이 문자열이 나오면 멈추고 그 앞까지만 돌려준다(예: 프롬프트 마커 "Oracle SQL:" 반복).
+    stop_strings: tuple[str, ...] = ()
+    # 출력에 문자열/주석 밖의 ';'가 이 개수만큼 나오면 문장이 끝난 것으로 보고 멈춘다.
+    expected_statements: int | None = None
+    # 설정하면 max_new_tokens를 min(max_new_tokens, 입력 SQL 토큰 수 * ratio + margin)으로 줄인다.
+    output_budget_ratio: float | None = None
+    output_budget_margin: int = 64
+
+    def __post_init__(self) -> None:
+        if self.prompt_lookup_num_tokens is not None and self.use_draft_model:
+            raise ValueError("prompt_lookup_num_tokens and use_draft_model cannot be used together")
+
+    def batch_key(self) -> tuple:
+        """같은 model.generate 호출로 묶을 수 있는 요청끼리 같은 키를 갖는다."""
+        # 시스템 프롬프트가 같아야 배치 전체가 하나의 prefix KV-cache를 공유할 수 있다.
+        return (
+            self.system_prompt,
+            self.temperature,
+            self.top_p,
+            self.do_sample,
+            self.prompt_lookup_num_tokens,
+            self.use_draft_model,
+            self.stop_strings,
+        )
+
+    def token_budget(self, question_tokens: int) -> int:
+        """output_budget_ratio가 있으면 입력 SQL 토큰 수에 비례한 출력 토큰 한도를 쓴다."""
+        if self.output_budget_ratio is None:
+            return self.max_new_tokens
+        budget = math.ceil(question_tokens * self.output_budget_ratio) + self.output_budget_margin
+        return max(1, min(self.max_new_tokens, budget))
+
+    @property
+    def batchable(self) -> bool:
+        """후보 검증(assisted) 디코딩은 transformers에서 배치 1만 지원한다."""
+        return self.prompt_lookup_num_tokens is None and not self.use_draft_model
+
+    @property
+    def decode_mode(self) -> str:
+        if self.prompt_lookup_num_tokens is not None:
+            return "prompt_lookup"
+        if self.use_draft_model:
+            return "draft_model"
+        return "sample" if self.do_sample else "greedy"
+
+
+@dataclass(frozen=True)
+class GenerationOutput:
+    text: str
+    input_tokens: int
+    output_tokens: int
+    stats: dict = field(default_factory=dict)
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+from sqlglot.errors import SqlglotError
+
+from merge_sql import merge_regex_only
+from parse_sql import DEFAULT_DIALECT, DEFAULT_MAX_CHARS, SQLPart, split_sql_text, unmask_placeholders
+from postprocess import clean_response_text
+
+MAIN_PART = "main"
+
+
+@dataclass
+class PartConversion:
+    statement_index: int
+    name: str  # MAIN_PART 또는 CTE 이름
+    source_sql: str  # 자리표시자를 되돌린 원본 Oracle SQL 조각
+    converted_sql: str = ""
+
+
+@dataclass
+class LongSqlConversion:
+    sql: str
+    parts: list[PartConversion]
+    split: list[dict] = field(default_factory=list)  # 문장별 SQLPart.meta
+
+
+def plan_parts(
+    sql_text: str,
+    min_depth_to_extract: int,
+    max_chars: int = DEFAULT_MAX_CHARS,
+    count_tokens: Callable[[str], int] | None = None,
+    max_tokens: int | None = None,
+) -> tuple[list[SQLPart], list[PartConversion]]:
+    """
+    SQL 텍스트를 메모리에서 문장별 main + CTE 조각으로 나누고, 조각마다 변환할 원본 SQL을 만든다.
+    count_tokens와 max_tokens를 주면 조각 SQL이 max_tokens 토큰 안에 들도록 나눈다.
+    sqlglot이 파싱하지 못하면 전체를 조각 하나로 보낸다.
+    """
+    try:
+        statements = split_sql_text(
+            sql_text,
+            dialect=DEFAULT_DIALECT,
+            max_chars=max_chars,
+            min_depth_to_extract=min_depth_to_extract,
+            count_tokens=count_tokens,
+            max_tokens=max_tokens,
+        )
+    except SqlglotError:
+        statements = []
+    if not statements:
+        whole = SQLPart(
+            statement_index=1,
+            main_sql=sql_text,
+            ctes={},
+            meta={"split": False, "reason": "parse_failed", "extracted": []},
+            placeholder_map={},
+        )
+        return [whole], [PartConversion(1, MAIN_PART, sql_text)]
+
+    parts = []
+    fragments: set[str] = set()
+    for statement in statements:
+        mapping = statement.placeholder_map
+        parts.append(
+            PartConversion(statement.statement_index, MAIN_PART, unmask_placeholders(statement.main_sql, mapping))
+        )
+        for cte_name, cte_sql in statement.ctes.items():
+            # CTE 이름은 서브쿼리 내용의 해시라서, 여러 문장에 나오는 같은 서브쿼리는 한 번만 변환한다.
+            if cte_name in fragments:
+                continue
+            fragments.add(cte_name)
+            parts.append(PartConversion(statement.statement_index, cte_name, unmask_placeholders(cte_sql, mapping)))
+    return statements, parts
+
+
+def merge_parts(statements: list[SQLPart], parts: list[PartConversion]) -> str:
+    """변환된 CTE 조각을 변환된 main 문장의 참조 자리에 다시 끼워 넣는다."""
+    mains = {part.statement_index: part.converted_sql for part in parts if part.name == MAIN_PART}
+    fragments = {part.name: part.converted_sql for part in parts if part.name != MAIN_PART}
+    merged = []
+    for statement in statements:
+        ctes = {cte_name: fragments[cte_name] for cte_name in statement.ctes}
+        merged.append(merge_regex_only(mains[statement.statement_index], ctes))
+    return "\n\n".join(merged)
+
+
+async def convert_parts(
+    statements: list[SQLPart],
+    parts: list[PartConversion],
+    convert: Callable[[str], Awaitable[str]],
+) -> LongSqlConversion:
+    """
+    main과 CTE 조각을 convert로 동시에 변환한 뒤 합친다.
+    조각은 서로의 변환 결과에 의존하지 않으므로(다른 조각은 CTE 이름으로만 참조) 한꺼번에 제출해
+    배처가 비슷한 길이끼리 묶어 실행하게 한다. 조각 하나라도 실패하면 그 예외를 그대로 올린다.
+    """
+    outputs = await asyncio.gather(*(convert(part.source_sql) for part in parts))
+    for part, output in zip(parts, outputs):
+        part.converted_sql = clean_response_text(output).strip()
+    return LongSqlConversion(
+        sql=merge_parts(statements, parts),
+        parts=parts,
+        split=[statement.meta for statement in statements],
+    )
+
+
+async def convert_long_sql(
+    sql_text: str,
+    convert: Callable[[str], Awaitable[str]],
+    min_depth_to_extract: int,
+    max_chars: int = DEFAULT_MAX_CHARS,
+    count_tokens: Callable[[str], int] | None = None,
+    max_tokens: int | None = None,
+) -> LongSqlConversion:
+    """긴 Oracle 문장을 파생 테이블 단위로 나누고(plan_parts) 조각을 동시에 변환해 합친다(convert_parts)."""
+    statements, parts = await asyncio.to_thread(
+        plan_parts, sql_text, min_depth_to_extract, max_chars, count_tokens, max_tokens
+    )
+    return await convert_parts(statements, parts, convert)
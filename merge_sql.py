@@ -1,9 +1,11 @@
 import os
 import json
 import argparse
-from typing import Dict
+from typing import Dict, Optional
 import re
 
+from run_ledger import STAGE_MERGE, RunLedger, content_hash
+
 def _read_text(path: str) -> str:
     with open(path, "r", encoding="utf-8") as f:
         return f.read().strip()
@@ -31,6 +33,18 @@ CROSS\s+JOIN
 def merge_regex_only(main_sql: str, cte_sql_map: Dict[str, str]) -> str:
     out = main_sql
 
+    # 바깥 파생 테이블의 CTE 본문에 안쪽 CTE 이름이 들어 있으므로, 더 바뀌지 않을 때까지 반복해서 끼워 넣는다.
+    for _ in range(len(cte_sql_map) + 1):
+        merged = _inline_ctes(out, cte_sql_map)
+        if merged == out:
+            break
+        out = merged
+
+    return _norm(out) + ";"
+
+def _inline_ctes(main_sql: str, cte_sql_map: Dict[str, str]) -> str:
+    out = main_sql
+
     for cte_name in sorted(cte_sql_map.keys(), key=len, reverse=True):
         body = _norm(cte_sql_map[cte_name])
 
@@ -52,11 +66,10 @@ def merge_regex_only(main_sql: str, cte_sql_map: Dict[str, str]) -> str:
 
         out = pattern.sub(repl, out)
 
-    return _norm(out) + ";"
+    return out
 
-def load_parts(parts_dir: str, manifest_path: str, use_transformed: bool, transformed_suffix: str):
-    manifest = json.loads(_read_text(manifest_path))
-    merged_statements = []
+def _part_paths(parts_dir: str, manifest, use_transformed: bool, transformed_suffix: str):
+    """manifest 항목마다 (main 파일, {CTE 이름: 파일}) 경로. 변환 파일이 있으면 그것을 고른다."""
 
     def pick(path: str) -> str:
         if use_transformed:
@@ -67,18 +80,57 @@ def load_parts(parts_dir: str, manifest_path: str, use_transformed: bool, transf
 
     for entry in manifest:
         main_path = pick(os.path.join(parts_dir, entry["main_file"]))
-        main_sql = _read_text(main_path)
+        cte_paths = {
+            cte_name: pick(os.path.join(parts_dir, cte_file))
+            for cte_name, cte_file in (entry.get("cte_files") or {}).items()
+        }
+        yield main_path, cte_paths
 
-        cte_sql_map = {}
-        for cte_name, cte_file in (entry.get("cte_files") or {}).items():
-            cte_path = pick(os.path.join(parts_dir, cte_file))
-            cte_sql_map[cte_name] = _read_text(cte_path)
+def load_parts(parts_dir: str, manifest_path: str, use_transformed: bool, transformed_suffix: str):
+    manifest = json.loads(_read_text(manifest_path))
+    merged_statements = []
+
+    for main_path, cte_paths in _part_paths(parts_dir, manifest, use_transformed, transformed_suffix):
+        main_sql = _read_text(main_path)
+        cte_sql_map = {cte_name: _read_text(cte_path) for cte_name, cte_path in cte_paths.items()}
 
         merged = merge_regex_only(main_sql, cte_sql_map)
         merged_statements.append(merged)
 
     return "\n\n".join(merged_statements).strip() + "\n"
 
+def merge_manifest(
+    parts_dir: str,
+    manifest_path: str,
+    out_path: str,
+    use_transformed: bool,
+    transformed_suffix: str,
+    ledger: Optional[RunLedger] = None,
+) -> bool:
+    """
+    manifest의 조각을 합쳐 out_path에 쓰고, 새로 합쳤으면 True를 돌려준다.
+    ledger를 주면 manifest와 고른 조각 파일 내용이 지난번과 같고
+    출력 파일이 그대로일 때는 건너뛴다(False).
+    """
+    input_hash = None
+    if ledger is not None:
+        manifest_text = _read_text(manifest_path)
+        paths = []
+        for main_path, cte_paths in _part_paths(
+            parts_dir, json.loads(manifest_text), use_transformed, transformed_suffix
+        ):
+            paths.append(main_path)
+            paths.extend(cte_paths[name] for name in sorted(cte_paths))
+        # 어떤 파일(원본/변환)을 골랐는지도 입력에 넣는다.
+        input_hash = content_hash(manifest_text, *paths, *(_read_text(path) for path in paths))
+        if ledger.current(STAGE_MERGE, os.path.abspath(out_path), input_hash):
+            return False
+
+    _write_text(out_path, load_parts(parts_dir, manifest_path, use_transformed, transformed_suffix))
+    if ledger is not None:
+        ledger.record(STAGE_MERGE, os.path.abspath(out_path), input_hash, outputs=[out_path])
+    return True
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument("--parts_dir", required=True, help="분할 결과 폴더")
@@ -86,15 +138,21 @@ def main():
     p.add_argument("--out", required=True, help="합친 SQL 출력 경로")
     p.add_argument("--use_transformed", action="store_true", help="*.transformed.sql 우선 사용")
     p.add_argument("--transformed_suffix", default=".transformed.sql", help="변환 파일 suffix")
+    p.add_argument("--ledger", default=None, help="입력이 바뀌지 않았으면 건너뛰도록 해시를 남길 원장(SQLite)")
     args = p.parse_args()
 
-    final_sql = load_parts(
+    ledger = RunLedger(args.ledger) if args.ledger else None
+
+    merged = merge_manifest(
         parts_dir=args.parts_dir,
         manifest_path=args.manifest,
+        out_path=args.out,
         use_transformed=args.use_transformed,
         transformed_suffix=args.transformed_suffix,
+        ledger=ledger,
     )
-    _write_text(args.out, final_sql)
+    if not merged:
+        print(f"unchanged: {args.out}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
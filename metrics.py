@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+
+from generation import GenerationOutput
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # 라벨 조합 -> (버킷별 개수(누적 아님), 합계, 개수)
+        self._values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+QUEUE_WAIT_SECONDS = REGISTRY.register(
+    Histogram("sqlconv_queue_wait_seconds", "Time a request waited in the batcher queue.", ("priority",))
+)
+QUEUE_DEPTH = REGISTRY.register(Gauge("sqlconv_queue_depth", "Requests waiting in the batcher queue.", ("priority",)))
+TOKENIZE_SECONDS = REGISTRY.register(
+    Histogram("sqlconv_tokenize_seconds", "Prompt rendering and tokenization time per batch.", ("mode",))
+)
+PREFILL_SECONDS = REGISTRY.register(
+    Histogram("sqlconv_prefill_seconds", "Prompt prefill time (until the first decode step) per batch.", ("mode",))
+)
+DECODE_SECONDS = REGISTRY.register(Histogram("sqlconv_decode_seconds", "Decode time per batch.", ("mode",)))
+DECODE_TOKENS_PER_SECOND = REGISTRY.register(
+    Histogram(
+        "sqlconv_decode_tokens_per_second",
+        "Output tokens per second of decode time, summed over the batch.",
+        ("mode",),
+        buckets=RATE_BUCKETS,
+    )
+)
+BATCH_SIZE = REGISTRY.register(
+    Histogram("sqlconv_batch_size", "Requests per generate_batch call.", ("mode",), buckets=BATCH_BUCKETS)
+)
+INPUT_TOKENS = REGISTRY.register(
+    Histogram("sqlconv_input_tokens", "Prompt tokens per request.", ("mode",), buckets=TOKEN_BUCKETS)
+)
+OUTPUT_TOKENS = REGISTRY.register(
+    Histogram("sqlconv_output_tokens", "Generated tokens per request.", ("mode",), buckets=TOKEN_BUCKETS)
+)
+GENERATION_ERRORS = REGISTRY.register(Counter("sqlconv_generation_errors_total", "Failed generate_batch calls."))
+ABANDONED_REQUESTS = REGISTRY.register(
+    Counter(
+        "sqlconv_abandoned_requests_total",
+        "Requests whose generation was stopped early, by reason (deadline, disconnect).",
+        ("reason",),
+    )
+)
+CACHE_REQUESTS = REGISTRY.register(
+    Counter("sqlconv_cache_requests_total", "Conversion cache lookups by result (hit, coalesced, miss).", ("result",))
+)
+FAST_PATH_REQUESTS = REGISTRY.register(
+    Counter(
+        "sqlconv_fast_path_total",
+        "Conversion requests by rule-based fast path result (transpiled, model).",
+        ("result",),
+    )
+)
+INFLIGHT_REQUESTS = REGISTRY.register(
+    Gauge("sqlconv_inflight_requests", "HTTP requests currently being handled.", ("endpoint",))
+)
+REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "sqlconv_request_duration_seconds",
+        "HTTP request latency until the last byte of the response.",
+        ("endpoint", "status"),
+    )
+)
+
+
+def observe_batch(outputs: list[GenerationOutput]) -> None:
+    """generate_batch 한 번의 결과 stats에서 단계별 시간과 토큰 수를 기록한다."""
+    if not outputs:
+        return
+    stats = outputs[0].stats
+    mode = stats.get("decode_mode", "unknown")
+    BATCH_SIZE.observe(len(outputs), mode=mode)
+    for output in outputs:
+        INPUT_TOKENS.observe(output.input_tokens, mode=mode)
+        OUTPUT_TOKENS.observe(output.output_tokens, mode=mode)
+    if "tokenize_s" in stats:
+        TOKENIZE_SECONDS.observe(stats["tokenize_s"], mode=mode)
+    if "prefill_s" in stats:
+        PREFILL_SECONDS.observe(stats["prefill_s"], mode=mode)
+    decode_s = stats.get("decode_s")
+    if decode_s is not None:
+        DECODE_SECONDS.observe(decode_s, mode=mode)
+        if decode_s > 0:
+            DECODE_TOKENS_PER_SECOND.observe(sum(output.output_tokens for output in outputs) / decode_s, mode=mode)
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+
+import sqlglot
+
+# 저장하는 값(문장 하나의 SQLPart 목록)의 형식이나 분할 규칙이 바뀌면 올린다. sqlglot 버전과 함께 캐시 버전이 된다.
+CACHE_FORMAT_VERSION = 3
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# 한도를 넘으면 이 비율까지 오래 안 쓴 항목부터 지운다(넣을 때마다 지우지 않도록 여유를 둔다).
+EVICT_TO_RATIO = 0.9
+
+
+def cache_version() -> str:
+    return f"{CACHE_FORMAT_VERSION}:sqlglot-{sqlglot.__version__}"
+
+
+def make_parse_key(
+    masked_text: str,
+    dialect: str,
+    max_chars: int,
+    min_depth_to_extract: int,
+    max_tokens: int | None = None,
+    tokenizer: str | None = None,
+) -> str:
+    """가린 문장 텍스트의 해시 + 분할 설정의 sha256."""
+    payload = {
+        "masked_sha256": hashlib.sha256(masked_text.encode("utf-8")).hexdigest(),
+        "dialect": dialect,
+        "max_chars": max_chars,
+        "min_depth_to_extract": min_depth_to_extract,
+        "max_tokens": max_tokens,
+        "tokenizer": tokenizer,
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ParseCache:
+    """
+    split_sql_text가 문장마다 나눈 결과(SQLPart 목록)를 SQLite 파일에 두는 캐시.
+    키는 가린 문장 텍스트와 분할 설정이고, sqlglot 버전이나 CACHE_FORMAT_VERSION이 바뀌면 통째로 비운다.
+    전체 크기가 max_bytes를 넘으면 마지막으로 쓴 시각이 오래된 항목부터 지운다.
+    여러 프로세스가 같은 파일을 함께 써도 되도록 WAL 모드로 열고, fork된 프로세스에서는 새로 연결한다.
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._db: sqlite3.Connection | None = None
+        self._pid: int | None = None
+
+    def __getstate__(self) -> dict:
+        # 연결은 프로세스마다 따로 연다.
+        return {"path": self.path, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["path"], state["max_bytes"])
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is not None and self._pid == os.getpid():
+            return self._db
+        self._db = sqlite3.connect(self.path, timeout=30)
+        self._pid = os.getpid()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS parse_results (
+                    key TEXT PRIMARY KEY,
+                    parts BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    used_at REAL NOT NULL
+                )
+                """
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS parse_results_used_at ON parse_results (used_at)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS parse_meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            row = self._db.execute("SELECT value FROM parse_meta WHERE name = 'version'").fetchone()
+            if row is None or row[0] != cache_version():
+                self._db.execute("DELETE FROM parse_results")
+                self._db.execute(
+                    "INSERT OR REPLACE INTO parse_meta (name, value) VALUES ('version', ?)", (cache_version(),)
+                )
+                self._db.execute("INSERT OR REPLACE INTO parse_meta (name, value) VALUES ('total_bytes', '0')")
+        return self._db
+
+    def lookup(self, key: str) -> list | None:
+        db = self._connect()
+        row = db.execute("SELECT parts FROM parse_results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        try:
+            parts = pickle.loads(zlib.decompress(row[0]))
+        except Exception:  # noqa: BLE001
+            # 깨졌거나 읽을 수 없는 항목은 지우고 새로 만든다.
+            self._delete([key])
+            self.misses += 1
+            return None
+        with db:
+            db.execute("UPDATE parse_results SET used_at = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return parts
+
+    def store(self, key: str, parts: list) -> None:
+        blob = zlib.compress(pickle.dumps(parts, protocol=pickle.HIGHEST_PROTOCOL))
+        if len(blob) > self.max_bytes:
+            return
+        db = self._connect()
+        with db:
+            row = db.execute("SELECT size FROM parse_results WHERE key = ?", (key,)).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO parse_results (key, parts, size, used_at) VALUES (?, ?, ?, ?)",
+                (key, blob, len(blob), time.time()),
+            )
+            total = self._add_total(db, len(blob) - (row[0] if row else 0))
+        if total > self.max_bytes:
+            self._evict(total)
+
+    def _add_total(self, db: sqlite3.Connection, delta: int) -> int:
+        db.execute(
+            "UPDATE parse_meta SET value = CAST(CAST(value AS INTEGER) + ? AS TEXT) WHERE name = 'total_bytes'",
+            (delta,),
+        )
+        return int(db.execute("SELECT value FROM parse_meta WHERE name = 'total_bytes'").fetchone()[0])
+
+    def _delete(self, keys: list[str]) -> None:
+        db = self._connect()
+        with db:
+            freed = 0
+            for key in keys:
+                row = db.execute("SELECT size FROM parse_results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    db.execute("DELETE FROM parse_results WHERE key = ?", (key,))
+                    freed += row[0]
+            self._add_total(db, -freed)
+
+    def _evict(self, total: int) -> None:
+        target = int(self.max_bytes * EVICT_TO_RATIO)
+        db = self._connect()
+        while total > target:
+            rows = db.execute("SELECT key, size FROM parse_results ORDER BY used_at LIMIT 256").fetchall()
+            if not rows:
+                break
+            victims = []
+            for key, size in rows:
+                victims.append(key)
+                total -= size
+                if total <= target:
+                    break
+            self._delete(victims)
+
+    def stats(self) -> dict:
+        db = self._connect()
+        entries = db.execute("SELECT COUNT(*) FROM parse_results").fetchone()[0]
+        total = int(db.execute("SELECT value FROM parse_meta WHERE name = 'total_bytes'").fetchone()[0])
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": total}
+
+    def close(self) -> None:
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
@@ -1,13 +1,16 @@
 import os
 import re
+import sys
 import json
 import uuid
 import hashlib
-from dataclasses import dataclass
-from typing import List, Dict, Optional, Tuple
+from dataclasses import dataclass, replace
+from typing import Callable, List, Dict, Optional, Tuple
 
 import sqlglot
 from sqlglot import expressions as exp
+from sqlglot.dialects.dialect import Dialect
+from sqlglot.tokens import TokenType
 
 
 # -----------------------------
@@ -16,6 +19,13 @@ from sqlglot import expressions as exp
 DEFAULT_MAX_CHARS = 1000
 DEFAULT_DIALECT = "oracle"
 
+# sqlglot의 파서/생성기는 재귀라서 서브쿼리가 100단계 남짓 중첩되면 기본 한도(1000)를 넘는다.
+SQL_RECURSION_LIMIT = 10000
+
+# 나누는 동안 자식 파생 테이블 본문 자리에 잠시 넣는 식별자
+SPLIT_STUB_PREFIX = "__SPLIT_STUB__"
+RE_SPLIT_STUB = re.compile(r"\(" + SPLIT_STUB_PREFIX + r"(\d+)__\)")
+
 # (A) MyBatis 바인딩 / 치환
 RE_MYBATIS_BIND = re.compile(r"#\{[^}]*\}")   # #{...}
 RE_MYBATIS_DOLLAR = re.compile(r"\$\{[^}]*\}")  # ${...}  (필요하면 활성화)
@@ -48,137 +58,150 @@ UNICODE_OPS = {
     "≠": "<>",
 }
 
+# (A)~(E)를 한 번에 찾는 스캐너. 그룹 이름이 마커 종류가 되며, 같은 위치에서는 앞쪽 그룹이 우선이다.
+RE_MASK_TOKEN = re.compile(
+    # 모든 토큰의 첫 글자로 먼저 걸러서, 대부분의 위치에서는 분기를 하나씩 시도하지 않게 한다.
+    r"(?=[<\]#$≥≤≠])(?:"
+    + "|".join(
+        [
+            rf"(?P<MBTAG>{RE_MYBATIS_XML_TAG.pattern})",
+            rf"(?P<CDATA_OPEN>{RE_CDATA_OPEN.pattern})",
+            rf"(?P<CDATA_CLOSE>{RE_CDATA_CLOSE.pattern})",
+            rf"(?P<UOP>{'|'.join(map(re.escape, UNICODE_OPS))})",
+            rf"(?P<PH>{RE_MYBATIS_BIND.pattern}|{RE_MYBATIS_DOLLAR.pattern}|{RE_HASH_VAR.pattern})",
+        ]
+    )
+    + ")",
+    re.IGNORECASE,
+)
+
+# mask_placeholders가 만든 마커: 문자열 리터럴 마커, 또는 (ASCII 연산자 +) 주석 마커
+RE_MASK_MARKER = re.compile(
+    r"(?P<literal>'__PH__[0-9a-f]+__\d+__')"
+    r"|(?:(?P<op>>=|<=|<>)(?P<space>\s*))?/\*\s*(?P<marker>__[A-Z_]+__[0-9a-f]+__\d+__)\s*\*/"
+)
+
 
 # -----------------------------
 # Data structures
 # -----------------------------
-@dataclass
+@dataclass(slots=True)
 class SQLPart:
     statement_index: int
-    original_sql: str              # masked
     main_sql: str                  # masked
     ctes: Dict[str, str]           # masked
     meta: Dict[str, object]
-    placeholder_map: Dict[str, str]  # replacement -> original
+    placeholder_map: Dict[str, str]  # replacement -> original (이 문장에 있는 마커만)
+    source_sql: Optional[str] = None  # masked, 나눴을 때만(나누지 않았으면 main_sql과 같다)
+
+    @property
+    def original_sql(self) -> str:
+        return self.source_sql if self.source_sql is not None else self.main_sql
 
 
 # -----------------------------
 # Placeholder mask / unmask
 # -----------------------------
-def mask_placeholders(sql: str) -> Tuple[str, Dict[str, str]]:
+def mask_placeholders(sql: str, run_id: Optional[str] = None) -> Tuple[str, Dict[str, str]]:
     """
     아래 항목을 모두 '파싱 안전' 형태로 치환:
       1) MyBatis XML 동적 태그(<if> 등) -> /*__MBTAG__...__*/ (SQL 주석)
       2) CDATA -> /*__CDATA__...__*/ (SQL 주석)
-      3) 유니코드 연산자(≥/≤/≠) -> >=/*__UOP__*/ (ASCII 연산자 + 주석)
+      3) 유니코드 연산자(≥/≤/≠) -> >=/*__UOP__...__*/ (ASCII 연산자 + 주석)
       4) MyBatis #{...}, ${...}, #VAR# -> '__PH__...__' (문자열 리터럴)
 
+    모든 패턴을 하나의 정규식(RE_MASK_TOKEN)으로 묶어 텍스트를 한 번만 훑는다.
+    같은 위치에서는 위 순서대로 먼저 맞는 패턴을 쓰므로 태그 안의 #{...}나 ≥는 태그와 함께 가려진다.
+
     반환 mapping은 replacement -> original 로 저장되어 unmask로 원복 가능.
+    run_id(16진수)를 주면 마커가 실행마다 같아진다(기본은 매번 새 uuid).
     """
-    run_id = uuid.uuid4().hex
+    run_id = run_id or uuid.uuid4().hex
     mapping: Dict[str, str] = {}
     counter = 0
 
-    def new_comment_marker(prefix: str) -> str:
+    def repl(m: re.Match) -> str:
         nonlocal counter
-        marker = f"/*__{prefix}__{run_id}__{counter}__*/"
-        counter += 1
-        return marker
-
-    def new_string_marker() -> str:
-        nonlocal counter
-        marker = f"'__PH__{run_id}__{counter}__'"
-        counter += 1
-        return marker
-
-    masked = sql
-
-    # 1) MyBatis XML 태그: 주석으로 치환 (문자열리터럴로 넣으면 SQL 구문을 깨기 쉬움)
-    def repl_xml(m: re.Match) -> str:
+        kind = m.lastgroup
         original = m.group(0)
-        marker = new_comment_marker("MBTAG")
-        mapping[marker] = original
-        return marker
-
-    masked = RE_MYBATIS_XML_TAG.sub(repl_xml, masked)
+        if kind == "PH":
+            # 파싱 목적이므로 값이 뭔지 중요하지 않다(원복은 mapping으로)
+            replacement = f"'__PH__{run_id}__{counter}__'"
+        elif kind == "UOP":
+            # ASCII 연산자로 바꿔서 파서가 인식하게 만들고, 주석 마커로 원래 연산자를 기억한다.
+            replacement = f"{UNICODE_OPS[original]}/*__UOP__{run_id}__{counter}__*/"
+        else:
+            # XML 태그/CDATA는 주석으로 (문자열리터럴로 넣으면 SQL 구문을 깨기 쉬움)
+            replacement = f"/*__{kind}__{run_id}__{counter}__*/"
+        counter += 1
+        mapping[replacement] = original
+        return replacement
 
-    # 2) CDATA 처리
-    def repl_cdata_open(m: re.Match) -> str:
-        original = m.group(0)
-        marker = new_comment_marker("CDATA_OPEN")
-        mapping[marker] = original
-        return marker
+    masked = RE_MASK_TOKEN.sub(repl, sql)
+    return masked, mapping
 
-    def repl_cdata_close(m: re.Match) -> str:
-        original = m.group(0)
-        marker = new_comment_marker("CDATA_CLOSE")
-        mapping[marker] = original
-        return marker
 
-    masked = RE_CDATA_OPEN.sub(repl_cdata_open, masked)
-    masked = RE_CDATA_CLOSE.sub(repl_cdata_close, masked)
-
-    # 3) 유니코드 연산자: ASCII 연산자 + 주석 마커로 바꿔서 파서가 인식하게 만들고 원복도 가능하게
-    #    예: ≥  -> >=/*__UOP__...__*/   (unmask 시 이 전체 문자열을 ≥로 되돌림)
-    for uop, ascii_op in UNICODE_OPS.items():
-        if uop in masked:
-            # 각 등장마다 다른 marker를 부여해야 정확히 원복됨
-            parts = masked.split(uop)
-            if len(parts) > 1:
-                rebuilt = [parts[0]]
-                for _ in range(len(parts) - 1):
-                    marker = new_comment_marker("UOP")
-                    replacement = f"{ascii_op}{marker}"
-                    mapping[replacement] = uop
-                    rebuilt.append(replacement)
-                    rebuilt.append(parts[len(rebuilt)//2] if False else "")  # placeholder, not used
-                # 위 방식은 리스트 관리가 지저분하므로 안전하게 재구성
-                # -> 아래에서 더 깔끔하게 재구성
-                pass
-
-    # 깔끔한 방식으로 재구성 (유니코드 연산자별로 정규식 치환)
-    def replace_unicode_op(text: str, uop: str, ascii_op: str) -> str:
-        # uop를 하나씩 치환하면서 mapping을 쌓는다
-        while uop in text:
-            marker = new_comment_marker("UOP")
-            replacement = f"{ascii_op}{marker}"
-            mapping[replacement] = uop
-            text = text.replace(uop, replacement, 1)
-        return text
-
-    for uop, ascii_op in UNICODE_OPS.items():
-        masked = replace_unicode_op(masked, uop, ascii_op)
-
-    # 4) MyBatis #{...} / ${...} / #VAR#: 문자열 리터럴로 치환
-    #    - 파싱 목적이므로 값이 뭔지 중요하지 않다(원복은 mapping으로)
-    def repl_stringish(m: re.Match) -> str:
-        original = m.group(0)
-        marker = new_string_marker()
-        mapping[marker] = original
+def unmask_placeholders(sql: str, mapping: Dict[str, str]) -> str:
+    """
+    RE_MASK_MARKER로 마커만 한 번에 찾아 mapping으로 되돌린다. 비용은 mapping 크기가 아니라 sql 길이에 비례한다.
+    sqlglot이 다시 만든 SQL은 주석을 /* ... */처럼 띄어 쓰므로 주석 마커는 안쪽 공백을 무시하고 찾는다.
+    연산자와 떨어져 버린 유니코드 연산자 마커는 지운다(앞의 ASCII 연산자가 같은 뜻이다).
+    """
+    if not mapping:
+        return sql
+
+    def repl(m: re.Match) -> str:
+        key = _resolve_marker(m, mapping)
+        if key is None:
+            return m.group(0)
+        if key.startswith("'"):
+            return mapping[key]
+        op = m.group("op") or ""
+        if key.startswith("/*"):
+            return op + (m.group("space") or "") + mapping[key]
+        # 유니코드 연산자 마커: 바로 앞 연산자와 함께 원래 연산자로
+        return mapping[key] if op and key.startswith(op) else op
+
+    return RE_MASK_MARKER.sub(repl, sql)
+
+
+def _resolve_marker(m: re.Match, mapping: Dict[str, str]) -> Optional[str]:
+    """RE_MASK_MARKER 매치에 해당하는 mapping 키(sqlglot이 띄어 쓴 주석 마커도 원래 키로)."""
+    literal = m.group("literal")
+    if literal is not None:
+        return literal if literal in mapping else None
+    marker = f"/*{m.group('marker')}*/"
+    op = m.group("op")
+    if op and op + marker in mapping:
+        return op + marker
+    if marker in mapping:
         return marker
-
-    # #{...} 먼저
-    masked = RE_MYBATIS_BIND.sub(repl_stringish, masked)
-
-    # ${...} 도 쓰면 활성화 (원하면 아래 주석 해제)
-    masked = RE_MYBATIS_DOLLAR.sub(repl_stringish, masked)
-
-    # #VAR#
-    masked = RE_HASH_VAR.sub(repl_stringish, masked)
-
-    return masked, mapping
+    for ascii_op in UNICODE_OPS.values():
+        if ascii_op + marker in mapping:
+            return ascii_op + marker
+    return None
 
 
-def unmask_placeholders(sql: str, mapping: Dict[str, str]) -> str:
-    # 긴 replacement부터 치환(부분 겹침 방지)
-    for replacement in sorted(mapping.keys(), key=len, reverse=True):
-        sql = sql.replace(replacement, mapping[replacement])
-    return sql
+def scope_placeholder_map(texts: List[str], mapping: Dict[str, str]) -> Dict[str, str]:
+    """texts에 실제로 들어 있는 마커만 담은 mapping. 문장별 SQLPart가 파일 전체 mapping을 들고 다니지 않게 한다."""
+    scoped: Dict[str, str] = {}
+    for text in texts:
+        for m in RE_MASK_MARKER.finditer(text):
+            key = _resolve_marker(m, mapping)
+            if key is not None:
+                scoped[key] = mapping[key]
+    return scoped
 
 
 # -----------------------------
 # Helpers
 # -----------------------------
+def _ensure_recursion_limit(limit: int = SQL_RECURSION_LIMIT) -> None:
+    """재귀 한도를 limit까지 올린다. 이미 더 높으면 그대로 둔다."""
+    if sys.getrecursionlimit() < limit:
+        sys.setrecursionlimit(limit)
+
+
 def normalize_sql(s: str) -> str:
     return s.strip().rstrip(";").strip()
 
@@ -199,28 +222,41 @@ def _get_query_expr(stmt: exp.Expression) -> Optional[exp.Expression]:
     return None
 
 
-def traverse_with_depth(node: exp.Expression, depth: int = 0, parent: Optional[exp.Expression] = None):
-    yield node, depth, parent
+def _child_expressions(node: exp.Expression) -> List[exp.Expression]:
+    children = []
     for child in node.args.values():
-        if child is None:
-            continue
         if isinstance(child, exp.Expression):
-            yield from traverse_with_depth(child, depth + 1, node)
+            children.append(child)
         elif isinstance(child, list):
-            for item in child:
-                if isinstance(item, exp.Expression):
-                    yield from traverse_with_depth(item, depth + 1, node)
+            children.extend(item for item in child if isinstance(item, exp.Expression))
+    return children
+
+
+def traverse_with_depth(node: exp.Expression, depth: int = 0, parent: Optional[exp.Expression] = None):
+    """(node, depth, parent)를 전위 순서로 낸다. 재귀 대신 명시적 스택을 써서 깊게 중첩된 문장에서도 안전하다."""
+    stack = [(node, depth, parent)]
+    while stack:
+        node, depth, parent = stack.pop()
+        yield node, depth, parent
+        stack.extend((child, depth + 1, node) for child in reversed(_child_expressions(node)))
 
 
 def _parent_is_from_or_join(parent: Optional[exp.Expression]) -> bool:
     return isinstance(parent, (exp.From, exp.Join))
 
 
-def _safe_cte_name(alias_name: Optional[str], inner_sql: str) -> str:
-    h = hashlib.sha1(inner_sql.encode("utf-8")).hexdigest()[:10]
-    u = uuid.uuid4().hex[:8]
-    suffix = re.sub(r"[^A-Za-z0-9_]", "_", alias_name or "part")
-    return f"cte__{h}__{u}__{suffix}"
+def fragment_key(fragment_sql: str) -> str:
+    """
+    추출한 파생 테이블의 키. 자리표시자를 되돌린 SQL의 SHA-1이라 실행/문장/파일이 달라도
+    같은 서브쿼리는 같은 키를 갖는다(가린 SQL에는 실행마다 다른 run_id가 들어 있다).
+    """
+    return hashlib.sha1(normalize_sql(fragment_sql).encode("utf-8")).hexdigest()
+
+
+def _safe_cte_name(key: str) -> str:
+    # 별칭은 넣지 않는다. 쓰는 자리의 별칭은 main 쪽 참조에 남아 있으므로(merge_regex_only가 되살린다)
+    # 같은 서브쿼리는 별칭이 달라도 조각 하나로 한 번만 변환한다.
+    return f"cte__{key[:16]}"
 
 
 def _make_identifier(name: str) -> exp.Identifier:
@@ -273,68 +309,129 @@ def split_long_statement_by_from_join_derived_tables(
     dialect: str,
     max_chars: int,
     min_depth_to_extract: int = 0,
+    count_tokens: Optional[Callable[[str], int]] = None,
+    max_tokens: Optional[int] = None,
+    copy_tree: bool = True,
 ) -> SQLPart:
+    """
+    문장이 한도를 넘으면 FROM/JOIN 파생 테이블을 CTE 조각으로 떼어 낸다.
+    copy_tree=False면 stmt를 복사하지 않고 그 자리에서 바꾼다(호출한 쪽이 stmt를 다시 쓰지 않을 때).
+    count_tokens와 max_tokens를 주면 글자 수 대신 (자리표시자를 되돌린 SQL의) 토큰 수로 잰다.
+
+    깊은 파생 테이블부터 올라가면서, 자기 본문(이미 떼어 낸 안쪽은 CTE 이름으로 바뀐 상태)이
+    한도를 넘는 동안 가장 큰 직계 파생 테이블부터 떼어 낸다. 한도 안에 드는 서브쿼리는
+    바깥 조각에 남기므로 조각 수가 적고 크기가 한도 근처로 고르게 맞춰진다.
+    더 나눌 수 없는데도 한도를 넘는 조각은 meta["oversized"]에 남긴다.
+    파생 테이블마다 한 번만 직렬화하고(serialize_shell), 떼어 낼지는 크기 차이로 판단하므로
+    깊게 중첩된 문장에서도 문장 길이에 비례하는 시간이 든다.
+    """
+    if count_tokens is not None and max_tokens is not None:
+        limit = max_tokens
+
+        def measure(sql: str) -> int:
+            return count_tokens(unmask_placeholders(sql, placeholder_map))
+    else:
+        limit = max_chars
+
+        def measure(sql: str) -> int:
+            return len(normalize_sql(unmask_placeholders(sql, placeholder_map)))
+
     original_sql_masked = normalize_sql(to_sql(stmt, dialect=dialect)) + ";"
+    # 조각들은 모두 이 문장의 일부이므로 이 문장에 있는 마커만 남긴다.
+    placeholder_map = scope_placeholder_map([original_sql_masked], placeholder_map)
+    original_size = measure(original_sql_masked)
 
-    if len(normalize_sql(original_sql_masked)) < max_chars:
+    if original_size <= limit:
         return SQLPart(
             statement_index=statement_index,
-            original_sql=original_sql_masked,
             main_sql=original_sql_masked,
             ctes={},
-            meta={"split": False, "reason": "below_threshold", "extracted": []},
+            meta={"split": False, "reason": "below_threshold", "extracted": [], "sizes": {"main": original_size}},
             placeholder_map=placeholder_map,
         )
 
-    stmt2 = stmt.copy()
+    stmt2 = stmt.copy() if copy_tree else stmt
     query_expr = _get_query_expr(stmt2)
     if query_expr is None:
         return SQLPart(
             statement_index=statement_index,
-            original_sql=original_sql_masked,
             main_sql=original_sql_masked,
             ctes={},
-            meta={"split": False, "reason": "unsupported_statement_type", "extracted": []},
+            meta={
+                "split": False,
+                "reason": "unsupported_statement_type",
+                "extracted": [],
+                "sizes": {"main": original_size},
+                "oversized": ["main"],
+            },
             placeholder_map=placeholder_map,
         )
 
+    # 한 번의 반복 순회로 후보(파생 테이블)와 깊이, 부모, 가장 가까운 바깥 후보(owner)를 함께 모은다.
+    # children[owner]는 그 후보의 직계 자식 후보 목록이고, None은 문장 본문이다.
     targets: List[Tuple[exp.Expression, exp.Expression, int, exp.Expression, Optional[str]]] = []
-    for node, depth, parent in traverse_with_depth(query_expr):
-        if depth < min_depth_to_extract:
-            continue
-        if parent is None or not _parent_is_from_or_join(parent):
-            continue
-
-        info = _derived_info(node)
-        if info is None:
-            continue
-        inner_q, alias_name = info
-        targets.append((node, parent, depth, inner_q, alias_name))
-
-    if not targets:
-        return SQLPart(
-            statement_index=statement_index,
-            original_sql=original_sql_masked,
-            main_sql=original_sql_masked,
-            ctes={},
-            meta={"split": False, "reason": "no_targets", "extracted": []},
-            placeholder_map=placeholder_map,
-        )
-
-    targets.sort(key=lambda t: t[2], reverse=True)
+    children: Dict[Optional[int], List[int]] = {}
+    stack: List[Tuple[exp.Expression, int, Optional[exp.Expression], Optional[int]]] = [(query_expr, 0, None, None)]
+    while stack:
+        node, depth, parent, owner = stack.pop()
+        if depth >= min_depth_to_extract and parent is not None and _parent_is_from_or_join(parent):
+            info = _derived_info(node)
+            if info is not None:
+                inner_q, alias_name = info
+                children.setdefault(owner, []).append(len(targets))
+                owner = len(targets)
+                targets.append((node, parent, depth, inner_q, alias_name))
+        stack.extend((child, depth + 1, node, owner) for child in reversed(_child_expressions(node)))
 
     ctes: Dict[str, str] = {}
+    sizes: Dict[str, int] = {}
     extracted_info = []
-    used = set()
-
-    for node, parent, depth, inner_q, alias_name in targets:
-        inner_sql = normalize_sql(inner_q.sql(dialect=dialect))
-        cte_name = _safe_cte_name(alias_name, inner_sql)
-        while cte_name.lower() in used:
-            cte_name = _safe_cte_name(alias_name, inner_sql)
-        used.add(cte_name.lower())
+    # 후보별 SQL과 크기(떼어 낼 자식은 CTE 이름으로 바꾼 뒤의 값)와, 떼어 냈을 때의 CTE 이름.
+    texts: Dict[int, str] = {}
+    target_sizes: Dict[int, int] = {}
+    cte_names: Dict[int, str] = {}
+
+    def serialize_shell(owner: Optional[int], node: exp.Expression) -> str:
+        """
+        owner의 직계 자식 후보 본문을 잠시 스텁 식별자로 바꿔 node를 직렬화한다.
+        자식 본문은 이미 따로 직렬화했으므로 노드마다 한 번씩만 직렬화하게 된다.
+        """
+        kids = children.get(owner, [])
+        for c in kids:
+            targets[c][0].set("this", exp.to_identifier(f"{SPLIT_STUB_PREFIX}{c}__"))
+        try:
+            return normalize_sql(to_sql(node, dialect=dialect))
+        finally:
+            for c in kids:
+                targets[c][0].set("this", targets[c][3])
+
+    def assemble(shell: str) -> str:
+        """스텁 자리에 떼어 낸 자식은 CTE 이름을, 남긴 자식은 그 SQL을 괄호째 넣는다."""
+
+        def repl(m: re.Match) -> str:
+            c = int(m.group(1))
+            return cte_names[c] if c in cte_names else f"({texts[c]})"
+
+        return RE_SPLIT_STUB.sub(repl, shell)
+
+    def shell_size(owner: Optional[int], shell: str) -> int:
+        """스텁 자리에 자식 SQL이 들어갔을 때의 크기. 글자 수 기준이면 정확하고, 토큰 수 기준이면 근삿값이다."""
+        size = measure(shell)
+        for c in children.get(owner, []):
+            size += measure("()") + target_sizes[c] - measure(f"({SPLIT_STUB_PREFIX}{c}__)")
+        return size
+
+    def extract(i: int) -> int:
+        """후보 i를 CTE로 떼어 내고, 그 자리에 들어간 CTE 이름의 크기를 돌려준다."""
+        node, parent, depth, inner_q, alias_name = targets[i]
+        inner_sql = texts[i]
+        key = fragment_key(unmask_placeholders(inner_sql, placeholder_map))
+        # 같은 문장 안에서 같은 서브쿼리가 다시 나오면 이름이 같으므로 CTE 하나를 함께 쓴다.
+        cte_name = _safe_cte_name(key)
+        cte_names[i] = cte_name
 
         ctes[cte_name] = inner_sql + ";"
+        sizes[cte_name] = measure(inner_sql)
 
         replacement = _make_table(cte_name, alias=alias_name)
         replaced = _replace_child_in_parent(parent, node, replacement)
@@ -342,21 +439,62 @@ def split_long_statement_by_from_join_derived_tables(
         extracted_info.append(
             {
                 "cte_name": cte_name,
+                "fragment_key": key,
                 "alias_name": alias_name,
                 "depth": depth,
                 "parent_type": type(parent).__name__,
                 "replaced": replaced,
             }
         )
-
-    main_sql_masked = normalize_sql(to_sql(stmt2, dialect=dialect)) + ";"
+        return measure(cte_name)
+
+    def shrink(owner: Optional[int], size: int) -> int:
+        """
+        owner가 한도 안에 들 때까지 큰 직계 자식부터 떼어 내고 줄어든 크기를 돌려준다.
+        다시 직렬화하지 않고 "(서브쿼리)"가 CTE 이름으로 바뀐 만큼만 크기에 반영한다.
+        """
+        for c in sorted(children.get(owner, []), key=lambda c: target_sizes[c], reverse=True):
+            if size <= limit:
+                break
+            size += extract(c) - target_sizes[c] - measure("()")
+        return size
+
+    # 깊은 후보부터: 자식 결정이 끝난 뒤에 자기 크기를 잰다.
+    for i in sorted(range(len(targets)), key=lambda i: targets[i][2], reverse=True):
+        shell = serialize_shell(i, targets[i][3])
+        target_sizes[i] = shrink(i, shell_size(i, shell))
+        texts[i] = assemble(shell)
+
+    main_sql_masked = original_sql_masked
+    if children.get(None):
+        shell = serialize_shell(None, stmt2)
+        shrink(None, shell_size(None, shell))
+        main_sql_masked = assemble(shell) + ";"
+    main_size = measure(main_sql_masked)
+    sizes = {"main": main_size, **sizes}
+    oversized = [name for name, size in sizes.items() if size > limit]
+
+    if not ctes:
+        return SQLPart(
+            statement_index=statement_index,
+            main_sql=original_sql_masked,
+            ctes={},
+            meta={"split": False, "reason": "no_targets", "extracted": [], "sizes": sizes, "oversized": oversized},
+            placeholder_map=placeholder_map,
+        )
 
     return SQLPart(
         statement_index=statement_index,
-        original_sql=original_sql_masked,
+        source_sql=original_sql_masked,
         main_sql=main_sql_masked,
         ctes=ctes,
-        meta={"split": True, "reason": "extracted_from_join_derived_tables", "extracted": extracted_info},
+        meta={
+            "split": True,
+            "reason": "extracted_from_join_derived_tables",
+            "extracted": extracted_info,
+            "sizes": sizes,
+            "oversized": oversized,
+        },
         placeholder_map=placeholder_map,
     )
 
@@ -364,8 +502,24 @@ def split_long_statement_by_from_join_derived_tables(
 # -----------------------------
 # Output
 # -----------------------------
-def write_parts(parts: List[SQLPart], out_dir: str, base_name: str, output_masked: bool = False):
+def write_parts(
+    parts: List[SQLPart],
+    out_dir: str,
+    base_name: str,
+    output_masked: bool = False,
+    fragments_dir: Optional[str] = None,
+):
+    """
+    fragments_dir를 주면 CTE 조각을 out_dir 대신 fragments_dir/<cte 이름>.sql에 한 번만 쓰고,
+    manifest의 cte_files는 out_dir 기준 상대 경로로 그 파일을 가리킨다.
+    여러 파일/문장에서 반복되는 서브쿼리는 조각 파일 하나만 변환하면 된다.
+    """
+    if fragments_dir is not None and output_masked:
+        # 가린 SQL의 자리표시자는 실행마다 달라서 다른 manifest와 조각 파일을 공유할 수 없다.
+        raise ValueError("fragments_dir cannot be combined with output_masked")
     os.makedirs(out_dir, exist_ok=True)
+    if fragments_dir is not None:
+        os.makedirs(fragments_dir, exist_ok=True)
     manifest = []
 
     for p in parts:
@@ -381,10 +535,20 @@ def write_parts(parts: List[SQLPart], out_dir: str, base_name: str, output_maske
 
         cte_files = {}
         for cte_name, cte_sql in p.ctes.items():
-            fn = f"{base_name}__{idx}__{cte_name}.sql"
-            with open(os.path.join(out_dir, fn), "w", encoding="utf-8") as f:
-                f.write(maybe_unmask(cte_sql).strip() + "\n")
-            cte_files[cte_name] = fn
+            if fragments_dir is None:
+                path = os.path.join(out_dir, f"{base_name}__{idx}__{cte_name}.sql")
+            else:
+                path = os.path.join(fragments_dir, f"{cte_name}.sql")
+            if fragments_dir is None:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(maybe_unmask(cte_sql).strip() + "\n")
+            elif not os.path.exists(path):
+                # 여러 프로세스가 같은 조각을 동시에 쓸 수 있으므로 임시 파일에 쓴 뒤 바꿔 넣는다.
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(maybe_unmask(cte_sql).strip() + "\n")
+                os.replace(tmp_path, path)
+            cte_files[cte_name] = os.path.relpath(path, out_dir)
 
         manifest.append(
             {
@@ -401,23 +565,123 @@ def write_parts(parts: List[SQLPart], out_dir: str, base_name: str, output_maske
         json.dump(manifest, f, ensure_ascii=False, indent=2)
 
 
-def split_sql_file(
-    input_path: str,
-    out_dir: str,
+def _statement_texts(masked_text: str, dialect: str) -> Optional[List[str]]:
+    """
+    가린 텍스트를 최상위 ';' 토큰으로 나눈 문장 텍스트 목록. parse_statements와 같은 순서로 나오므로
+    i번째 텍스트가 i번째 문장이다(마지막 ';' 뒤의 빈 텍스트는 parse_statements에 없지만 비어 있어 건너뛴다).
+    ';'에 주석이 붙으면 sqlglot이 그 주석을 따로 문장으로 만들어 번호가 어긋나므로 None.
+    """
+    texts: List[str] = []
+    start = 0
+    for token in Dialect.get_or_raise(dialect).tokenize(masked_text):
+        if token.token_type != TokenType.SEMICOLON:
+            continue
+        if token.comments:
+            return None
+        texts.append(masked_text[start:token.start])
+        start = token.end + 1
+    texts.append(masked_text[start:])
+    return texts
+
+
+def _split_statement_cached(
+    statement_sql: str,
+    statement_index: int,
+    cache,
+    dialect: str,
+    max_chars: int,
+    min_depth_to_extract: int,
+    count_tokens: Optional[Callable[[str], int]],
+    max_tokens: Optional[int],
+    tokenizer: Optional[str],
+) -> List[SQLPart]:
+    """
+    원문 문장 하나를 캐시를 거쳐 나눈다. 마커 id를 이 문장의 해시로 정하므로 같은 문장은
+    파일 안의 위치나 다른 문장과 상관없이 같은 키가 된다. 캐시에는 문장 번호 없이 두고 꺼낼 때 붙인다.
+    """
+    from parse_cache import make_parse_key
+
+    run_id = hashlib.sha1(statement_sql.encode("utf-8")).hexdigest()
+    masked, mp = mask_placeholders(statement_sql, run_id=run_id)
+    by_tokens = count_tokens is not None and max_tokens is not None
+    key = make_parse_key(
+        masked,
+        dialect,
+        max_chars,
+        min_depth_to_extract,
+        max_tokens=max_tokens if by_tokens else None,
+        tokenizer=tokenizer if by_tokens else None,
+    )
+    parts = cache.lookup(key)
+    if parts is None:
+        parts = [
+            split_long_statement_by_from_join_derived_tables(
+                stmt=stmt,
+                statement_index=0,
+                placeholder_map=mp,
+                dialect=dialect,
+                max_chars=max_chars,
+                min_depth_to_extract=min_depth_to_extract,
+                count_tokens=count_tokens,
+                max_tokens=max_tokens,
+                copy_tree=False,
+            )
+            for stmt in parse_statements(masked, dialect=dialect)
+            if stmt is not None
+        ]
+        cache.store(key, parts)
+    return [replace(part, statement_index=statement_index) for part in parts]
+
+
+def split_sql_text(
+    sql_text: str,
     dialect: str = DEFAULT_DIALECT,
     max_chars: int = DEFAULT_MAX_CHARS,
     min_depth_to_extract: int = 0,
-    output_masked: bool = False,
-):
-    with open(input_path, "r", encoding="utf-8") as f:
-        original_text = f.read()
+    count_tokens: Optional[Callable[[str], int]] = None,
+    max_tokens: Optional[int] = None,
+    cache=None,
+    tokenizer: Optional[str] = None,
+) -> List[SQLPart]:
+    """
+    파일을 거치지 않고 SQL 텍스트를 문장별 SQLPart(main + CTE 조각)로 나눈다.
+    count_tokens와 max_tokens를 주면 max_chars 대신 토큰 수로 나눈다.
+
+    cache(parse_cache.ParseCache)를 주면 문장마다 가린 텍스트와 분할 설정으로 결과를 찾아 쓰므로,
+    파일에서 한 문장만 고쳐도 나머지 문장은 다시 파싱하지 않는다.
+    토큰 수로 나눌 때는 tokenizer(count_tokens를 만든 토크나이저 이름/경로)도 줘야 캐시를 쓴다.
+    """
+    use_cache = cache is not None and (count_tokens is None or max_tokens is None or tokenizer is not None)
+    masked_text, mp = mask_placeholders(sql_text)
+    _ensure_recursion_limit()
+
+    statement_texts = _statement_texts(masked_text, dialect) if use_cache else None
+    if statement_texts is not None:
+        parts: List[SQLPart] = []
+        for i, text in enumerate(statement_texts, start=1):
+            if not text.strip():
+                continue
+            parts.extend(
+                _split_statement_cached(
+                    unmask_placeholders(text, mp),
+                    statement_index=i,
+                    cache=cache,
+                    dialect=dialect,
+                    max_chars=max_chars,
+                    min_depth_to_extract=min_depth_to_extract,
+                    count_tokens=count_tokens,
+                    max_tokens=max_tokens,
+                    tokenizer=tokenizer,
+                )
+            )
+        return parts
 
-    masked_text, mp = mask_placeholders(original_text)
     stmts = parse_statements(masked_text, dialect=dialect)
 
-    base = os.path.splitext(os.path.basename(input_path))[0]
-    parts: List[SQLPart] = []
+    parts = []
     for i, stmt in enumerate(stmts, start=1):
+        if stmt is None:
+            continue
         parts.append(
             split_long_statement_by_from_join_derived_tables(
                 stmt=stmt,
@@ -426,10 +690,55 @@ def split_sql_file(
                 dialect=dialect,
                 max_chars=max_chars,
                 min_depth_to_extract=min_depth_to_extract,
+                count_tokens=count_tokens,
+                max_tokens=max_tokens,
+                # 방금 파싱한 트리는 여기서만 쓰므로 복사하지 않고 그 자리에서 나눈다.
+                copy_tree=False,
             )
         )
+    return parts
 
-    write_parts(parts, out_dir=out_dir, base_name=base, output_masked=output_masked)
+
+def split_sql_file(
+    input_path: str,
+    out_dir: str,
+    dialect: str = DEFAULT_DIALECT,
+    max_chars: int = DEFAULT_MAX_CHARS,
+    min_depth_to_extract: int = 0,
+    output_masked: bool = False,
+    fragments_dir: Optional[str] = None,
+    count_tokens: Optional[Callable[[str], int]] = None,
+    max_tokens: Optional[int] = None,
+    cache=None,
+    tokenizer: Optional[str] = None,
+):
+    with open(input_path, "r", encoding="utf-8") as f:
+        original_text = f.read()
+
+    parts = split_sql_text(
+        original_text,
+        dialect=dialect,
+        max_chars=max_chars,
+        min_depth_to_extract=min_depth_to_extract,
+        count_tokens=count_tokens,
+        max_tokens=max_tokens,
+        cache=cache,
+        tokenizer=tokenizer,
+    )
+    base = os.path.splitext(os.path.basename(input_path))[0]
+    write_parts(parts, out_dir=out_dir, base_name=base, output_masked=output_masked, fragments_dir=fragments_dir)
+
+
+def load_token_counter(tokenizer_path: str) -> Callable[[str], int]:
+    """모델/토크나이저 경로로 SQL 토큰 수를 세는 함수를 만든다(transformers는 이때만 불러온다)."""
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+
+    def count_tokens(text: str) -> int:
+        return len(tokenizer(text, add_special_tokens=False).input_ids)
+
+    return count_tokens
 
 
 if __name__ == "__main__":
@@ -442,8 +751,24 @@ if __name__ == "__main__":
     parser.add_argument("--max_chars", type=int, default=DEFAULT_MAX_CHARS)
     parser.add_argument("--min_depth", type=int, default=2)
     parser.add_argument("--output_masked", action="store_true")
+    parser.add_argument("--fragments_dir", default=None, help="반복되는 CTE 조각을 한 번만 저장할 공용 폴더")
+    parser.add_argument("--max_tokens", type=int, default=None, help="조각당 SQL 토큰 한도(--tokenizer와 함께 쓰면 --max_chars 대신 사용)")
+    parser.add_argument("--tokenizer", default=None, help="토큰 수를 셀 모델/토크나이저 경로")
+    parser.add_argument("--cache", default=None, help="분할 결과를 재사용할 SQLite 파일(parse_cache)")
     args = parser.parse_args()
 
+    cache = None
+    if args.cache:
+        from parse_cache import ParseCache
+
+        cache = ParseCache(args.cache)
+
+    count_tokens = None
+    if args.max_tokens is not None:
+        if args.tokenizer is None:
+            parser.error("--max_tokens requires --tokenizer")
+        count_tokens = load_token_counter(args.tokenizer)
+
     split_sql_file(
         args.input,
         args.out_dir,
@@ -451,4 +776,9 @@ if __name__ == "__main__":
         max_chars=args.max_chars,
         min_depth_to_extract=args.min_depth,
         output_masked=args.output_masked,
+        fragments_dir=args.fragments_dir,
+        count_tokens=count_tokens,
+        max_tokens=args.max_tokens,
+        cache=cache,
+        tokenizer=args.tokenizer,
     )
\ No newline at end of file
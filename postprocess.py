@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import json
+import re
+
+# 검증 출력에서 {"result": ..., "reason": ...} 형태의 JSON 객체 후보
+RE_VERDICT_OBJECT = re.compile(r"\{[^{}]*\}", re.DOTALL)
+
+
+def clean_response_text(text: str) -> str:
+    if not text:
+        return text
+    cleaned = text.lstrip("\ufeff").lstrip()
+    cleaned = re.sub(r"^(?:\\n)+", "", cleaned)
+    cleaned = cleaned.lstrip("\n")
+    cleaned = re.sub(r"(?i)^\s*assistant[:\s]*", "", cleaned)
+    cleaned = re.sub(r"^[^A-Za-z0-9_]+", "", cleaned)
+    return cleaned
+
+
+class StatementScanner:
+    """
+    SQL 텍스트를 조각 단위로 받아 문자열/인용 식별자/주석 밖에 있는 ';'(문장 끝)의 개수를 센다.
+    생성 중인 출력에 조각을 이어 넣을 수 있도록 상태를 유지한다.
+    """
+
+    def __init__(self) -> None:
+        self.terminators = 0
+        # 마지막 ';' 이후에 주석이 아닌 SQL 내용이 있었는지(= 끝나지 않은 문장이 있는지)
+        self.pending = False
+        self._state = "code"  # code | single | double | line_comment | block_comment
+        self._prev = ""
+        self._pending_before_prev = False
+
+    def feed(self, text: str) -> None:
+        for ch in text:
+            state = self._state
+            pending_before = self.pending
+            if state == "code":
+                if ch == ";":
+                    self.terminators += 1
+                    self.pending = False
+                elif ch == "-" and self._prev == "-":
+                    self._state = "line_comment"
+                    self.pending = self._pending_before_prev
+                elif ch == "*" and self._prev == "/":
+                    self._state = "block_comment"
+                    self.pending = self._pending_before_prev
+                    ch = ""  # "/*/"를 주석 종료로 보지 않도록 직전 문자를 비운다.
+                elif not ch.isspace():
+                    self.pending = True
+                    if ch == "'":
+                        self._state = "single"
+                    elif ch == '"':
+                        self._state = "double"
+            elif state == "single" and ch == "'":
+                self._state = "code"
+            elif state == "double" and ch == '"':
+                self._state = "code"
+            elif state == "line_comment" and ch == "\n":
+                self._state = "code"
+            elif state == "block_comment" and ch == "/" and self._prev == "*":
+                self._state = "code"
+                ch = ""
+            self._pending_before_prev = pending_before
+            self._prev = ch
+
+
+def count_statements(sql: str) -> int:
+    """입력 SQL의 문장 수. 마지막 문장에 ';'가 없어도 1개로 센다."""
+    scanner = StatementScanner()
+    scanner.feed(sql)
+    return scanner.terminators + (1 if scanner.pending else 0)
+
+
+def truncate_at_stop_strings(text: str, stop_strings: tuple[str, ...] | list[str]) -> str:
+    """가장 먼저 나오는 stop string부터 뒤를 잘라낸다."""
+    cut = len(text)
+    for stop in stop_strings:
+        index = text.find(stop)
+        if index != -1:
+            cut = min(cut, index)
+    return text[:cut]
+
+
+def parse_verdict(text: str) -> dict | None:
+    """
+    검증 출력에서 첫 번째 {"result": "0"|"1", "reason": ...} 객체를 꺼낸다.
+    result는 문자열 "0"(정상)/"1"(오류)로 맞추고, 찾지 못하면 None.
+    """
+    for match in RE_VERDICT_OBJECT.finditer(text or ""):
+        try:
+            payload = json.loads(match.group(0))
+        except json.JSONDecodeError:
+            continue
+        if not isinstance(payload, dict) or "result" not in payload:
+            continue
+        result = str(payload["result"]).strip()
+        if result not in ("0", "1"):
+            continue
+        return {"result": result, "reason": str(payload.get("reason") or "")}
+    return None
@@ -1,61 +1,481 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import copy
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Iterator
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    DynamicCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextStreamer,
+)
 
+from generation import GenerationConfig, GenerationOutput
+from postprocess import StatementScanner, truncate_at_stop_strings
 
+__all__ = ["GenerationConfig", "GenerationOutput", "QwenSqlEncoder"]
 
-@dataclass(frozen=True)
-class GenerationConfig:
-    max_new_tokens: int = 1024
-    temperature: float = 0.1
-    top_p: float = 0.8
-    do_sample: bool = True
-    user_prompt: str | None = None
-    system_prompt: str | None = None
+
+class _CallbackStreamer(TextStreamer):
+    """디코딩된 텍스트 조각을 콜백으로 넘긴다(프롬프트 토큰은 건너뜀)."""
+
+    def __init__(self, tokenizer, on_text: Callable[[str], None]) -> None:
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.on_text = on_text
+
+    def on_finalized_text(self, text: str, stream_end: bool = False) -> None:
+        if text:
+            self.on_text(text)
+
+
+class _StopEventCriteria(StoppingCriteria):
+    """행별 threading.Event가 set되면 다음 디코드 스텝에서 해당 행의 생성을 멈춘다."""
+
+    def __init__(self, stop_events: list[threading.Event | None]) -> None:
+        self.stop_events = stop_events
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        flags = [event is not None and event.is_set() for event in self.stop_events]
+        return torch.tensor(flags, dtype=torch.bool, device=input_ids.device)
+
+
+class _SqlStopCriteria(StoppingCriteria):
+    """
+    행별 출력 토큰 한도(입력 길이 기반 예산)와 문장 종료(';' 개수)를 검사한다.
+    매 스텝 새로 생성된 토큰만 디코딩해 StatementScanner에 이어 넣는다.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_length: int,
+        token_limits: list[int],
+        expected_statements: list[int | None],
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.token_limits = token_limits
+        self.expected_statements = expected_statements
+        self.scanners = [StatementScanner() if expected else None for expected in expected_statements]
+        self.consumed = [prompt_length] * len(token_limits)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        generated = input_ids.shape[1] - self.prompt_length
+        flags = []
+        for row, (limit, expected, scanner) in enumerate(
+            zip(self.token_limits, self.expected_statements, self.scanners)
+        ):
+            done = generated >= limit
+            if scanner is not None and not done:
+                new_ids = input_ids[row, self.consumed[row]:]
+                scanner.feed(self.tokenizer.decode(new_ids, skip_special_tokens=True))
+                self.consumed[row] = input_ids.shape[1]
+                done = scanner.terminators >= expected
+            flags.append(done)
+        return torch.tensor(flags, dtype=torch.bool, device=input_ids.device)
+
+
+class _ForwardCounter:
+    """
+    model.forward 호출을 세어 디코드 스텝과 후보 토큰 검증량을 기록한다.
+    첫 호출은 prefill이고, 이후 호출의 입력 길이 - 1이 그 스텝에서 검증한 후보 토큰 수다.
+    """
+
+    def __init__(self) -> None:
+        self.forward_passes = 0
+        self.proposed_tokens = 0
+        # 두 번째 forward가 시작된 시각 = prefill(첫 토큰 생성)이 끝난 시각
+        self.prefill_done_at: float | None = None
+
+    def __call__(self, module, args, kwargs) -> None:
+        input_ids = kwargs.get("input_ids")
+        if input_ids is None and args:
+            input_ids = args[0]
+        if self.forward_passes == 1:
+            self.prefill_done_at = time.perf_counter()
+        if self.forward_passes > 0 and input_ids is not None:
+            self.proposed_tokens += max(int(input_ids.shape[1]) - 1, 0)
+        self.forward_passes += 1
+
+    def stats(self, output_tokens: int) -> dict:
+        # 한 번의 forward는 검증된 후보 외에 자기 토큰 1개를 만든다. 나머지가 받아들여진 후보다.
+        accepted = max(output_tokens - self.forward_passes, 0)
+        return {
+            "forward_passes": self.forward_passes,
+            "proposed_tokens": self.proposed_tokens,
+            "accepted_tokens": accepted,
+            "acceptance_rate": accepted / self.proposed_tokens if self.proposed_tokens else 0.0,
+            "tokens_per_forward": output_tokens / self.forward_passes if self.forward_passes else 0.0,
+        }
+
+
+@contextmanager
+def _count_forwards(model: torch.nn.Module | None) -> Iterator[_ForwardCounter]:
+    counter = _ForwardCounter()
+    if model is None:
+        yield counter
+        return
+    handle = model.register_forward_pre_hook(counter, with_kwargs=True)
+    try:
+        yield counter
+    finally:
+        handle.remove()
 
 
 class QwenSqlEncoder:
-    def __init__(self, model_name: str) -> None:
+    def __init__(
+        self,
+        model_name: str,
+        prefix_cache_size: int = 4,
+        draft_model_name: str | None = None,
+        dtype: torch.dtype = torch.bfloat16,
+        device_map: str | dict = "auto",
+    ) -> None:
         self.model_name = model_name
+        # 로딩 단계별 소요 시간(초)
+        self.load_timings: dict[str, float] = {}
+
+        started = time.perf_counter()
         self.model = AutoModelForCausalLM.from_pretrained(
             model_name,
-            dtype=torch.bfloat16,
-            device_map="auto",
+            dtype=dtype,
+            device_map=device_map,
+        )
+        self.load_timings["model_load_s"] = time.perf_counter() - started
+
+        # 같은 토크나이저를 쓰는 작은 Qwen 계열 모델. use_draft_model 요청에서 후보 토큰을 제안한다.
+        self.draft_model_name = draft_model_name
+        self.draft_model = None
+        if draft_model_name:
+            started = time.perf_counter()
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_name,
+                dtype=dtype,
+                device_map=device_map,
+            )
+            self.load_timings["draft_model_load_s"] = time.perf_counter() - started
+
+        # 배치 생성 시 프롬프트 끝이 정렬되도록 왼쪽 패딩을 사용한다.
+        started = time.perf_counter()
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side="left")
+        self.load_timings["tokenizer_load_s"] = time.perf_counter() - started
+        # fast tokenizer는 padding 설정을 내부 상태로 바꾸므로 여러 스레드에서 동시에 인코딩하지 않는다.
+        self._tokenizer_lock = threading.Lock()
+        # 시스템 프롬프트(few-shot 포함) 텍스트 -> (prefix 토큰, prefill된 KV-cache)
+        self.prefix_cache_size = prefix_cache_size
+        self._prefix_cache: OrderedDict[str, tuple[torch.Tensor, DynamicCache]] = OrderedDict()
+
+    def _render(self, config: GenerationConfig) -> str:
+        message = [
+            {"role": "system", "content": config.system_prompt},
+            {"role": "user", "content": config.user_prompt},
+        ]
+        return self.tokenizer.apply_chat_template(
+            message,
+            tokenize=False,
+            add_generation_prompt=True,
         )
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    def count_tokens(self, config: GenerationConfig) -> int:
+        """채팅 템플릿까지 적용한 프롬프트의 토큰 수."""
+        text = self._render(config)
+        with self._tokenizer_lock:
+            return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def count_text_tokens(self, text: str) -> int:
+        """채팅 템플릿 없이 텍스트만 토큰화한 길이."""
+        with self._tokenizer_lock:
+            return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def token_budget(self, question: str, config: GenerationConfig) -> int:
+        """output_budget_ratio가 있으면 입력 SQL 길이에 비례한 출력 토큰 한도를 쓴다."""
+        if config.output_budget_ratio is None:
+            return config.max_new_tokens
+        return config.token_budget(self.count_text_tokens(question))
+
+    def _split_system_prefix(self, config: GenerationConfig) -> tuple[str, str] | None:
+        """렌더링된 프롬프트를 시스템 프롬프트 구간과 나머지(유저 구간 + generation prompt)로 나눈다."""
+        if not config.system_prompt:
+            return None
+        text = self._render(config)
+        prefix = self.tokenizer.apply_chat_template(
+            [{"role": "system", "content": config.system_prompt}],
+            tokenize=False,
+        )
+        if not text.startswith(prefix) or len(prefix) == len(text):
+            return None
+        return prefix, text[len(prefix):]
+
+    def _get_prefix_cache(self, prefix: str) -> tuple[torch.Tensor, DynamicCache]:
+        """시스템 프롬프트 구간을 한 번만 prefill하고, 프롬프트 내용이 같으면 재사용한다."""
+        entry = self._prefix_cache.get(prefix)
+        if entry is not None:
+            self._prefix_cache.move_to_end(prefix)
+            return entry
+
+        with self._tokenizer_lock:
+            prefix_ids = self.tokenizer(prefix, return_tensors="pt", add_special_tokens=False).input_ids
+        prefix_ids = prefix_ids.to(self.model.device)
+        with torch.no_grad():
+            past_key_values = self.model(input_ids=prefix_ids, use_cache=True).past_key_values
+        entry = (prefix_ids[0], past_key_values)
+        self._prefix_cache[prefix] = entry
+        while len(self._prefix_cache) > self.prefix_cache_size:
+            self._prefix_cache.popitem(last=False)
+        return entry
+
+    def _build_inputs(self, configs: list[GenerationConfig]) -> dict:
+        """
+        배치 전체가 같은 시스템 프롬프트를 쓰면 [prefix | 왼쪽 패딩 | 유저 구간] 형태로 입력을 만들고
+        캐시된 prefix KV를 배치 크기만큼 복제해 넘긴다. 그래서 유저 구간만 prefill된다.
+        """
+        device = self.model.device
+        splits = [self._split_system_prefix(config) for config in configs]
+        if self.prefix_cache_size > 0 and all(splits) and len({prefix for prefix, _ in splits}) == 1:
+            prefix_ids, past_key_values = self._get_prefix_cache(splits[0][0])
+            with self._tokenizer_lock:
+                suffix = self.tokenizer(
+                    [suffix for _, suffix in splits],
+                    return_tensors="pt",
+                    padding=True,
+                    add_special_tokens=False,
+                ).to(device)
+            prefix_block = prefix_ids.unsqueeze(0).expand(len(configs), -1)
+            # generate가 캐시를 확장하므로 원본은 두고 복사본을 넘긴다.
+            past_key_values = copy.deepcopy(past_key_values)
+            past_key_values.batch_repeat_interleave(len(configs))
+            return {
+                "input_ids": torch.cat([prefix_block, suffix.input_ids], dim=1),
+                "attention_mask": torch.cat([torch.ones_like(prefix_block), suffix.attention_mask], dim=1),
+                "past_key_values": past_key_values,
+            }
+
+        texts = [self._render(config) for config in configs]
+        with self._tokenizer_lock:
+            model_inputs = self.tokenizer(texts, return_tensors="pt", padding=True).to(device)
+        return {"input_ids": model_inputs.input_ids, "attention_mask": model_inputs.attention_mask}
 
     def generate(self, question: str, config: GenerationConfig | None = None) -> str:
         if config is None:
             config = GenerationConfig()
+        return self.generate_batch([question], [config])[0].text
 
-        system_prompt = config.system_prompt
-        user_prompt = config.user_prompt
-        message = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ]
+    def generate_batch(
+        self,
+        questions: list[str],
+        configs: list[GenerationConfig],
+        on_text: Callable[[str], None] | None = None,
+        stop_events: list[threading.Event | None] | None = None,
+    ) -> list[GenerationOutput]:
+        """
+        batch_key()가 같은 요청들을 왼쪽 패딩해 한 번의 model.generate로 처리한다.
+        요청별 출력 토큰 한도(token_budget) 중 최댓값으로 생성하고, 한도에 도달한 행은 멈춘 뒤 잘라낸다.
+        stop_strings가 나오거나 expected_statements만큼 문장이 끝나면 해당 행은 일찍 멈춘다.
 
-        text = self.tokenizer.apply_chat_template(
-            message,
+        on_text를 주면 디코딩되는 텍스트를 토큰 단위로 흘려보낸다(요청 1건일 때만 가능).
+        stop_events의 Event가 set된 행은 다음 디코드 스텝에서 생성을 멈춘다.
+        """
+        if len(questions) != len(configs):
+            raise ValueError("questions and configs must have the same length")
+        if not configs:
+            return []
+        head = configs[0]
+        if any(config.batch_key() != head.batch_key() for config in configs):
+            raise ValueError("configs in one batch must share the same batch_key()")
+        if on_text is not None and len(configs) != 1:
+            raise ValueError("streaming is only supported for a single request")
+        if not head.batchable and len(configs) != 1:
+            raise ValueError(f"{head.decode_mode} decoding is only supported for a single request")
+
+        tokenize_started = time.perf_counter()
+        model_inputs = self._build_inputs(configs)
+        tokenize_s = time.perf_counter() - tokenize_started
+        outputs, _ = self._generate(questions, configs, model_inputs, tokenize_s, on_text, stop_events)
+        return outputs
+
+    def _generate(
+        self,
+        questions: list[str],
+        configs: list[GenerationConfig],
+        model_inputs: dict,
+        tokenize_s: float,
+        on_text: Callable[[str], None] | None = None,
+        stop_events: list[threading.Event | None] | None = None,
+    ) -> tuple[list[GenerationOutput], tuple[list[torch.Tensor], DynamicCache]]:
+        """
+        model_inputs로 model.generate를 실행해 행별 출력을 만든다.
+        행별 생성 토큰(패딩 제외)과 generate가 채운 KV-cache도 함께 돌려준다(대화를 이어 갈 때 사용).
+        """
+        head = configs[0]
+        prompt_length = model_inputs["input_ids"].shape[1]
+        token_limits = [self.token_budget(question, config) for question, config in zip(questions, configs)]
+        streamer = _CallbackStreamer(self.tokenizer, on_text) if on_text is not None else None
+        stopping_criteria = StoppingCriteriaList()
+        if stop_events is not None and any(event is not None for event in stop_events):
+            stopping_criteria.append(_StopEventCriteria(stop_events))
+        expected_statements = [config.expected_statements for config in configs]
+        if len(set(token_limits)) > 1 or any(expected_statements):
+            stopping_criteria.append(
+                _SqlStopCriteria(self.tokenizer, prompt_length, token_limits, expected_statements)
+            )
+
+        decode_kwargs = {}
+        if head.stop_strings:
+            decode_kwargs["stop_strings"] = list(head.stop_strings)
+            decode_kwargs["tokenizer"] = self.tokenizer
+        if head.prompt_lookup_num_tokens is not None:
+            decode_kwargs["prompt_lookup_num_tokens"] = head.prompt_lookup_num_tokens
+        if head.use_draft_model:
+            if self.draft_model is None:
+                raise ValueError("draft model is not configured")
+            decode_kwargs["assistant_model"] = self.draft_model
+
+        generate_started = time.perf_counter()
+        with _count_forwards(self.model) as counter, _count_forwards(self.draft_model) as draft_counter:
+            generated = self.model.generate(
+                **model_inputs,
+                **decode_kwargs,
+                streamer=streamer,
+                stopping_criteria=stopping_criteria,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+                max_new_tokens=max(token_limits),
+                temperature=head.temperature,
+                top_p=head.top_p,
+                do_sample=head.do_sample,
+                return_dict_in_generate=True,
+            )
+        generate_finished = time.perf_counter()
+        prefill_done_at = counter.prefill_done_at or generate_finished
+        timings = {
+            "tokenize_s": tokenize_s,
+            "prefill_s": prefill_done_at - generate_started,
+            "decode_s": generate_finished - prefill_done_at,
+        }
+
+        # 왼쪽 패딩이므로 모든 행의 생성 토큰은 같은 위치에서 시작한다.
+        outputs = []
+        generated_rows = []
+        for row, attention_mask, config, limit in zip(
+            generated.sequences, model_inputs["attention_mask"], configs, token_limits
+        ):
+            new_ids = row[prompt_length:][:limit]
+            new_ids = new_ids[new_ids != self.tokenizer.pad_token_id]
+            generated_rows.append(new_ids)
+            output_tokens = int(new_ids.shape[0])
+            stats = {"decode_mode": head.decode_mode, "batch_size": len(configs), "token_budget": limit, **timings}
+            if not head.batchable:
+                stats.update(counter.stats(output_tokens))
+            if head.use_draft_model:
+                stats["draft_forward_passes"] = draft_counter.forward_passes
+            text = self.tokenizer.decode(new_ids, skip_special_tokens=True)
+            outputs.append(
+                GenerationOutput(
+                    text=truncate_at_stop_strings(text, config.stop_strings),
+                    input_tokens=int(attention_mask.sum()),
+                    output_tokens=output_tokens,
+                    stats=stats,
+                )
+            )
+        return outputs, (generated_rows, generated.past_key_values)
+
+    def _follow_up_inputs(
+        self,
+        first_config: GenerationConfig,
+        first_inputs: dict,
+        answer_ids: torch.Tensor,
+        answer_text: str,
+        past_key_values: DynamicCache | None,
+        follow_up: str,
+    ) -> tuple[dict, int]:
+        """
+        [system, user, assistant(answer_text), user(follow_up)] 대화의 입력을 만든다.
+        첫 턴의 프롬프트 토큰과 생성 토큰을 그대로 앞에 두고 KV-cache를 이어 쓰면
+        뒤에 붙는 꼬리(턴 종료 + 후속 질문)만 prefill된다. 재사용한 토큰 수도 돌려준다.
+        """
+        first_text = self._render(first_config)
+        full_text = self.tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": first_config.system_prompt},
+                {"role": "user", "content": first_config.user_prompt},
+                {"role": "assistant", "content": answer_text},
+                {"role": "user", "content": follow_up},
+            ],
             tokenize=False,
             add_generation_prompt=True,
         )
-        model_inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
-
-        generated_ids = self.model.generate(
-            **model_inputs,
-            pad_token_id=self.tokenizer.pad_token_id,
-            eos_token_id=self.tokenizer.eos_token_id,
-            max_new_tokens=config.max_new_tokens,
-            temperature=config.temperature,
-            top_p=config.top_p,
-            do_sample=config.do_sample,
+        # 생성 토큰 중 answer_text(stop string에서 잘린 결과)에 해당하는 앞부분만 남긴다.
+        special_ids = set(self.tokenizer.all_special_ids)
+        keep = int(answer_ids.shape[0])
+        while keep > 0 and (
+            int(answer_ids[keep - 1]) in special_ids
+            or len(self.tokenizer.decode(answer_ids[:keep], skip_special_tokens=True)) > len(answer_text)
+        ):
+            keep -= 1
+        kept_text = self.tokenizer.decode(answer_ids[:keep], skip_special_tokens=True)
+        prefix_text = first_text + answer_text
+        device = self.model.device
+        if past_key_values is not None and kept_text == answer_text and full_text.startswith(prefix_text):
+            with self._tokenizer_lock:
+                tail_ids = self.tokenizer(
+                    full_text[len(prefix_text):], return_tensors="pt", add_special_tokens=False
+                ).input_ids.to(device)
+            input_ids = torch.cat([first_inputs["input_ids"][0], answer_ids[:keep].to(device), tail_ids[0]]).unsqueeze(0)
+            reused = min(past_key_values.get_seq_length(), first_inputs["input_ids"].shape[1] + keep)
+            past_key_values.crop(reused)
+            return {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+                "past_key_values": past_key_values,
+            }, reused
+        # 채팅 템플릿이 답변을 가공하는 등 토큰을 이어 붙일 수 없으면 대화 전체를 새로 prefill한다.
+        with self._tokenizer_lock:
+            model_inputs = self.tokenizer(full_text, return_tensors="pt", add_special_tokens=False).to(device)
+        return {"input_ids": model_inputs.input_ids, "attention_mask": model_inputs.attention_mask}, 0
+
+    def convert_and_verify(
+        self,
+        question: str,
+        convert_config: GenerationConfig,
+        verify_config: GenerationConfig,
+        stop_event: threading.Event | None = None,
+    ) -> tuple[GenerationOutput, GenerationOutput]:
+        """
+        변환 후 같은 대화에 검증 질문(verify_config.user_prompt)을 이어 붙여 검증까지 한 번에 실행한다.
+        변환 턴에서 prefill/생성한 KV-cache를 그대로 이어 쓰므로 Oracle SQL과 변환 결과를 다시 prefill하지 않는다.
+        verify_config의 system_prompt는 쓰지 않는다(대화는 변환 시스템 프롬프트를 유지).
+        """
+        if not convert_config.batchable:
+            raise ValueError(f"{convert_config.decode_mode} decoding is not supported for convert_and_verify")
+        stop_events = [stop_event]
+        tokenize_started = time.perf_counter()
+        first_inputs = self._build_inputs([convert_config])
+        tokenize_s = time.perf_counter() - tokenize_started
+        (conversion,), ((answer_ids,), past_key_values) = self._generate(
+            [question], [convert_config], first_inputs, tokenize_s, stop_events=stop_events
         )
-        generated_ids = [
-            output_ids[len(input_ids):]
-            for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-        ]
-        return self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+        if stop_event is not None and stop_event.is_set():
+            return conversion, GenerationOutput(text="", input_tokens=0, output_tokens=0)
+
+        tokenize_started = time.perf_counter()
+        verify_inputs, reused = self._follow_up_inputs(
+            convert_config,
+            first_inputs,
+            answer_ids,
+            conversion.text,
+            past_key_values,
+            verify_config.user_prompt or "",
+        )
+        tokenize_s = time.perf_counter() - tokenize_started
+        (verdict,), _ = self._generate(
+            [question], [verify_config], verify_inputs, tokenize_s, stop_events=stop_events
+        )
+        verdict.stats["reused_prefix_tokens"] = reused
+        return conversion, verdict
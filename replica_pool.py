@@ -0,0 +1,508 @@
+from __future__ import annotations
+
+import itertools
+import math
+import multiprocessing
+import os
+import pickle
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable
+
+from backends import TokenCounter
+from generation import GenerationConfig, GenerationOutput
+
+# 대기 토큰 부하는 라우팅할 때마다 토큰화하지 않도록 글자 수로 어림한다.
+CHARS_PER_TOKEN = 4
+# 취소 신호를 워커로 넘기기 위해 결과를 기다리며 stop_events를 확인하는 주기(초)
+CANCEL_POLL_S = 0.05
+# 워커에서 호출할 수 있는 백엔드 메서드
+REPLICA_METHODS = ("generate_batch", "convert_and_verify", "count_tokens", "count_text_tokens", "token_budget")
+
+
+class ReplicaError(RuntimeError):
+    """워커 프로세스가 죽었거나 재시작되어 요청을 끝내지 못함."""
+
+
+def estimate_tokens(text: str | None) -> int:
+    return math.ceil(len(text or "") / CHARS_PER_TOKEN)
+
+
+def estimate_load(question: str, config: GenerationConfig) -> int:
+    """요청 하나의 대기 토큰 부하(프롬프트 토큰 + 출력 토큰 한도) 어림값."""
+    prompt_tokens = estimate_tokens(config.system_prompt) + estimate_tokens(config.user_prompt)
+    return prompt_tokens + config.token_budget(estimate_tokens(question))
+
+
+def _picklable(exc: BaseException) -> BaseException:
+    try:
+        pickle.dumps(exc)
+        return exc
+    except Exception:  # noqa: BLE001
+        return RuntimeError(f"{type(exc).__name__}: {exc}")
+
+
+def _replica_main(conn, backend: str, options: dict, env: dict[str, str], threads: int) -> None:
+    """
+    워커 프로세스 본체. 백엔드를 만든 뒤 요청을 하나씩 실행한다.
+    별도 스레드가 연결을 읽어서 실행 중에도 ping과 취소를 바로 처리한다.
+    """
+    # CUDA_VISIBLE_DEVICES, OMP_NUM_THREADS 등은 torch를 import하기 전에 정해야 한다.
+    os.environ.update(env)
+    from backends import create_backend
+
+    send_lock = threading.Lock()
+
+    def send(message: tuple) -> None:
+        with send_lock:
+            conn.send(message)
+
+    try:
+        started = time.perf_counter()
+        encoder = create_backend(backend, **options)
+        if threads and "torch" in sys.modules:
+            sys.modules["torch"].set_num_threads(threads)
+        timings = dict(encoder.load_timings, backend_load_s=time.perf_counter() - started)
+    except BaseException as exc:  # noqa: BLE001
+        send(("failed", _picklable(exc)))
+        return
+    send(("ready", encoder.model_name, timings))
+
+    jobs: queue.Queue = queue.Queue()
+    cancels: dict[int, list[threading.Event]] = {}
+
+    def read() -> None:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                jobs.put(None)
+                return
+            kind = message[0]
+            if kind == "ping":
+                send(("pong",))
+            elif kind == "cancel":
+                _, request_id, row = message
+                events = cancels.get(request_id)
+                if events is not None:
+                    events[row].set()
+            elif kind == "call":
+                _, request_id, method, args = message
+                # 실행 전에 도착한 취소도 받을 수 있게 읽는 쪽에서 Event를 만든다.
+                if method == "generate_batch":
+                    cancels[request_id] = [threading.Event() for _ in args[1]]
+                elif method == "convert_and_verify":
+                    cancels[request_id] = [threading.Event()]
+                jobs.put(message)
+            elif kind == "stop":
+                jobs.put(None)
+                return
+
+    threading.Thread(target=read, name="replica-reader", daemon=True).start()
+    while (message := jobs.get()) is not None:
+        _, request_id, method, args = message
+        try:
+            if method == "generate_batch":
+                questions, configs, stream = args
+                on_text = (lambda chunk, rid=request_id: send(("text", rid, chunk))) if stream else None
+                result = encoder.generate_batch(
+                    questions, configs, on_text=on_text, stop_events=cancels[request_id]
+                )
+            elif method == "convert_and_verify":
+                result = encoder.convert_and_verify(*args, stop_event=cancels[request_id][0])
+            else:
+                result = getattr(encoder, method)(*args)
+            send(("result", request_id, result))
+        except Exception as exc:  # noqa: BLE001
+            send(("error", request_id, _picklable(exc)))
+        finally:
+            cancels.pop(request_id, None)
+
+
+class Replica:
+    """워커 프로세스 하나와 그 연결. 요청별 Future와 스트리밍 콜백을 관리한다."""
+
+    def __init__(
+        self,
+        index: int,
+        backend: str,
+        options: dict,
+        env: dict[str, str],
+        threads: int,
+        context,
+        on_state_change: Callable[[], None],
+    ) -> None:
+        self.index = index
+        self.backend = backend
+        self.options = options
+        self.env = env
+        self.threads = threads
+        self.context = context
+        self.on_state_change = on_state_change
+        self.state = "stopped"  # starting | ready | failed | dead | stopped
+        self.error: BaseException | None = None
+        self.model_name = backend
+        self.load_timings: dict[str, float] = {}
+        self.restarts = 0
+        self.started_at = 0.0
+        self.last_pong = 0.0
+        self._lock = threading.Lock()
+        self._pending: dict[int, tuple[Future, Callable[[str], None] | None]] = {}
+        self._request_ids = itertools.count()
+        self._conn = None
+        self._process = None
+
+    def start(self) -> None:
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=_replica_main,
+            args=(child_conn, self.backend, self.options, self.env, self.threads),
+            name=f"replica-{self.index}",
+            daemon=True,
+        )
+        self.state = "starting"
+        self.error = None
+        self.started_at = time.monotonic()
+        process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        self._process = process
+        threading.Thread(
+            target=self._read, args=(parent_conn,), name=f"replica-{self.index}-reader", daemon=True
+        ).start()
+
+    @property
+    def alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def _read(self, conn) -> None:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == "ready":
+                _, self.model_name, self.load_timings = message
+                self.last_pong = time.monotonic()
+                self.state = "ready"
+                self.on_state_change()
+            elif kind == "failed":
+                self.error = message[1]
+                self.state = "failed"
+                self.on_state_change()
+            elif kind == "pong":
+                self.last_pong = time.monotonic()
+            elif kind == "text":
+                _, request_id, chunk = message
+                with self._lock:
+                    entry = self._pending.get(request_id)
+                if entry is not None and entry[1] is not None:
+                    entry[1](chunk)
+            elif kind in ("result", "error"):
+                _, request_id, value = message
+                with self._lock:
+                    entry = self._pending.pop(request_id, None)
+                if entry is None:
+                    continue
+                if kind == "result":
+                    entry[0].set_result(value)
+                else:
+                    entry[0].set_exception(value)
+        # 재시작 전 연결이 닫힌 경우는 stop()이 이미 정리했으므로 새 프로세스의 요청을 건드리지 않는다.
+        if conn is not self._conn:
+            return
+        if self.state in ("starting", "ready"):
+            self.state = "dead"
+        self._fail_pending(ReplicaError(f"replica {self.index} exited"))
+        self.on_state_change()
+
+    def _fail_pending(self, exc: BaseException) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    def _send(self, message: tuple) -> None:
+        with self._lock:
+            self._conn.send(message)
+
+    def call(self, method: str, *args, on_text: Callable[[str], None] | None = None) -> tuple[int, Future]:
+        if method not in REPLICA_METHODS:
+            raise ValueError(f"unsupported replica method: {method}")
+        future: Future = Future()
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._pending[request_id] = (future, on_text)
+        try:
+            self._send(("call", request_id, method, args))
+        except (OSError, ValueError) as exc:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise ReplicaError(f"replica {self.index} is unavailable") from exc
+        return request_id, future
+
+    def ping(self) -> None:
+        try:
+            self._send(("ping",))
+        except (OSError, ValueError):
+            pass
+
+    def generate_batch(
+        self,
+        questions: list[str],
+        configs: list[GenerationConfig],
+        on_text: Callable[[str], None] | None = None,
+        stop_events: list[threading.Event | None] | None = None,
+    ) -> list[GenerationOutput]:
+        request_id, future = self.call(
+            "generate_batch", questions, configs, on_text is not None, on_text=on_text
+        )
+        return self._wait(request_id, future, stop_events)
+
+    def convert_and_verify(
+        self,
+        question: str,
+        convert_config: GenerationConfig,
+        verify_config: GenerationConfig,
+        stop_event: threading.Event | None = None,
+    ) -> tuple[GenerationOutput, GenerationOutput]:
+        request_id, future = self.call("convert_and_verify", question, convert_config, verify_config)
+        return self._wait(request_id, future, [stop_event])
+
+    def _wait(self, request_id: int, future: Future, stop_events: list[threading.Event | None] | None):
+        """결과를 기다리며 set된 stop_events를 워커로 전달한다."""
+        forwarded = set()
+        while True:
+            try:
+                return future.result(timeout=CANCEL_POLL_S)
+            except TimeoutError:
+                pass
+            for row, event in enumerate(stop_events or []):
+                if event is not None and event.is_set() and row not in forwarded:
+                    forwarded.add(row)
+                    try:
+                        self._send(("cancel", request_id, row))
+                    except (OSError, ValueError):
+                        pass
+
+    def count_text_tokens(self, text: str) -> int:
+        return self.call("count_text_tokens", text)[1].result()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self.state = "stopped"
+        conn, process = self._conn, self._process
+        if conn is not None:
+            try:
+                conn.send(("stop",))
+            except (OSError, ValueError):
+                pass
+        if process is not None:
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        if conn is not None:
+            conn.close()
+        self._fail_pending(ReplicaError(f"replica {self.index} stopped"))
+
+
+class ReplicaPool:
+    """
+    같은 백엔드를 워커 프로세스 N개에 하나씩 올리고, 요청마다 대기 토큰 부하가 가장 작은 워커로 보낸다.
+    워커별로 CUDA_VISIBLE_DEVICES(devices) 또는 CPU 스레드 수(threads_per_replica)를 나눠 준다.
+    감시 스레드가 health_interval_s마다 ping을 보내고, 프로세스가 죽었거나
+    health_timeout_s 동안 응답이 없으면 워커를 다시 띄운다.
+    InferenceBackend와 같은 메서드를 제공하므로 GenerationBatcher에 그대로 넘길 수 있다.
+    """
+
+    def __init__(
+        self,
+        backend: str,
+        replicas: int,
+        backend_options: dict | None = None,
+        devices: list[str] | None = None,
+        threads_per_replica: int = 0,
+        health_interval_s: float = 5.0,
+        health_timeout_s: float = 60.0,
+        start_timeout_s: float = 1800.0,
+        token_counter: TokenCounter | None = None,
+    ) -> None:
+        if replicas < 1:
+            raise ValueError("replicas must be >= 1")
+        if devices is not None and len(devices) < replicas:
+            raise ValueError("need one device set per replica")
+        self.health_interval = health_interval_s
+        self.health_timeout = health_timeout_s
+        self.start_timeout = start_timeout_s
+        # 있으면 토큰 수는 워커에 묻지 않고 이 프로세스에서 센다(긴 SQL 계획처럼 자주 세는 경로가 생성과 겨루지 않게).
+        self.token_counter = token_counter
+        self._cond = threading.Condition()
+        self._loads = [0] * replicas
+        self._closed = False
+        context = multiprocessing.get_context("spawn")
+        self.replicas: list[Replica] = []
+        for index in range(replicas):
+            env: dict[str, str] = {}
+            if devices is not None:
+                env["CUDA_VISIBLE_DEVICES"] = devices[index]
+            if threads_per_replica:
+                env["OMP_NUM_THREADS"] = env["MKL_NUM_THREADS"] = str(threads_per_replica)
+            self.replicas.append(
+                Replica(index, backend, dict(backend_options or {}), env, threads_per_replica, context, self._notify)
+            )
+
+        started = time.perf_counter()
+        for replica in self.replicas:
+            replica.start()
+        self._wait_started()
+        self.model_name = self.replicas[0].model_name
+        self.load_timings: dict[str, float] = {"replicas_ready_s": time.perf_counter() - started}
+        for replica in self.replicas:
+            for name, value in replica.load_timings.items():
+                self.load_timings[f"replica_{replica.index}_{name}"] = value
+        self._supervisor = threading.Thread(target=self._supervise, name="replica-supervisor", daemon=True)
+        self._supervisor.start()
+
+    def _notify(self) -> None:
+        with self._cond:
+            self._cond.notify_all()
+
+    def _wait_started(self) -> None:
+        deadline = time.monotonic() + self.start_timeout
+        with self._cond:
+            while any(replica.state == "starting" for replica in self.replicas):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self._cond.wait(timeout)
+        broken = [replica for replica in self.replicas if replica.state != "ready"]
+        if broken:
+            self.close()
+            errors = "; ".join(f"replica {replica.index}: {replica.error or replica.state}" for replica in broken)
+            raise RuntimeError(f"replica pool failed to start ({errors})")
+
+    def _supervise(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed, timeout=self.health_interval)
+                if self._closed:
+                    return
+            now = time.monotonic()
+            for replica in self.replicas:
+                if replica.state == "ready" and replica.alive and now - replica.last_pong <= self.health_timeout:
+                    replica.ping()
+                    continue
+                if replica.state == "starting" and replica.alive and now - replica.started_at <= self.start_timeout:
+                    continue
+                self._restart(replica)
+
+    def _restart(self, replica: Replica) -> None:
+        replica.stop(timeout=1.0)
+        replica.restarts += 1
+        with self._cond:
+            self._loads[replica.index] = 0
+        replica.start()
+
+    def _acquire(self, load: int) -> Replica:
+        """준비된 워커 중 대기 부하가 가장 작은 워커를 고르고 부하를 더한다."""
+        deadline = time.monotonic() + self.start_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("replica pool is closed")
+                ready = [replica for replica in self.replicas if replica.state == "ready"]
+                if ready:
+                    replica = min(ready, key=lambda candidate: (self._loads[candidate.index], candidate.index))
+                    self._loads[replica.index] += load
+                    return replica
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise ReplicaError("no replica is ready")
+                self._cond.wait(timeout)
+
+    def _release(self, replica: Replica, load: int) -> None:
+        with self._cond:
+            self._loads[replica.index] = max(self._loads[replica.index] - load, 0)
+
+    def _call(self, method: str, *args):
+        replica = self._acquire(0)
+        return replica.call(method, *args)[1].result()
+
+    def queued_tokens(self) -> list[int]:
+        with self._cond:
+            return list(self._loads)
+
+    def status(self) -> list[dict]:
+        loads = self.queued_tokens()
+        return [
+            {"index": replica.index, "state": replica.state, "restarts": replica.restarts, "queued_tokens": load}
+            for replica, load in zip(self.replicas, loads)
+        ]
+
+    def count_tokens(self, config: GenerationConfig) -> int:
+        if self.token_counter is not None:
+            return self.token_counter.count_tokens(config)
+        return self._call("count_tokens", config)
+
+    def count_text_tokens(self, text: str) -> int:
+        if self.token_counter is not None:
+            return self.token_counter.count_text_tokens(text)
+        return self._call("count_text_tokens", text)
+
+    def token_budget(self, question: str, config: GenerationConfig) -> int:
+        if self.token_counter is not None:
+            return self.token_counter.token_budget(question, config)
+        return self._call("token_budget", question, config)
+
+    def generate(self, question: str, config: GenerationConfig | None = None) -> str:
+        if config is None:
+            config = GenerationConfig()
+        return self.generate_batch([question], [config])[0].text
+
+    def generate_batch(
+        self,
+        questions: list[str],
+        configs: list[GenerationConfig],
+        on_text: Callable[[str], None] | None = None,
+        stop_events: list[threading.Event | None] | None = None,
+    ) -> list[GenerationOutput]:
+        load = sum(estimate_load(question, config) for question, config in zip(questions, configs))
+        replica = self._acquire(load)
+        try:
+            outputs = replica.generate_batch(questions, configs, on_text=on_text, stop_events=stop_events)
+        finally:
+            self._release(replica, load)
+        for output in outputs:
+            output.stats["replica"] = replica.index
+        return outputs
+
+    def convert_and_verify(
+        self,
+        question: str,
+        convert_config: GenerationConfig,
+        verify_config: GenerationConfig,
+        stop_event: threading.Event | None = None,
+    ) -> tuple[GenerationOutput, GenerationOutput]:
+        # 검증 턴은 변환 결과 길이만큼 더 prefill하지 않으므로 검증 출력 한도만 더한다.
+        load = estimate_load(question, convert_config) + verify_config.max_new_tokens
+        replica = self._acquire(load)
+        try:
+            conversion, verdict = replica.convert_and_verify(
+                question, convert_config, verify_config, stop_event=stop_event
+            )
+        finally:
+            self._release(replica, load)
+        conversion.stats["replica"] = verdict.stats["replica"] = replica.index
+        return conversion, verdict
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for replica in self.replicas:
+            replica.stop()
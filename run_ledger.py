@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from dataclasses import dataclass, field
+
+# 파이프라인 단계 이름(원장의 stage 값)
+STAGE_EXPORT = "export"  # XML -> 문장별 .sql
+STAGE_SPLIT = "split"  # .sql -> 조각 + manifest
+STAGE_CONVERT = "convert"  # 문장 -> 변환 결과(DB)
+STAGE_MERGE = "merge"  # manifest + 변환 조각 -> 합친 SQL
+
+
+def content_hash(*chunks: str | bytes) -> str:
+    """여러 조각을 이어 붙인 내용의 sha256. 조각 경계도 해시에 넣어 ("ab", "c")와 ("a", "bc")를 구분한다."""
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        data = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def file_hash(path: str | os.PathLike) -> str | None:
+    """파일 내용의 content_hash. 파일이 없으면 None."""
+    try:
+        with open(path, "rb") as f:
+            return content_hash(f.read())
+    except FileNotFoundError:
+        return None
+
+
+@dataclass
+class LedgerEntry:
+    stage: str
+    item: str
+    input_hash: str
+    outputs: dict[str, str] = field(default_factory=dict)  # 출력 파일 경로 -> 내용 해시
+    output_hash: str | None = None  # 파일이 아닌 출력(예: DB에 저장한 변환 결과)의 해시
+    info: dict = field(default_factory=dict)  # 단계별 부가 정보(문장 수, 조각 수 등)
+    updated_at: float = 0.0
+
+
+class RunLedger:
+    """
+    단계(stage)별 항목(item)의 입력/출력 해시를 SQLite에 남기는 실행 원장.
+    다시 실행할 때 입력 해시가 같고 기록한 출력 파일이 그대로 있으면 그 항목을 건너뛴다.
+    항목은 성공한 뒤에만 기록하므로 중간에 멈춘 실행은 끝나지 않은 항목부터 이어서 한다.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._db: sqlite3.Connection | None = None
+        self._pid: int | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is not None and self._pid == os.getpid():
+            return self._db
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._pid = os.getpid()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ledger_items (
+                    stage TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    input_hash TEXT NOT NULL,
+                    outputs TEXT NOT NULL,
+                    output_hash TEXT,
+                    info TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (stage, item)
+                )
+                """
+            )
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ledger_runs (
+                    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    stage TEXT NOT NULL,
+                    started_at REAL NOT NULL,
+                    finished_at REAL,
+                    processed INTEGER NOT NULL DEFAULT 0,
+                    skipped INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+        return self._db
+
+    def get(self, stage: str, item: str) -> LedgerEntry | None:
+        row = self._connect().execute(
+            """
+            SELECT input_hash, outputs, output_hash, info, updated_at
+            FROM ledger_items
+            WHERE stage = ? AND item = ?
+            """,
+            (stage, item),
+        ).fetchone()
+        if row is None:
+            return None
+        return LedgerEntry(
+            stage=stage,
+            item=item,
+            input_hash=row[0],
+            outputs=json.loads(row[1]),
+            output_hash=row[2],
+            info=json.loads(row[3]),
+            updated_at=row[4],
+        )
+
+    def current(self, stage: str, item: str, input_hash: str, verify_outputs: bool = True) -> LedgerEntry | None:
+        """
+        지난번 성공한 실행과 입력이 같으면 그 기록을, 아니면 None을 돌려준다.
+        verify_outputs면 기록한 출력 파일이 지워졌거나 바뀐 경우에도 None이다(다시 만든다).
+        """
+        entry = self.get(stage, item)
+        if entry is None or entry.input_hash != input_hash:
+            return None
+        if verify_outputs and any(file_hash(path) != digest for path, digest in entry.outputs.items()):
+            return None
+        return entry
+
+    def record(
+        self,
+        stage: str,
+        item: str,
+        input_hash: str,
+        outputs: list[str] | None = None,
+        output_hash: str | None = None,
+        info: dict | None = None,
+    ) -> LedgerEntry:
+        """성공한 항목을 기록한다. outputs는 출력 파일 경로 목록이며 지금 내용의 해시를 함께 남긴다."""
+        entry = LedgerEntry(
+            stage=stage,
+            item=item,
+            input_hash=input_hash,
+            outputs={path: file_hash(path) for path in outputs or []},
+            output_hash=output_hash,
+            info=info or {},
+            updated_at=time.time(),
+        )
+        db = self._connect()
+        with db:
+            db.execute(
+                """
+                INSERT OR REPLACE INTO ledger_items (stage, item, input_hash, outputs, output_hash, info, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    stage,
+                    item,
+                    input_hash,
+                    json.dumps(entry.outputs, ensure_ascii=False),
+                    output_hash,
+                    json.dumps(entry.info, ensure_ascii=False),
+                    entry.updated_at,
+                ),
+            )
+        return entry
+
+    def forget(self, stage: str, item: str) -> None:
+        db = self._connect()
+        with db:
+            db.execute("DELETE FROM ledger_items WHERE stage = ? AND item = ?", (stage, item))
+
+    def begin_run(self, stage: str) -> int:
+        db = self._connect()
+        with db:
+            cursor = db.execute("INSERT INTO ledger_runs (stage, started_at) VALUES (?, ?)", (stage, time.time()))
+        return cursor.lastrowid
+
+    def finish_run(self, run_id: int, processed: int, skipped: int, failed: int) -> None:
+        db = self._connect()
+        with db:
+            db.execute(
+                "UPDATE ledger_runs SET finished_at = ?, processed = ?, skipped = ?, failed = ? WHERE run_id = ?",
+                (time.time(), processed, skipped, failed, run_id),
+            )
+
+    def close(self) -> None:
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import glob
+import json
+import os
+import sys
+import time
+from collections import Counter
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import asdict, dataclass
+
+from parse_cache import DEFAULT_MAX_BYTES, ParseCache
+from parse_sql import DEFAULT_DIALECT, DEFAULT_MAX_CHARS, load_token_counter, split_sql_text, write_parts
+from run_ledger import STAGE_SPLIT, RunLedger, content_hash
+
+# 한 번에 풀에 넣어 두는 작업 수(워커 수의 배수). 수만 개 파일을 한꺼번에 제출하지 않는다.
+PENDING_PER_WORKER = 4
+
+
+@dataclass(frozen=True)
+class SplitOptions:
+    dialect: str = DEFAULT_DIALECT
+    max_chars: int = DEFAULT_MAX_CHARS
+    min_depth_to_extract: int = 2
+    output_masked: bool = False
+    fragments_dir: str | None = None
+    max_tokens: int | None = None
+    tokenizer: str | None = None  # max_tokens와 함께 주면 워커마다 한 번 불러와 토큰 수로 나눈다
+    cache_path: str | None = None  # 주면 parse_cache로 같은 SQL/설정의 분할 결과를 재사용한다
+    cache_max_bytes: int = DEFAULT_MAX_BYTES
+
+
+@dataclass
+class SplitJob:
+    name: str  # 원본 파일 이름(결과 보고용)
+    out_dir: str
+    input_path: str | None = None
+    sql_text: str | None = None  # 주면 파일을 읽지 않고 이 텍스트를 나눈다
+
+
+@dataclass
+class SplitFileResult:
+    name: str
+    ok: bool
+    elapsed_s: float
+    out_dir: str
+    manifest_path: str | None = None
+    statements: int = 0
+    parts: int = 0  # main + CTE 조각 수
+    oversized: int = 0
+    cached: bool = False  # 모든 문장을 parse_cache에서 꺼냈으면 True
+    skipped: bool = False  # 원장 기준으로 바뀌지 않아 다시 나누지 않았으면 True
+    error: str | None = None
+    worker_pid: int | None = None
+
+
+_count_tokens: Callable[[str], int] | None = None
+_cache: ParseCache | None = None
+
+
+def _init_worker(options: SplitOptions) -> None:
+    global _count_tokens, _cache
+    _count_tokens = load_token_counter(options.tokenizer) if options.tokenizer else None
+    _cache = ParseCache(options.cache_path, options.cache_max_bytes) if options.cache_path else None
+
+
+def split_job(job: SplitJob, options: SplitOptions) -> SplitFileResult:
+    """파일 하나를 나눠 쓴다. 예외는 올리지 않고 결과의 error에 담는다."""
+    started = time.perf_counter()
+    base_name = os.path.splitext(os.path.basename(job.name))[0]
+    hits, misses = (_cache.hits, _cache.misses) if _cache is not None else (0, 0)
+    try:
+        sql_text = job.sql_text
+        if sql_text is None:
+            with open(job.input_path, "r", encoding="utf-8") as f:
+                sql_text = f.read()
+        parts = split_sql_text(
+            sql_text,
+            dialect=options.dialect,
+            max_chars=options.max_chars,
+            min_depth_to_extract=options.min_depth_to_extract,
+            count_tokens=_count_tokens,
+            max_tokens=options.max_tokens if _count_tokens is not None else None,
+            cache=_cache,
+            tokenizer=options.tokenizer,
+        )
+        write_parts(
+            parts,
+            out_dir=job.out_dir,
+            base_name=base_name,
+            output_masked=options.output_masked,
+            fragments_dir=options.fragments_dir,
+        )
+    except Exception as exc:  # noqa: BLE001
+        return SplitFileResult(
+            name=job.name,
+            ok=False,
+            elapsed_s=time.perf_counter() - started,
+            out_dir=job.out_dir,
+            error=f"{type(exc).__name__}: {exc}",
+            worker_pid=os.getpid(),
+        )
+    return SplitFileResult(
+        name=job.name,
+        ok=True,
+        elapsed_s=time.perf_counter() - started,
+        out_dir=job.out_dir,
+        manifest_path=os.path.join(job.out_dir, f"{base_name}__manifest.json"),
+        statements=len(parts),
+        parts=sum(1 + len(part.ctes) for part in parts),
+        oversized=sum(len(part.meta.get("oversized", [])) for part in parts),
+        cached=_cache is not None and _cache.hits > hits and _cache.misses == misses,
+        worker_pid=os.getpid(),
+    )
+
+
+def split_input_hash(job: SplitJob, options: SplitOptions) -> str | None:
+    """원장에 남길 입력 해시: SQL 원문 + 출력 위치 + 분할 설정. 파일을 읽을 수 없으면 None(워커가 실패로 보고한다)."""
+    try:
+        if job.sql_text is not None:
+            source: str | bytes = job.sql_text
+        else:
+            with open(job.input_path, "rb") as f:
+                source = f.read()
+    except OSError:
+        return None
+    settings = {
+        "out_dir": os.path.abspath(job.out_dir),
+        "dialect": options.dialect,
+        "max_chars": options.max_chars,
+        "min_depth_to_extract": options.min_depth_to_extract,
+        "output_masked": options.output_masked,
+        "fragments_dir": os.path.abspath(options.fragments_dir) if options.fragments_dir else None,
+        "max_tokens": options.max_tokens,
+        "tokenizer": options.tokenizer,
+    }
+    return content_hash(source, json.dumps(settings, sort_keys=True))
+
+
+def manifest_outputs(manifest_path: str) -> list[str]:
+    """manifest와 그것이 가리키는 main/CTE 조각 파일 경로."""
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    parts_dir = os.path.dirname(manifest_path)
+    outputs = [manifest_path]
+    for entry in manifest:
+        outputs.append(os.path.join(parts_dir, entry["main_file"]))
+        outputs.extend(os.path.normpath(os.path.join(parts_dir, path)) for path in entry.get("cte_files", {}).values())
+    return outputs
+
+
+def run_split_jobs(
+    jobs: Iterable[SplitJob],
+    options: SplitOptions,
+    workers: int | None = None,
+    ledger: RunLedger | None = None,
+    force: bool = False,
+) -> Iterator[SplitFileResult]:
+    """
+    jobs를 프로세스 풀에서 나누고, 끝난 순서대로 결과를 낸다.
+    작업은 워커 수의 PENDING_PER_WORKER배까지만 미리 제출해 메모리를 일정하게 유지한다.
+    워커 프로세스가 죽는 등 풀 자체의 오류도 해당 파일의 실패로 보고한다.
+    ledger를 주면 지난번 성공한 분할과 입력(SQL, 출력 위치, 설정)이 같고 출력 파일이 그대로인 파일은
+    제출하지 않고 skipped=True로 바로 내며, 새로 나눈 파일은 성공하면 원장에 기록한다.
+    force면 원장과 상관없이 모두 다시 나누고 기록만 새로 한다.
+    """
+    workers = workers or os.cpu_count() or 1
+    if options.max_tokens is not None and options.tokenizer is None:
+        raise ValueError("max_tokens requires tokenizer")
+    jobs = iter(jobs)
+    pending: dict[Future, tuple[SplitJob, float, str | None]] = {}
+    skipped: list[SplitFileResult] = []
+    run_id = ledger.begin_run(STAGE_SPLIT) if ledger else None
+    counts = {"processed": 0, "skipped": 0, "failed": 0}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(options,)) as pool:
+
+        def submit_next() -> bool:
+            for job in jobs:
+                input_hash = split_input_hash(job, options) if ledger else None
+                entry = None
+                if input_hash and not force:
+                    entry = ledger.current(STAGE_SPLIT, os.path.abspath(job.out_dir), input_hash)
+                if entry is not None:
+                    skipped.append(
+                        SplitFileResult(
+                            name=job.name,
+                            ok=True,
+                            elapsed_s=0.0,
+                            out_dir=job.out_dir,
+                            manifest_path=entry.info.get("manifest_path"),
+                            statements=entry.info.get("statements", 0),
+                            parts=entry.info.get("parts", 0),
+                            oversized=entry.info.get("oversized", 0),
+                            skipped=True,
+                        )
+                    )
+                    continue
+                pending[pool.submit(split_job, job, options)] = (job, time.perf_counter(), input_hash)
+                return True
+            return False
+
+        def finish(result: SplitFileResult, input_hash: str | None) -> SplitFileResult:
+            counts["skipped" if result.skipped else "processed" if result.ok else "failed"] += 1
+            if ledger and result.ok and not result.skipped and input_hash:
+                info = {
+                    "manifest_path": result.manifest_path,
+                    "statements": result.statements,
+                    "parts": result.parts,
+                    "oversized": result.oversized,
+                }
+                outputs = manifest_outputs(result.manifest_path)
+                ledger.record(STAGE_SPLIT, os.path.abspath(result.out_dir), input_hash, outputs=outputs, info=info)
+            return result
+
+        while len(pending) < workers * PENDING_PER_WORKER and submit_next():
+            pass
+        while pending or skipped:
+            while skipped:
+                yield finish(skipped.pop(0), None)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, submitted, input_hash = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as exc:  # noqa: BLE001
+                    result = SplitFileResult(
+                        name=job.name,
+                        ok=False,
+                        elapsed_s=time.perf_counter() - submitted,
+                        out_dir=job.out_dir,
+                        error=f"{type(exc).__name__}: {exc}",
+                    )
+                yield finish(result, input_hash)
+                submit_next()
+    if ledger:
+        ledger.finish_run(run_id, counts["processed"], counts["skipped"], counts["failed"])
+
+
+def collect_input_paths(source: str) -> list[str]:
+    """디렉터리면 그 안의 *.sql, 파일이면 그 파일, 그 밖에는 glob 패턴(** 포함)으로 보고 정렬해 돌려준다."""
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, "*.sql"))
+    elif os.path.isfile(source):
+        paths = [source]
+    else:
+        paths = glob.glob(source, recursive=True)
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+def main() -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="SQL 파일들을 프로세스 풀에서 파일 단위로 나누고, 끝난 파일마다 결과를 JSON 한 줄로 출력한다")
+    parser.add_argument("source", help="SQL 파일 폴더, 파일, 또는 glob 패턴(예: './exports/**/*.sql')")
+    parser.add_argument("out_dir", help="파일마다 <out_dir>/<파일 이름>/ 아래에 조각과 manifest를 쓴다")
+    parser.add_argument("--workers", type=int, default=None, help="프로세스 수(기본: CPU 수)")
+    parser.add_argument("--dialect", default=DEFAULT_DIALECT)
+    parser.add_argument("--max_chars", type=int, default=DEFAULT_MAX_CHARS)
+    parser.add_argument("--min_depth", type=int, default=2)
+    parser.add_argument("--output_masked", action="store_true")
+    parser.add_argument("--fragments_dir", default=None, help="반복되는 CTE 조각을 한 번만 저장할 공용 폴더")
+    parser.add_argument("--max_tokens", type=int, default=None, help="조각당 SQL 토큰 한도(--tokenizer와 함께)")
+    parser.add_argument("--tokenizer", default=None, help="토큰 수를 셀 모델/토크나이저 경로")
+    parser.add_argument("--cache", default=None, help="분할 결과를 재사용할 SQLite 파일(parse_cache)")
+    parser.add_argument("--cache_max_mb", type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024))
+    parser.add_argument("--ledger", default=None, help="바뀐 파일만 다시 나누도록 입력/출력 해시를 남길 원장(SQLite)")
+    parser.add_argument("--force", action="store_true", help="--ledger가 있어도 모든 파일을 다시 나눈다")
+    args = parser.parse_args()
+
+    if args.max_tokens is not None and args.tokenizer is None:
+        parser.error("--max_tokens requires --tokenizer")
+    paths = collect_input_paths(args.source)
+    if not paths:
+        parser.error(f"no .sql files matched: {args.source}")
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    duplicates = sorted(name for name, count in Counter(names).items() if count > 1)
+    if duplicates:
+        parser.error(f"files with the same name would share an output folder: {', '.join(duplicates[:10])}")
+
+    options = SplitOptions(
+        dialect=args.dialect,
+        max_chars=args.max_chars,
+        min_depth_to_extract=args.min_depth,
+        output_masked=args.output_masked,
+        fragments_dir=args.fragments_dir,
+        max_tokens=args.max_tokens,
+        tokenizer=args.tokenizer,
+        cache_path=args.cache,
+        cache_max_bytes=args.cache_max_mb * 1024 * 1024,
+    )
+    jobs = (
+        SplitJob(name=os.path.basename(path), out_dir=os.path.join(args.out_dir, name), input_path=path)
+        for path, name in zip(paths, names)
+    )
+
+    started = time.perf_counter()
+    succeeded = failed = parts = cached = skipped = 0
+    ledger = RunLedger(args.ledger) if args.ledger else None
+    for result in run_split_jobs(jobs, options, workers=args.workers, ledger=ledger, force=args.force):
+        print(json.dumps(asdict(result), ensure_ascii=False), flush=True)
+        if result.ok:
+            succeeded += 1
+            parts += result.parts
+            cached += result.cached
+            skipped += result.skipped
+        else:
+            failed += 1
+    elapsed = time.perf_counter() - started
+    print(
+        f"split {len(paths)} files in {elapsed:.1f}s: {succeeded} ok "
+        f"({parts} parts, {cached} from cache, {skipped} unchanged), "
+        f"{failed} failed",
+        file=sys.stderr,
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
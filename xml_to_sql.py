@@ -11,7 +11,10 @@ Rules:
 - Unescape XML entities like &lt; &gt; &amp; so the SQL is readable.
 
 Usage:
-  python export_sql_from_xml.py /path/to/oracle_xml_folder /path/to/output_folder
+  python export_sql_from_xml.py /path/to/oracle_xml_folder /path/to/output_folder [--ledger run_ledger.sqlite3]
+
+With --ledger, XML files whose content (and output folder) did not change since the last
+successful export are skipped, and files a mapper no longer produces are removed.
 """
 
 from __future__ import annotations
@@ -21,9 +24,11 @@ import re
 import sys
 import html
 from pathlib import Path
-from typing import Iterable, Tuple
+from typing import Iterable, Optional, Set, Tuple
 import xml.etree.ElementTree as ET
 
+from run_ledger import STAGE_EXPORT, RunLedger, content_hash, file_hash
+
 
 TARGET_TAGS = {"sql", "select", "insert", "update", "delete"}
 
@@ -53,11 +58,29 @@ def sanitize_filename(name: str) -> str:
     return name
 
 
-def unique_path(base_path: Path) -> Path:
+def unique_path(
+    base_path: Path,
+    content: Optional[str] = None,
+    reusable: Optional[Set[Path]] = None,
+    claimed: Optional[Set[Path]] = None,
+) -> Path:
     """
     If base_path exists, create base_path stem + _{n}.sql
+    An existing candidate is reused instead when it already holds `content` (unchanged re-export)
+    or is in `reusable` (written for the same XML last time). Paths in `claimed` were already
+    written during this run and are never reused.
     """
-    if not base_path.exists():
+    reusable = reusable or set()
+    claimed = claimed or set()
+
+    def usable(cand: Path) -> bool:
+        if cand in claimed:
+            return False
+        if not cand.exists() or cand in reusable:
+            return True
+        return content is not None and cand.read_text(encoding="utf-8") == content
+
+    if usable(base_path):
         return base_path
     stem = base_path.stem
     suffix = base_path.suffix
@@ -65,7 +88,7 @@ def unique_path(base_path: Path) -> Path:
     n = 2
     while True:
         cand = parent / f"{stem}_{n}{suffix}"
-        if not cand.exists():
+        if usable(cand):
             return cand
         n += 1
 
@@ -113,19 +136,39 @@ def iter_sql_nodes(tree_root: ET.Element) -> Iterable[Tuple[str, ET.Element]]:
             yield tag, elem
 
 
-def export_from_xml_file(xml_path: Path, out_dir: Path) -> int:
+def export_from_xml_file(
+    xml_path: Path,
+    out_dir: Path,
+    reusable: Optional[Set[Path]] = None,
+    claimed: Optional[Set[Path]] = None,
+) -> int:
     """
     Export all eligible nodes from a single XML file.
     Returns number of exported SQL files.
     """
+    written = _export_nodes(xml_path, out_dir, reusable, claimed)
+    return len(written) if written is not None else 0
+
+
+def _export_nodes(
+    xml_path: Path,
+    out_dir: Path,
+    reusable: Optional[Set[Path]] = None,
+    claimed: Optional[Set[Path]] = None,
+) -> Optional[list]:
+    """
+    Export all eligible nodes from a single XML file.
+    Returns the written paths, or None if the XML could not be parsed.
+    """
     try:
         tree = ET.parse(xml_path)
     except ET.ParseError as e:
         print(f"[WARN] Skipping (XML parse error): {xml_path} ({e})")
-        return 0
+        return None
 
     root = tree.getroot()
-    count = 0
+    claimed = claimed if claimed is not None else set()
+    written = []
 
     for tag, elem in iter_sql_nodes(root):
         sql_id = elem.get("id")
@@ -134,23 +177,74 @@ def export_from_xml_file(xml_path: Path, out_dir: Path) -> int:
             continue
 
         filename = sanitize_filename(sql_id) + ".sql"
-        out_path = unique_path(out_dir / filename)
-
         content = inner_xml_to_text(elem)
 
         # Optionally, add a tiny header comment showing origin
         header = f"-- source: {xml_path.name}  tag: <{tag} id=\"{sql_id}\">\n"
         final = header + content
 
-        out_path.write_text(final, encoding="utf-8")
-        count += 1
+        out_path = unique_path(out_dir / filename, content=final, reusable=reusable, claimed=claimed)
+        claimed.add(out_path)
+        # Leave unchanged files alone so their mtime (and anything keyed on it) stays the same.
+        if not out_path.exists() or out_path.read_text(encoding="utf-8") != final:
+            out_path.write_text(final, encoding="utf-8")
+        written.append(out_path)
 
-    return count
+    return written
+
+
+def export_xml_files(xml_files: Iterable[Path], out_dir: Path, ledger: Optional[RunLedger] = None) -> Tuple[int, int]:
+    """
+    Export several XML files into out_dir.
+    Returns (exported SQL files, XML files skipped as unchanged).
+
+    With a ledger, an XML file is skipped when its content and out_dir match the last successful
+    export and the files written then are still intact. A changed XML may overwrite its own previous
+    outputs, and outputs it no longer produces are removed (unless edited since).
+    """
+    claimed: Set[Path] = set()
+    exported = 0
+    skipped = 0
+    run_id = ledger.begin_run(STAGE_EXPORT) if ledger else None
+    processed = failed = 0
+    for xml_path in xml_files:
+        item = str(Path(xml_path).resolve())
+        input_hash = content_hash(Path(xml_path).read_bytes(), str(Path(out_dir).resolve()))
+        previous = ledger.get(STAGE_EXPORT, item) if ledger else None
+        if ledger and ledger.current(STAGE_EXPORT, item, input_hash):
+            claimed.update(Path(path) for path in previous.outputs)
+            skipped += 1
+            continue
+
+        reusable = {Path(path) for path in previous.outputs} if previous else set()
+        written = _export_nodes(xml_path, out_dir, reusable=reusable, claimed=claimed)
+        if written is None:
+            failed += 1
+            continue
+        exported += len(written)
+        processed += 1
+        if ledger:
+            for path, digest in previous.outputs.items() if previous else ():
+                if Path(path) not in claimed and file_hash(path) == digest:
+                    os.remove(path)
+            ledger.record(STAGE_EXPORT, item, input_hash, outputs=[str(path) for path in written])
+    if ledger:
+        ledger.finish_run(run_id, processed, skipped, failed)
+    return exported, skipped
 
 
 def main(argv: list[str]) -> int:
+    ledger = None
+    if "--ledger" in argv:
+        index = argv.index("--ledger")
+        if index + 1 >= len(argv):
+            print("Usage: --ledger <path>")
+            return 2
+        ledger = RunLedger(argv[index + 1])
+        argv = argv[:index] + argv[index + 2:]
+
     if len(argv) < 2:
-        print("Usage: python export_sql_from_xml.py <oracle_xml_folder> [output_folder]")
+        print("Usage: python export_sql_from_xml.py <oracle_xml_folder> [output_folder] [--ledger <path>]")
         return 2
 
     src_dir = Path(argv[1]).expanduser().resolve()
@@ -167,9 +261,16 @@ def main(argv: list[str]) -> int:
         print(f"[WARN] No .xml files found in {src_dir}")
         return 0
 
+    if ledger is not None:
+        total, skipped = export_xml_files(xml_files, out_dir, ledger=ledger)
+        print(f"\nDone. Total exported: {total} (unchanged XML skipped: {skipped})")
+        print(f"Output folder: {out_dir}")
+        return 0
+
     total = 0
+    claimed: Set[Path] = set()
     for xml_path in xml_files:
-        exported = export_from_xml_file(xml_path, out_dir)
+        exported = export_from_xml_file(xml_path, out_dir, claimed=claimed)
         print(f"[OK] {xml_path.name}: exported {exported}")
         total += exported
 